@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for parsing and replaying TD event logs.
+
+Synthetic event logs of each size are built with the emulator, then every
+benchmark reports the best time over the repeats, the rate in items per
+second and the peak of the memory allocated by Python, traced in a separate
+run so the tracing does not skew the time:
+
+    process             TDEventLogActor.process
+    replay              TDEventLogActor.replay, streaming
+    dump_td_event_logs  TDEventLogActor.dump_td_event_logs, to /dev/null
+    tdreport            TdReport parsing and field access, one per item
+    binaryblob          BinaryBlob zero-copy accessors, one record per item
+
+The results are saved as JSON. Compare them with the results of a previous
+release to catch regressions, the exit status is 1 if any is found:
+
+    python3 benchmarks/bench_attestation.py -o 0.0.12.json
+    python3 benchmarks/bench_attestation.py -c 0.0.12.json -t 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import tracemalloc
+
+from bench_binaryblob import RECORD_SIZE, walk
+from pytdxattest.actor import TDEventLogActor
+from pytdxattest.binaryblob import BinaryBlob
+from pytdxattest.emulator import TdxEmulator, build_event_log, EMULATED_LOG_AREA_START
+from pytdxattest.tdreport import TdReport
+from pytdxattest.utility import TDX_VERSION_1_5
+
+DEFAULT_SIZES = "100,1000,10000,100000,1000000"
+
+
+def _actor(log):
+    return TDEventLogActor(EMULATED_LOG_AREA_START, None, data=log)
+
+
+def bench_process(log, _):
+    """
+    Parse all the entries of the event log
+    """
+    _actor(log).process()
+
+
+def bench_replay(log, _):
+    """
+    Replay the event log in a single streaming pass
+    """
+    _actor(log).replay()
+
+
+def bench_dump_td_event_logs(log, _):
+    """
+    Dump all the entries of the event log through the logging handler
+    """
+    _actor(log).dump_td_event_logs()
+
+
+def bench_tdreport(report, count):
+    """
+    Parse TD reports and read the fields the verification uses
+    """
+    for _ in range(count):
+        tdreport = TdReport(report, version=TDX_VERSION_1_5)
+        _ = tdreport.report_mac_struct.report_data
+        _ = tdreport.tee_tcb_info.module_version
+        _ = tdreport.td_info.mrtd
+        _ = tdreport.td_info.rtmr_3
+
+
+def bench_binaryblob(data, _):
+    """
+    Walk fixed size records with the zero-copy accessors
+    """
+    walk(BinaryBlob(data, zero_copy=True))
+
+
+# name -> (function, unit of the items, input builder)
+BENCHMARKS = {
+    "process": (bench_process, "events", lambda count: build_event_log(count)[0]),
+    "replay": (bench_replay, "events", lambda count: build_event_log(count)[0]),
+    "dump_td_event_logs": (bench_dump_td_event_logs, "events",
+                           lambda count: build_event_log(count)[0]),
+    "tdreport": (bench_tdreport, "reports",
+                 lambda count: TdxEmulator(TDX_VERSION_1_5, events=0).build_report()),
+    "binaryblob": (bench_binaryblob, "records",
+                   lambda count: os.urandom(count * RECORD_SIZE + RECORD_SIZE)),
+}
+
+
+def measure(function, data, count, repeat):
+    """
+    Return the best time of the repeats and the traced peak memory
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(data, count)
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+
+    tracemalloc.start()
+    try:
+        function(data, count)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run(names, sizes, repeat, dump_max):
+    """
+    Run the benchmarks over the sizes, print and return the result records
+    """
+    results = []
+    for name in names:
+        function, unit, build = BENCHMARKS[name]
+        for count in sizes:
+            if name == "dump_td_event_logs" and count > dump_max:
+                continue
+            data = build(count)
+            seconds, peak = measure(function, data, count, repeat)
+            result = {
+                "name": name,
+                "count": count,
+                "unit": unit,
+                "seconds": seconds,
+                "rate": count / max(seconds, 1e-9),
+                "peak_bytes": peak,
+            }
+            results.append(result)
+            print(f"{name:20s} {count:9d} {unit:8s} {seconds * 1000:12.2f} ms "
+                  f"{result['rate']:14.0f} {unit}/s {peak / 1024 / 1024:10.2f} MiB peak")
+    return results
+
+
+def _environment():
+    try:
+        # pylint: disable=import-outside-toplevel
+        from importlib.metadata import version, PackageNotFoundError
+        package_version = version("pytdxattest")
+    except (ImportError, PackageNotFoundError):
+        package_version = None
+    return {
+        "pytdxattest": package_version,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the results slower or bigger than the baseline by more than the
+    threshold, return the number of regressions
+    """
+    previous = {(result["name"], result["count"]): result for result in baseline["results"]}
+    regressions = 0
+    for result in results:
+        before = previous.get((result["name"], result["count"]))
+        if before is None:
+            continue
+        for key, worse in (("rate", result["rate"] < before["rate"] * (1 - threshold)),
+                           ("peak_bytes",
+                            result["peak_bytes"] > before["peak_bytes"] * (1 + threshold))):
+            if worse:
+                regressions += 1
+                print(f"REGRESSION {result['name']} {result['count']} {key}: "
+                      f"{before[key]:.0f} -> {result[key]:.0f}")
+    return regressions
+
+
+def main():
+    """
+    Parse the arguments, run the benchmarks, save and compare the results
+    """
+    parser = argparse.ArgumentParser(description="Benchmark event log parsing and replay")
+    parser.add_argument('-n', default=DEFAULT_SIZES, dest='sizes',
+                        help='Comma separated numbers of events or items')
+    parser.add_argument('-b', action='append', choices=sorted(BENCHMARKS), dest='names',
+                        help='Benchmark to run, can be repeated, all by default')
+    parser.add_argument('-r', type=int, default=3, dest='repeat',
+                        help='Repeat count, the best run is reported')
+    parser.add_argument('-d', type=int, default=10000, dest='dump_max',
+                        help='Largest event log to dump')
+    parser.add_argument('-o', dest='output', help='JSON file to save the results to')
+    parser.add_argument('-c', dest='baseline', help='JSON results to compare with')
+    parser.add_argument('-t', type=float, default=0.2, dest='threshold',
+                        help='Relative slowdown or memory growth reported as a regression')
+    args = parser.parse_args()
+
+    # dump the entries the way the tools do, into /dev/null
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        logging.basicConfig(level=logging.INFO, format="%(message)s", stream=devnull)
+        sizes = [int(size) for size in args.sizes.split(",")]
+        results = run(args.names or list(BENCHMARKS), sizes, args.repeat, args.dump_max)
+
+    report = {"environment": _environment(), "repeat": args.repeat, "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fobj:
+            json.dump(report, fobj, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as fobj:
+            baseline = json.load(fobj)
+        if compare(results, baseline, args.threshold) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
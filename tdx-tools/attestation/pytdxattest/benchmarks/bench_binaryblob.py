@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the BinaryBlob accessors.
+
+It compares the previous slice-and-unpack accessors, the precompiled struct
+accessors and the zero-copy mode on the same buffer, walking it the way the
+event log parser does: read a few integers, then take a digest sized slice.
+
+    python3 benchmarks/bench_binaryblob.py -s 4194304 -r 5
+"""
+
+import os
+import struct
+import argparse
+import timeit
+
+from pytdxattest.binaryblob import BinaryBlob
+
+RECORD_SIZE = 12 + 2 + 48 + 4
+
+
+class LegacyBlob(BinaryBlob):
+    """
+    The accessors as they were before the precompiled readers, for reference
+    """
+
+    def get_uint16(self, pos):
+        """
+        Get UINT16 integer by slicing and unpacking
+        """
+        assert pos + 2 <= self.length
+        return (struct.unpack("<H", self.data[pos:pos + 2])[0], pos + 2)
+
+    def get_uint32(self, pos):
+        """
+        Get UINT32 integer by slicing and unpacking
+        """
+        assert pos + 4 <= self.length
+        return (struct.unpack("<L", self.data[pos:pos + 4])[0], pos + 4)
+
+    def get_uint64(self, pos):
+        """
+        Get UINT64 integer by slicing and unpacking
+        """
+        assert pos + 8 <= self.length
+        return (struct.unpack("<Q", self.data[pos:pos + 8])[0], pos + 8)
+
+    def get_bytes(self, pos, count):
+        """
+        Get bytes by slicing
+        """
+        if count == 0:
+            return None
+        assert pos + count <= self.length
+        return (self.data[pos:pos + count], pos + count)
+
+
+def walk(blob):
+    """
+    Walk the blob with fixed size records of uint32/uint16/digest/uint32
+    """
+    index = 0
+    end = blob.length - RECORD_SIZE
+    while index <= end:
+        _, index = blob.get_uint32(index)
+        _, index = blob.get_uint32(index)
+        _, index = blob.get_uint32(index)
+        _, index = blob.get_uint16(index)
+        _, index = blob.get_bytes(index, 48)
+        _, index = blob.get_uint32(index)
+    return index
+
+
+def run(size, repeat):
+    """
+    Run all accessor flavours and print the best time of each
+    """
+    data = os.urandom(size)
+    records = size // RECORD_SIZE
+    results = {}
+    for name, blob in (("legacy", LegacyBlob(data)),
+                       ("copy", BinaryBlob(data)),
+                       ("zero-copy", BinaryBlob(data, zero_copy=True))):
+        best = min(timeit.repeat(lambda b=blob: walk(b), number=1, repeat=repeat))
+        results[name] = best
+        print(f"{name:10s} {best * 1000:10.2f} ms  {records / best:14.0f} records/s")
+    print(f"speedup    {results['legacy'] / results['zero-copy']:10.2f}x")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark BinaryBlob accessors")
+    parser.add_argument('-s', type=int, default=4 * 1024 * 1024,
+                        help='Size of the blob in bytes', dest='size')
+    parser.add_argument('-r', type=int, default=5,
+                        help='Repeat count, the best run is reported', dest='repeat')
+    args = parser.parse_args()
+    run(args.size, args.repeat)
@@ -23,6 +23,9 @@ Traditionally IMA measurements are anchored in Trusted Platform Module (TPM),\
 User have to set 'ima_hash=sha384' in kernel command line while boot and is able to\
     switch the index of RTMR register to either 2 or 3 by using the flag '-i'. The\
     digests are extended into RTMR[3] by default.
+
+This utility extends the whole list each time it runs. To extend only the
+    measurements added since the last run, use ima_follower.py instead.
 """
 
 import os
@@ -69,15 +72,19 @@ def extend_measurements_to_rtmr(contents, rtmr_index):
         LOG.error("Invalid RTMR index %d provided", int(rtmr_index))
         return None
 
+    digests = []
     for content in contents:
         # currently RTMR only supports hash with sha384
         if 'sha384' not in content:
             LOG.info("Skip measurements not using sha384")
             continue
         content = content.split(":")
-        res = RTMR.extend_rtmr("", "", content[1], rtmr_index)
-        if res != RTMR.EXTEND_SUCCESS:
-            LOG.error("Failed to extend %s", content[1])
+        digests.append(bytes.fromhex(content[1]))
+
+    # the device node is opened once for all the digests
+    extended = RTMR.extend_rtmr_digests(digests, rtmr_index)
+    if extended != len(digests):
+        LOG.error("Failed to extend %s", digests[extended].hex())
 
     return None
 
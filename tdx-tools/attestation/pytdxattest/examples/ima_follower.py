@@ -0,0 +1,43 @@
+#!/usr/bin/python
+"""
+Follow the IMA measurement list and extend the new measurements into an RTMR
+register, see extend_ima.py for the IMA setup in the TD.
+
+Unlike extend_ima.py, it reads the binary measurement list from the position
+saved in a checkpoint file, so each cycle only parses and extends the
+measurements added since the previous one, and a restart of the daemon does
+not extend the same measurements twice. The checkpoint is discarded after a
+reboot of the TD.
+
+    ./ima_follower.py -i 3 -c /var/lib/ima_follower.json -t 5
+"""
+
+import logging
+import argparse
+from pytdxattest.ima import ImaFollower, DEFAULT_RTMR_INDEX, IMA_BINARY_MEASUREMENTS
+
+DEFAULT_CHECKPOINT = '/var/lib/ima_follower.json'
+
+LOG = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(
+        description="The daemon to extend new IMA measurements into RTMR register")
+    parser.add_argument('-i', type=int, default=DEFAULT_RTMR_INDEX,
+                        help='index of RTMR register to extend', dest='rtmr_index')
+    parser.add_argument('-c', type=str, default=DEFAULT_CHECKPOINT,
+                        help='checkpoint file of the measurements already extended',
+                        dest='checkpoint')
+    parser.add_argument('-m', type=str, default=IMA_BINARY_MEASUREMENTS,
+                        help='IMA binary measurement list', dest='measurements')
+    parser.add_argument('-t', type=float, default=5.0,
+                        help='interval in seconds between two cycles', dest='interval')
+    parser.add_argument('--once', action='store_true',
+                        help='extend the new measurements once and exit')
+    args = parser.parse_args()
+
+    with ImaFollower(args.rtmr_index, args.checkpoint, args.measurements) as follower:
+        LOG.info("Following IMA measurements from entry %d", follower.checkpoint.count)
+        follower.run(args.interval, 1 if args.once else None)
@@ -2,35 +2,131 @@
 Actors package, the bussiness logic layer.
 """
 
-import os
+import json
+import struct
 import logging
-from typing import Dict, List
+from typing import Dict, Iterator, List
+from itertools import chain
 from hashlib import sha384
 
+from .cache import TieredCache
 from .rtmr import RTMR
 from .tdreport import TdReport
-from .tdeventlog import TDEventLogEntry, TDEventLogType, TDEventLogSpecIdHeader
+from .tdeventlog import TDEventLogBase, TDEventLogEntry, TDEventLogType, \
+    TDEventLogSpecIdHeader, TDEventLogIndex, TCGAlgorithmRegistry
 from .ccel import CCEL
 from .binaryblob import BinaryBlob
+from .source import BufferSource, CCEL_EVENT_LOG, open_source
 
 __author__ = "cpio"
 
 LOG = logging.getLogger(__name__)
 
 
+# Version of the verification rules. Bump it when they change, so results
+# cached with the former rules are not used anymore.
+VERIFY_POLICY_VERSION = 1
+
+
+class VerifyCache:
+    """
+    Cache of verification results keyed by the digest of the event log, the
+    RTMR values of the TD report and the policy version, with an in-process
+    LRU layer and an optional on-disk layer. TDs booted from the same image
+    have byte-identical event logs, so their event log is replayed once.
+    """
+
+    KEY_PREFIX = struct.Struct("<I")
+
+    def __init__(self, maxsize=1024, ttl=None, directory=None,
+                 policy_version=VERIFY_POLICY_VERSION):
+        # to create the same cache in a worker process
+        self.config = (maxsize, ttl, directory, policy_version)
+        self._cache = TieredCache(maxsize, ttl, directory)
+        self._policy_version = policy_version
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, td_event_log_actor, rtmrs: bytes) -> bytes:
+        """
+        Key of the result for the event log of the actor and the expected
+        RTMR values, None if the event log cannot be read
+        """
+        digest = td_event_log_actor.digest()
+        if digest is None:
+            return None
+        return sha384(self.KEY_PREFIX.pack(self._policy_version) + digest +
+                      bytes(rtmrs)).digest()
+
+    def get(self, key: bytes) -> Dict:
+        """
+        Get the result of the key, or None
+        """
+        entry = self._cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(entry)
+
+    def put(self, key: bytes, result: Dict):
+        """
+        Store the result of the key
+        """
+        self._cache.put(key, json.dumps(result).encode())
+
+
 # pylint: disable=too-few-public-methods
 class VerifyActor:
     """
-    Actor to verify the RTMR
+    Actor to verify the RTMR, with an optional VerifyCache of the results
     """
 
-    def _verify_single_rtmr(self, rtmr_index: int, rtmr_value_1: RTMR,
-        rtmr_value_2: RTMR) -> None:
+    def __init__(self, cache: VerifyCache = None):
+        self._cache = cache
 
-        if rtmr_value_1 == rtmr_value_2:
-            LOG.info("RTMR[%d] passed the verification.", rtmr_index)
+    @staticmethod
+    def _verify_single_rtmr(rtmr: Dict) -> None:
+        if rtmr["passed"]:
+            LOG.info("RTMR[%d] passed the verification.", rtmr["index"])
         else:
-            LOG.error("RTMR[%d] did not pass the verification", rtmr_index)
+            LOG.error("RTMR[%d] did not pass the verification", rtmr["index"])
+
+    def verify_event_log(self, td_event_log_actor, expected: List[bytes]) -> Dict:
+        """
+        Replay the event log and compare the RTMR values with the expected
+        ones. Return whether all passed, the number of events and the
+        expected and replayed value of each RTMR, from the cache if the
+        same event log was verified against the same values before. With a
+        cache, "cached" tells whether it was.
+        """
+        key = None
+        if self._cache is not None:
+            key = self._cache.key(td_event_log_actor, b"".join(expected))
+            result = self._cache.get(key) if key is not None else None
+            if result is not None:
+                result["cached"] = True
+                return result
+
+        td_event_log_actor.replay()
+        result = {"passed": True, "events": 0, "rtmrs": []}
+        if td_event_log_actor.checkpoint is not None:
+            result["events"] = td_event_log_actor.checkpoint.event_count
+        for index in range(RTMR.RTMR_COUNT):
+            replayed = bytes(td_event_log_actor.get_rtmr_by_index(index).data)
+            passed = bytes(expected[index]) == replayed
+            result["passed"] = result["passed"] and passed
+            result["rtmrs"].append({
+                "index": index,
+                "expected": bytes(expected[index]).hex(),
+                "replayed": replayed.hex(),
+                "passed": passed
+            })
+
+        if key is not None:
+            self._cache.put(key, result)
+            result["cached"] = False
+        return result
 
     def verify_rtmr(self) -> None:
         """
@@ -46,33 +142,104 @@ class VerifyActor:
             ccelobj.log_area_start_address,
             ccelobj.log_area_minimum_length)
 
-        # 3. Collect event log and replay the RTMR value according to event log
-        td_event_log_actor.replay()
-
-        # 4. Read TD REPORT via TDCALL.GET_TDREPORT
+        # 3. Read TD REPORT via TDCALL.GET_TDREPORT
         td_report = TdReport.get_td_report()
+        expected = [bytes(getattr(td_report.td_info, f"rtmr_{index}"))
+                    for index in range(RTMR.RTMR_COUNT)]
+
+        # 4. Collect event log, replay the RTMR value according to event log
+        #    unless the result is cached, and verify individual RTMR value
+        #    from TDREPORT and recalculated from event log
+        result = self.verify_event_log(td_event_log_actor, expected)
+        for rtmr in result["rtmrs"]:
+            self._verify_single_rtmr(rtmr)
 
-        # 5. Verify individual RTMR value from TDREPORT and recalculated from
-        #    event log
-        self._verify_single_rtmr(
-            0,
-            td_event_log_actor.get_rtmr_by_index(0),
-            RTMR(bytearray(td_report.td_info.rtmr_0)))
 
-        self._verify_single_rtmr(
-            1,
-            td_event_log_actor.get_rtmr_by_index(1),
-            RTMR(bytearray(td_report.td_info.rtmr_1)))
+class ReplayCheckpoint:
+    """
+    Running state of a replay: the offset in the event log data where it
+    stopped and the RTMR values at that point, plus the digest of the data
+    replayed so far to detect a truncated or rewritten log.
 
-        self._verify_single_rtmr(
-            2,
-            td_event_log_actor.get_rtmr_by_index(2),
-            RTMR(bytearray(td_report.td_info.rtmr_2)))
+    The RTMR values are replayed in one pass for every digest algorithm of
+    the spec ID header, each in its own bank. The SHA384 bank is the one of
+    the RTMR registers.
+    """
 
-        self._verify_single_rtmr(
-            3,
-            td_event_log_actor.get_rtmr_by_index(3),
-            RTMR(bytearray(td_report.td_info.rtmr_3)))
+    def __init__(self):
+        self.offset = 0
+        self.event_count = 0
+        self.specid_header = None
+        # algorithm ID -> RTMR index -> running hash
+        self.banks = {}
+        self._hash_functions = {}
+        self.rtmrs = self._add_bank(TCGAlgorithmRegistry.TPM_ALG_SHA384)
+        # offset and digest of the data replayed up to the last seal()
+        self._sealed_offset = None
+        self._sealed_digest = None
+
+    def _add_bank(self, algoid: int) -> Dict[int, bytes]:
+        if algoid not in self.banks:
+            hash_function = TCGAlgorithmRegistry.get_hash_function(algoid)
+            if hash_function is None:
+                LOG.warning("Digest algorithm 0x%X is not supported, skip its replay", algoid)
+                return None
+            self._hash_functions[algoid] = hash_function
+            self.banks[algoid] = dict.fromkeys(range(RTMR.RTMR_COUNT),
+                                               bytes(hash_function().digest_size))
+        return self.banks[algoid]
+
+    def update(self, event: TDEventLogBase, log_base: int) -> None:
+        """
+        Extend the running state with the next event of the log
+        """
+        start = event.address - log_base
+        self.offset = start + event.length
+        if isinstance(event, TDEventLogEntry):
+            index = event.rtmr
+            for algoid, digest in zip(event.algorithm_ids, event.digests):
+                hash_function = self._hash_functions.get(algoid)
+                if hash_function is not None:
+                    bank = self.banks[algoid]
+                    bank[index] = hash_function(bank[index] + digest).digest()
+            self.event_count += 1
+        else:
+            self.specid_header = event
+            for algoid in event.digest_sizes:
+                self._add_bank(algoid)
+
+    def seal(self, data) -> None:
+        """
+        Remember the data replayed so far, once the replay is done with it
+        """
+        if self._sealed_offset != self.offset or self._sealed_digest is None:
+            self._sealed_offset = self.offset
+            self._sealed_digest = sha384(memoryview(data)[:self.offset]).digest()
+
+    def is_valid_for(self, data) -> bool:
+        """
+        Whether the data still holds the events replayed so far, byte for
+        byte
+        """
+        if len(data) < self.offset:
+            return False
+        if self._sealed_digest is None:
+            return self.offset == 0
+        return sha384(memoryview(data)[:self._sealed_offset]).digest() == self._sealed_digest
+
+    def get_rtmrs(self) -> Dict[int, RTMR]:
+        """
+        RTMR values replayed up to the checkpoint
+        """
+        return {index: RTMR(bytearray(value)) for index, value in self.rtmrs.items()}
+
+    def get_banks(self) -> Dict[int, Dict[int, bytes]]:
+        """
+        Replayed values of every RTMR index, by digest algorithm ID of the
+        spec ID header
+        """
+        return {algoid: dict(bank) for algoid, bank in self.banks.items()
+                if self.specid_header is None or algoid in self.specid_header.digest_sizes}
 
 
 # pylint: disable=too-few-public-methods
@@ -81,36 +248,60 @@ class TDEventLogActor:
     Event log actor
     """
 
-    def __init__(self, base, length):
+    def __init__(self, base, length, data=None, source=None):
         self._data = None
         self._log_base = base
+        # None to parse up to the end of the data
         self._log_length = length
+        # where to read the event log data from, the CCEL data in sysfs by
+        # default, or data given by the caller e.g. for offline verification
+        if data is not None:
+            source = BufferSource(data)
+        self._source = open_source(source, CCEL_EVENT_LOG)
         self._specid_header = None
         self._event_logs = []
         self._rtmrs = {}
+        self._checkpoint = None
+        self._index = None
 
-    def _read(self, ccel_file="/sys/firmware/acpi/tables/data/CCEL"):
-        assert os.path.exists(ccel_file), f"Could not find the CCEL file {ccel_file}"
-        try:
-            with open(ccel_file, "rb") as fobj:
-                self._data = fobj.read()
-                assert len(self._data) > 0
-                return self._data
-        except (PermissionError, OSError):
-            LOG.error("Need root permission to open file %s", ccel_file)
+    def _read(self):
+        data = self._source.read()
+        if data is None:
+            return None
+        if len(data) == 0:
+            LOG.error("The event log data is empty")
             return None
+        self._data = data
+        return self._data
 
-    @staticmethod
-    def _replay_single_rtmr(event_logs: List[TDEventLogEntry]) -> RTMR:
-        rtmr = bytearray(RTMR.RTMR_LENGTH_BY_BYTES)
+    @property
+    def data(self):
+        """
+        Raw event log data, read from the source on first use, None if it
+        could not be read
+        """
+        if self._data is None:
+            self._read()
+        return self._data
 
-        for event_log in event_logs:
-            digest = event_log.digests[0]
-            sha384_algo = sha384()
-            sha384_algo.update(rtmr + digest)
-            rtmr = sha384_algo.digest()
+    def digest(self) -> bytes:
+        """
+        SHA-384 digest of the event log data that is parsed, None if it
+        could not be read
+        """
+        if self._data is None and self._read() is None:
+            return None
+        data = memoryview(self._data)
+        if self._log_length is not None:
+            data = data[:self._log_length]
+        return sha384(data).digest()
 
-        return RTMR(rtmr)
+    @property
+    def checkpoint(self) -> ReplayCheckpoint:
+        """
+        Checkpoint of the last replay, None before any replay
+        """
+        return self._checkpoint
 
     def get_rtmr_by_index(self, index: int) -> RTMR:
         """
@@ -118,87 +309,146 @@ class TDEventLogActor:
         """
         return self._rtmrs[index]
 
-    def process(self) -> None:
+    def get_rtmr_banks(self) -> Dict[int, Dict[int, bytes]]:
         """
-        Factory process raw data and generate entries
+        Replayed values of every RTMR index for each digest algorithm of the
+        event log, by TCGAlgorithmRegistry ID. The log is replayed if it
+        has not been yet.
         """
-        if self._specid_header is not None:
-            return
+        if self._checkpoint is None:
+            self.replay()
+        return self._checkpoint.get_banks()
 
-        if self._read() is None:
+    def iter_events(self, start: int = 0,
+        specid_header: TDEventLogSpecIdHeader = None) -> Iterator[TDEventLogBase]:
+        """
+        Walk the event log once and yield the spec ID header and the event
+        log entries as they are parsed. Entries reference the raw data
+        instead of copying it, and the caller can stop at any point.
+
+        To resume a previous walk, pass the offset where it stopped and the
+        spec ID header it found.
+        """
+        if self._data is None and self._read() is None:
             return
 
-        index = 0
-        count = 0
-        blob = BinaryBlob(self._data, self._log_base)
+        data = memoryview(self._data)
+        blob = BinaryBlob(data, self._log_base, zero_copy=True)
+        end = blob.length if self._log_length is None else \
+            min(self._log_length, blob.length)
+        index = start
 
-        while index < self._log_length:
-            start = index
-            rtmr, index = blob.get_uint32(index)
-            etype, index = blob.get_uint32(index)
+        # Each entry starts with the register index and the event type
+        while index + 8 <= end:
+            rtmr, _ = blob.get_uint32(index)
+            etype, _ = blob.get_uint32(index + 4)
 
             if rtmr == 0xFFFFFFFF:
                 break
 
             if etype == TDEventLogType.EV_NO_ACTION:
-                self._specid_header = TDEventLogSpecIdHeader(
-                    self._log_base + start)
-                self._specid_header.parse(self._data[start:])
-                index = start + self._specid_header.length
+                specid_header = TDEventLogSpecIdHeader(self._log_base + index)
+                event = specid_header
+            else:
+                event = TDEventLogEntry(self._log_base + index, specid_header)
+            index += event.parse(data, index)
+            yield event
+
+    def process(self) -> None:
+        """
+        Factory process raw data and generate entries
+        """
+        if self._specid_header is not None:
+            return
+
+        for event in self.iter_events():
+            if isinstance(event, TDEventLogEntry):
+                self._event_logs.append(event)
             else:
-                event_log_obj = TDEventLogEntry(self._log_base + start,
-                    self._specid_header)
-                event_log_obj.parse(self._data[start:])
-                index = start + event_log_obj.length
-                self._event_logs.append(event_log_obj)
+                self._specid_header = event
+
+    def get_index(self) -> TDEventLogIndex:
+        """
+        Index of the event log entries by number, RTMR, type and digest.
+        It is built once on first use.
+        """
+        if self._index is None:
+            self.process()
+            self._index = TDEventLogIndex(self._event_logs, self._log_base)
+        return self._index
+
+    def export_columns(self, algorithm: int = TCGAlgorithmRegistry.TPM_ALG_SHA384):
+        """
+        Export the event log entries as NumPy columns, see TDEventLogColumns
+        """
+        # NumPy is only imported by the tools that export columns
+        # pylint: disable=import-outside-toplevel
+        from .columnar import TDEventLogColumns
+        if self._data is None and self._read() is None:
+            return None
+        return TDEventLogColumns.from_data(self._data, self._log_base,
+                                           self._log_length, algorithm)
 
-            count += 1
+    def _iter_processed(self) -> Iterator[TDEventLogBase]:
+        """
+        Events already processed, or a single streaming pass otherwise
+        """
+        if self._specid_header is None:
+            return self.iter_events()
+        return chain([self._specid_header], self._event_logs)
 
     def replay(self) -> Dict[int, RTMR]:
         """
         Replay event logs to generate RTMR value, which will be used during
         verification
         """
-        self.process()
-
-        # result dictionary for classifying event logs by rtmr index
-        # the key is a integer, which represents rtmr index
-        # the value is a list of event log entries whose rtmr index is equal to
-        # its related key
-        event_logs_by_index = {}
-        for index in range(RTMR.RTMR_COUNT):
-            event_logs_by_index[index] = []
+        # running hash of each rtmr index, extended entry by entry in log
+        # order, so the event logs do not need to be grouped or kept
+        checkpoint = ReplayCheckpoint()
+        for event in self._iter_processed():
+            checkpoint.update(event, self._log_base)
+
+        if self._data is not None:
+            checkpoint.seal(self._data)
+        self._checkpoint = checkpoint
+        self._rtmrs = checkpoint.get_rtmrs()
+        return self._rtmrs
+
+    def replay_incremental(self) -> Dict[int, RTMR]:
+        """
+        Read the event log again and extend the RTMR values of the last
+        replay with the events appended since then. If the log has been
+        truncated or rewritten, replay it from the start.
+        """
+        self._data = None
+        self._specid_header = None
+        self._event_logs = []
+        self._index = None
+        if self._read() is None:
+            return None
 
-        for event_log in self._event_logs:
-            event_logs_by_index[event_log.rtmr].append(event_log)
+        checkpoint = self._checkpoint
+        if checkpoint is None or not checkpoint.is_valid_for(self._data):
+            if checkpoint is not None:
+                LOG.info("Event log was truncated or rewritten, replay from start")
+            checkpoint = ReplayCheckpoint()
 
-        rtmr_by_index = {}
-        for rtmr_index, event_logs in event_logs_by_index.items():
-            rtmr_value = TDEventLogActor._replay_single_rtmr(event_logs)
-            rtmr_by_index[rtmr_index] = rtmr_value
+        for event in self.iter_events(checkpoint.offset, checkpoint.specid_header):
+            checkpoint.update(event, self._log_base)
 
-        self._rtmrs = rtmr_by_index
+        checkpoint.seal(self._data)
+        self._checkpoint = checkpoint
+        self._rtmrs = checkpoint.get_rtmrs()
+        return self._rtmrs
 
     def dump_td_event_logs(self) -> None:
         """
         Dump all TD event logs.
         """
-        self.process()
-
-        count, start = 0, 0
-
-        LOG.info("==== TDX Event Log Entry - %d [0x%X] ====",
-            count, self._log_base + start)
-        self._specid_header.dump()
-        count += 1
-        start += self._specid_header.length
-
-        for event_log in self._event_logs:
+        for count, event_log in enumerate(self._iter_processed()):
             LOG.info("==== TDX Event Log Entry - %d [0x%X] ====",
-            count, self._log_base + start)
+                count, event_log.address)
             event_log.dump()
-            count += 1
-            start += event_log.length
 
     def dump_rtmrs(self) -> None:
         """
@@ -0,0 +1,254 @@
+"""
+Offline batch verification of TD evidence.
+
+An evidence bundle is the event log and the TD report collected from one TD,
+optionally with its CCEL ACPI table. Bundles are read either from a directory,
+one sub-directory per TD:
+
+    <dir>/<td-id>/eventlog.bin   CCEL event log data
+    <dir>/<td-id>/tdreport.bin   TDREPORT_STRUCT
+    <dir>/<td-id>/ccel.bin       CCEL ACPI table (optional)
+
+or from a stream of JSON lines with the same content in base64:
+
+    {"id": "<td-id>", "eventlog": "...", "tdreport": "...", "ccel": "..."}
+
+or from a file of compressed evidence bundle records, see evidence.py. The
+records are decoded by the workers.
+
+The RTMR replay of each bundle is compared with the RTMR values in its TD
+report, and the bundles are spread over a pool of worker processes. The
+results can be cached, see actor.VerifyCache, so the identical event logs of
+TDs booted from the same image are not replayed again.
+"""
+
+import os
+import json
+import time
+import struct
+import base64
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List
+
+from .actor import TDEventLogActor, VerifyActor, VerifyCache
+from .ccel import CCEL
+from .evidence import EvidenceReader, decode_bundle
+from .rtmr import RTMR
+from .source import FileSource
+from .tdreport import TdInfo
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+EVENTLOG_FILE = "eventlog.bin"
+TDREPORT_FILE = "tdreport.bin"
+CCEL_FILE = "ccel.bin"
+
+# Offset and length of TDINFO_STRUCT in TDREPORT_STRUCT
+TDINFO_OFFSET = 0x200
+TDINFO_LENGTH = 0x200
+
+STATUS_PASS = "pass"
+STATUS_FAIL = "fail"
+STATUS_ERROR = "error"
+
+
+def _read_file(path):
+    with open(path, "rb") as fobj:
+        return fobj.read()
+
+
+def load_bundle_dir(path: str, with_tdreport: bool = True) -> Dict:
+    """
+    Load an evidence bundle from its directory. The event log is
+    memory-mapped and parsed in place. Without with_tdreport, the TD report
+    is not read, for the callers that only need the event log.
+    """
+    bundle = {"id": os.path.basename(os.path.normpath(path))}
+    bundle["eventlog"] = FileSource(os.path.join(path, EVENTLOG_FILE)).read()
+    if bundle["eventlog"] is None:
+        raise OSError(f"Could not read the event log of {path}")
+    bundle["tdreport"] = _read_file(os.path.join(path, TDREPORT_FILE)) \
+        if with_tdreport else None
+    ccel_file = os.path.join(path, CCEL_FILE)
+    bundle["ccel"] = _read_file(ccel_file) if os.path.exists(ccel_file) else None
+    return bundle
+
+
+def iter_bundle_dirs(directory: str) -> Iterator[str]:
+    """
+    Yield the bundle directories under the given directory, by name
+    """
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.exists(os.path.join(path, EVENTLOG_FILE)):
+            yield path
+
+
+def iter_bundle_stream(stream) -> Iterator[Dict]:
+    """
+    Yield the evidence bundles from a stream of JSON lines
+    """
+    for count, line in enumerate(stream):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        bundle = {"id": record.get("id", str(count))}
+        for key in ("eventlog", "tdreport", "ccel"):
+            value = record.get(key)
+            bundle[key] = base64.b64decode(value) if value is not None else None
+        yield bundle
+
+
+def iter_evidence_file(stream) -> Iterator[bytes]:
+    """
+    Yield the undecoded evidence bundle records of a binary stream
+    """
+    yield from EvidenceReader(stream).iter_records()
+
+
+def verify_bundle(bundle, cache: VerifyCache = None) -> Dict:
+    """
+    Replay the event log of a bundle and compare it with the RTMR values of
+    its TD report. The bundle is either loaded already, the path of its
+    directory or an evidence bundle record. With a VerifyCache, the event
+    log is not replayed again if it was verified before against the same
+    RTMR values. Return one result record.
+    """
+    result = {"id": None, "status": STATUS_ERROR, "events": 0, "rtmrs": []}
+    try:
+        if isinstance(bundle, str):
+            result["id"] = os.path.basename(os.path.normpath(bundle))
+            bundle = load_bundle_dir(bundle)
+        elif isinstance(bundle, (bytes, bytearray)):
+            bundle = decode_bundle(bundle).to_dict()
+        result["id"] = bundle["id"]
+
+        log_base = 0
+        log_length = len(bundle["eventlog"])
+        if bundle.get("ccel") is not None:
+            ccelobj = CCEL(bundle["ccel"])
+            if not ccelobj.is_valid():
+                raise ValueError("Invalid CCEL table")
+            log_base = ccelobj.log_area_start_address
+            log_length = ccelobj.log_area_minimum_length
+
+        if bundle.get("tdreport") is None:
+            raise ValueError("No TD report")
+        if len(bundle["tdreport"]) < TDINFO_OFFSET + TDINFO_LENGTH:
+            raise ValueError("TD report is too short")
+        td_info = TdInfo(
+            bundle["tdreport"][TDINFO_OFFSET:TDINFO_OFFSET + TDINFO_LENGTH], None)
+        expected = [bytes(getattr(td_info, f"rtmr_{index}")) for index in range(RTMR.RTMR_COUNT)]
+
+        actor = TDEventLogActor(log_base, log_length, bundle["eventlog"])
+        verified = VerifyActor(cache).verify_event_log(actor, expected)
+        result["status"] = STATUS_PASS if verified.pop("passed") else STATUS_FAIL
+        result.update(verified)
+    except (AssertionError, ImportError, KeyError, OSError, ValueError, struct.error) as err:
+        result["error"] = f"{type(err).__name__}: {err}"
+    return result
+
+
+def iter_chunks(items: Iterable, chunksize: int) -> Iterator[List]:
+    """
+    Yield lists of at most chunksize items, to be sent to a worker at once
+    """
+    chunksize = max(1, chunksize)
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# VerifyCache.config -> cache of a worker process, kept across chunks
+_WORKER_CACHES = {}
+
+
+def _verify_chunk(bundles: List, cache_config: tuple = None) -> List[Dict]:
+    cache = None
+    if cache_config is not None:
+        cache = _WORKER_CACHES.get(cache_config)
+        if cache is None:
+            cache = _WORKER_CACHES[cache_config] = VerifyCache(*cache_config)
+    return [verify_bundle(bundle, cache) for bundle in bundles]
+
+
+class BatchVerifyActor:
+    """
+    Actor to verify many evidence bundles over a pool of worker processes.
+
+    Bundles are sent to the workers in chunks, and only a bounded number of
+    chunks is in flight, so a long stream is never loaded at once. Results
+    are yielded in the order of the input.
+
+    With a VerifyCache, each worker keeps a cache of the same configuration
+    across chunks, and shares its on-disk layer with the other workers, so
+    the duplicated event logs of TDs booted from the same image are only
+    replayed once per worker, or not at all if found on disk.
+    """
+
+    def __init__(self, workers: int = None, chunksize: int = 16, cache: VerifyCache = None):
+        self._workers = workers or os.cpu_count() or 1
+        self._chunksize = max(1, chunksize)
+        self._cache_config = cache.config if cache is not None else None
+        self.stats = {}
+
+    def verify(self, bundles: Iterable) -> Iterator[Dict]:
+        """
+        Verify the bundles, either loaded, paths of bundle directories or
+        evidence bundle records, and yield one result per TD. The
+        throughput is kept in stats.
+        """
+        self.stats = {"bundles": 0, "passed": 0, "failed": 0, "errors": 0,
+                      "cached": 0, "events": 0, "seconds": 0.0}
+        started = time.monotonic()
+        pending = deque()
+        max_pending = self._workers * 2
+
+        with ProcessPoolExecutor(max_workers=self._workers) as executor:
+            for chunk in iter_chunks(bundles, self._chunksize):
+                pending.append(executor.submit(_verify_chunk, chunk, self._cache_config))
+                if len(pending) >= max_pending:
+                    yield from self._collect(pending.popleft().result())
+            while pending:
+                yield from self._collect(pending.popleft().result())
+
+        self.stats["seconds"] = time.monotonic() - started
+        self.dump_stats()
+
+    def _collect(self, results: List[Dict]) -> Iterator[Dict]:
+        for result in results:
+            self.stats["bundles"] += 1
+            self.stats["events"] += result["events"]
+            if result.get("cached"):
+                self.stats["cached"] += 1
+            if result["status"] == STATUS_PASS:
+                self.stats["passed"] += 1
+            elif result["status"] == STATUS_FAIL:
+                self.stats["failed"] += 1
+            else:
+                self.stats["errors"] += 1
+            yield result
+
+    def dump_stats(self) -> None:
+        """
+        Dump the counters and the throughput of the last verification
+        """
+        seconds = max(self.stats.get("seconds", 0.0), 1e-9)
+        LOG.info("Verified %d TDs: %d passed, %d failed, %d errors",
+                 self.stats["bundles"], self.stats["passed"],
+                 self.stats["failed"], self.stats["errors"])
+        if self._cache_config is not None:
+            LOG.info("Cached results: %d", self.stats["cached"])
+        LOG.info("Throughput: %.1f TDs/s, %.1f events/s in %.3f s",
+                 self.stats["bundles"] / seconds, self.stats["events"] / seconds,
+                 seconds)
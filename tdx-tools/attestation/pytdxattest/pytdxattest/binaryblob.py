@@ -2,22 +2,56 @@
 Manage the binary blob
 """
 import logging
-import string
 import struct
 
 LOG = logging.getLogger(__name__)
 
 __author__ = "cpio"
 
+# Precompiled little-endian readers shared by all blobs, so the format string
+# is not parsed again on every access.
+UINT16 = struct.Struct("<H")
+UINT32 = struct.Struct("<L")
+UINT64 = struct.Struct("<Q")
+
+# Tables of the hexdump: the hex column of each byte value, and the printable
+# ASCII characters, with every other byte shown as a dot
+HEXDUMP_WIDTH = 16
+HEX_COLUMNS = [f"{value:02X} " for value in range(256)]
+PRINTABLE_TABLE = bytes(value if 0x20 <= value < 0x7F else ord(".") for value in range(256))
+
+
+def hexdump_lines(data, base_address=0):
+    """
+    Yield the lines of the hexdump of data: the address, the hex value of
+    16 bytes and their printable characters
+    """
+    view = memoryview(data).cast("B") if not isinstance(data, bytes) else data
+    for index in range(0, len(view), HEXDUMP_WIDTH):
+        chunk = bytes(view[index:index + HEXDUMP_WIDTH])
+        yield "%08X  %s %s" % (  # pylint: disable=consider-using-f-string
+            base_address + index,
+            "".join(map(HEX_COLUMNS.__getitem__, chunk)).ljust(HEXDUMP_WIDTH * 3),
+            chunk.translate(PRINTABLE_TABLE).decode("ascii"))
+
 
 class BinaryBlob:
     """
     Manage the binary blob.
+
+    With zero_copy=True, the blob is kept as a memoryview over the original
+    buffer and get_bytes returns views instead of copies. The caller must keep
+    the buffer alive and unchanged while the views are in use.
     """
 
-    def __init__(self, data, base=0):
+    __slots__ = ("_data", "_base_address", "_zero_copy")
+
+    def __init__(self, data, base=0, zero_copy=False):
+        if zero_copy and not isinstance(data, memoryview):
+            data = memoryview(data)
         self._data = data
         self._base_address = base
+        self._zero_copy = zero_copy
 
     @property
     def length(self):
@@ -33,81 +67,154 @@ class BinaryBlob:
         """
         return self._data
 
+    @property
+    def zero_copy(self):
+        """
+        Whether get_bytes returns memoryview slices instead of copies
+        """
+        return self._zero_copy
+
     def to_hex_string(self):
         """
         To hex string
         """
-        return "".join(f"{b:02x}" % b for b in self._data)
+        return bytes(self._data).hex()
 
     def get_uint16(self, pos):
         """
         Get UINT16 integer
         """
         assert pos + 2 <= self.length
-        return (struct.unpack("<H", self.data[pos:pos + 2])[0], pos + 2)
+        return (UINT16.unpack_from(self._data, pos)[0], pos + 2)
 
     def get_uint8(self, pos):
         """
         Get UINT8 integer
         """
         assert pos + 1 <= self.length
-        return (self.data[pos], pos + 1)
+        return (self._data[pos], pos + 1)
 
     def get_uint32(self, pos):
         """
         Get UINT32 integer
         """
         assert pos + 4 <= self.length
-        return (struct.unpack("<L", self.data[pos:pos + 4])[0], pos + 4)
+        return (UINT32.unpack_from(self._data, pos)[0], pos + 4)
 
     def get_uint64(self, pos):
         """
         Get UINT64 integer
         """
         assert pos + 8 <= self.length
-        return (struct.unpack("<Q", self.data[pos:pos + 8])[0], pos + 8)
+        return (UINT64.unpack_from(self._data, pos)[0], pos + 8)
 
     def get_bytes(self, pos, count):
         """
-        Get bytes
+        Get bytes, a memoryview slice in zero-copy mode
         """
         if count == 0:
             return None
         assert pos + count <= self.length
-        return (self.data[pos:pos + count], pos + count)
+        return (self._data[pos:pos + count], pos + count)
+
+    def get_view(self, pos, count):
+        """
+        Get a memoryview slice without copying, whatever the blob mode is
+        """
+        assert pos + count <= self.length
+        if self._zero_copy:
+            return (self._data[pos:pos + count], pos + count)
+        return (memoryview(self._data)[pos:pos + count], pos + count)
 
     def dump(self):
         """
         Dump Hex value
         """
-        index = 0
-        linestr = ""
-        printstr = ""
-
-        while index < self.length:
-            if (index % 16) == 0:
-                if len(linestr) != 0:
-                    LOG.info("%s %s", linestr, printstr)
-                    printstr = ''
-                # line prefix string
-                # pylint: disable=consider-using-f-string
-                linestr = "{0:08X}  ".format(int(index / 16) * 16 + \
-                    self._base_address)
-
-            # pylint: disable=consider-using-f-string
-            linestr += "{0:02X} ".format(self._data[index])
-            if chr(self._data[index]) in set(string.printable) and \
-               self._data[index] not in [0xC, 0xB, 0xA, 0xD, 0x9]:
-                printstr += chr(self._data[index])
-            else:
-                printstr += '.'
-
-            index += 1
-
-        if (index % 16) != 0:
-            blank = ""
-            for _ in range(16 - index % 16):
-                blank = blank + "   "
-            LOG.info("%s%s %s", linestr, blank, printstr)
-        elif index == self.length:
-            LOG.info("%s %s", linestr, printstr)
+        for line in hexdump_lines(self._data[:self.length], self._base_address):
+            LOG.info(line)
+
+
+class StructField:
+    """
+    Descriptor of a StructView field, looked up in the layout of the instance
+    """
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        # pylint: disable=protected-access
+        field = obj._layout.get(self.name)
+        if field is None:
+            return None
+        offset, length = field
+        return obj._view[offset:offset + length]
+
+
+class StructView:
+    """
+    Read-only view of a fixed layout structure over a buffer.
+
+    Subclasses describe the structure with LAYOUTS, a table of
+    {name: (offset, length)} per version, and the None key is used when the
+    version is unknown. A field is a memoryview slice of the buffer, taken
+    when the field is accessed. A field defined in another version of the
+    layout reads as None.
+    """
+
+    __slots__ = ("_view", "_layout")
+
+    LAYOUTS = {None: {}}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for layout in cls.LAYOUTS.values():
+            for name in layout:
+                if not isinstance(cls.__dict__.get(name), StructField):
+                    setattr(cls, name, StructField(name))
+
+    def __init__(self, data, version=None):
+        self._view = data if isinstance(data, memoryview) else memoryview(data)
+        self._layout = self.LAYOUTS.get(version) or self.LAYOUTS[None]
+
+    def __getattr__(self, name):
+        # Fields are class descriptors, this is only reached for unknown names
+        raise AttributeError(f"{type(self).__name__} has no field {name}")
+
+    @property
+    def data(self):
+        """
+        Raw data of the structure
+        """
+        return self._view
+
+    @property
+    def length(self):
+        """
+        Length of the structure in bytes
+        """
+        return len(self._view)
+
+    @property
+    def fields(self):
+        """
+        Names of the fields in the layout of this structure
+        """
+        return list(self._layout.keys())
+
+    @staticmethod
+    def build_layout(*fields):
+        """
+        Build a layout table from (name, length) tuples of consecutive fields,
+        the first one at offset 0
+        """
+        layout = {}
+        offset = 0
+        for name, length in fields:
+            layout[name] = (offset, length)
+            offset += length
+        return layout
@@ -0,0 +1,186 @@
+"""
+Generic caches used to avoid repeating expensive attestation operations: an
+in-process LRU cache and an on-disk cache, both with an optional TTL, and the
+LRU cache in front of the on-disk one.
+"""
+
+import os
+import time
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    In-process cache of at most maxsize entries, evicting the least recently
+    used one first. Entries older than ttl seconds are dropped when read.
+    It is safe to share across threads.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, clock=time.monotonic):
+        self._maxsize = max(1, maxsize)
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Get the value of the key, or None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored, value = entry
+            if self._ttl is not None and self._clock() - stored > self._ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, age=0.0):
+        """
+        Store the value of the key, stored age seconds ago for its TTL, e.g.
+        when it comes from another cache
+        """
+        with self._lock:
+            self._entries[key] = (self._clock() - age, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """
+        Remove the key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all the entries
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache:
+    """
+    On-disk cache with one file per key in a directory, so that it survives
+    the process and can be shared by processes. Each file holds the time it
+    was stored and the value in bytes, and is replaced atomically.
+    """
+
+    TIMESTAMP = struct.Struct("<d")
+
+    def __init__(self, directory, ttl=None):
+        self._directory = directory
+        self._ttl = ttl
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha256(key).hexdigest())
+
+    def get(self, key: bytes):
+        """
+        Get the value of the key, or None if missing or expired
+        """
+        return self.get_with_age(key)[0]
+
+    def get_with_age(self, key: bytes):
+        """
+        Get the value of the key and the seconds since it was stored, or
+        (None, None) if missing or expired
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fobj:
+                data = fobj.read()
+        except OSError:
+            return None, None
+
+        if len(data) < self.TIMESTAMP.size:
+            self.pop(key)
+            return None, None
+        stored, = self.TIMESTAMP.unpack_from(data)
+        age = max(0.0, time.time() - stored)
+        if self._ttl is not None and age > self._ttl:
+            self.pop(key)
+            return None, None
+        return data[self.TIMESTAMP.size:], age
+
+    def put(self, key: bytes, value: bytes):
+        """
+        Store the value of the key
+        """
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory)
+            with os.fdopen(fd, "wb") as fobj:
+                fobj.write(self.TIMESTAMP.pack(time.time()))
+                fobj.write(value)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            LOG.error("Fail to write cache entry in %s", self._directory)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def pop(self, key: bytes):
+        """
+        Remove the key
+        """
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class TieredCache:
+    """
+    In-process LRUCache in front of an optional DiskCache, for bytes values.
+    An entry found on disk only is brought back in memory with the age it
+    has on disk, so it still expires when its TTL from the first store ends.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, directory=None):
+        self._memory = LRUCache(maxsize, ttl)
+        self._disk = DiskCache(directory, ttl) if directory is not None else None
+
+    def get(self, key: bytes):
+        """
+        Get the value of the key, or None if missing or expired
+        """
+        value = self._memory.get(key)
+        if value is None and self._disk is not None:
+            value, age = self._disk.get_with_age(key)
+            if value is not None:
+                self._memory.put(key, value, age)
+        return value
+
+    def put(self, key: bytes, value: bytes):
+        """
+        Store the value of the key
+        """
+        self._memory.put(key, value)
+        if self._disk is not None:
+            self._disk.put(key, value)
+
+    def pop(self, key: bytes):
+        """
+        Remove the key
+        """
+        self._memory.pop(key)
+        if self._disk is not None:
+            self._disk.pop(key)
@@ -4,10 +4,10 @@ see https://software.intel.com/content/dam/develop/external/us/en/documents/inte
 
 """
 
-import os
 import logging
 
 from .binaryblob import BinaryBlob
+from .source import CCEL_ACPI_TABLE, open_source
 
 __author__ = "cpio"
 
@@ -105,20 +105,21 @@ class CCEL(BinaryBlob):
             self.length == self.data[4]
 
     @staticmethod
-    def create_from_acpi_file(acpi_file="/sys/firmware/acpi/tables/CCEL"):
+    def create_from_acpi_file(acpi_file=CCEL_ACPI_TABLE):
         """
-        Read the CCEL table from the /sys/firmware/acpi/tables/CCEL
+        Read the CCEL table from the /sys/firmware/acpi/tables/CCEL, or from
+        a file captured from it
         """
-        if not os.path.exists(acpi_file):
-            LOG.error("Could not find the ACPI file %s", acpi_file)
-            return None
+        return CCEL.create_from_source(open_source(acpi_file, CCEL_ACPI_TABLE))
 
-        try:
-            with open(acpi_file, "rb") as fobj:
-                data = fobj.read()
-                assert len(data) > 0 and data[0:4] == b'CCEL', \
-                    "Invalid CCEL table"
-                return CCEL(data)
-        except (PermissionError, OSError):
-            LOG.error("Need root permission to open file %s", acpi_file)
+    @staticmethod
+    def create_from_source(source):
+        """
+        Read the CCEL table from a DataSource, see source.open_source for
+        the supported locations
+        """
+        data = open_source(source, CCEL_ACPI_TABLE).read()
+        if data is None:
             return None
+        assert len(data) > 0 and data[0:4] == b'CCEL', "Invalid CCEL table"
+        return CCEL(data)
@@ -2,28 +2,42 @@
 Dump command line
 """
 
+import os
+import sys
+import json
 import base64
 from abc import abstractmethod
+from contextlib import ExitStack, contextmanager
 import logging
 import logging.config
-from .actor import VerifyActor, TDEventLogActor
-from .tdreport import TdReport
-from .tdquote import TdQuote
-from .rtmr import RTMR
-from .ccel import CCEL
+from .output import RecordWriter, FORMAT_TEXT
+
+# The modules a command needs are imported when it runs, so that a tool only
+# pays for the imports of its own command, see main.py.
+# pylint: disable=import-outside-toplevel
 
 __author__ = "cpio"
 
 LOG = logging.getLogger(__name__)
 
 
+def configure_logging(level=logging.DEBUG):
+    """
+    Configure the log of the tools, which is their text output, once per
+    process
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(level=level, format='%(message)s')
+
+
 class TDXMeasurementCmdBase:
     """
     Base class for TDX measurements commands.
     """
 
     def __init__(self):
-        logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+        configure_logging()
 
     @abstractmethod
     def run(self, *args):
@@ -32,6 +46,18 @@ class TDXMeasurementCmdBase:
         """
         raise NotImplementedError
 
+    @staticmethod
+    def open_writer(output_format):
+        """
+        Writer of the records to stdout in a machine-readable format, None
+        for the text output through the log
+        """
+        if output_format in (None, FORMAT_TEXT):
+            return None
+        # the records are the output, the log only reports errors
+        logging.getLogger().setLevel(logging.WARNING)
+        return RecordWriter(output_format)
+
 
 class TDXEventLogsCmd(TDXMeasurementCmdBase):
     """
@@ -40,17 +66,30 @@ class TDXEventLogsCmd(TDXMeasurementCmdBase):
 
     def run(self, *args):
         """
-        Run cmd
+        Run cmd. The CCEL table and the event log are read from sysfs, or
+        from the given captured files ("-" for the event log on stdin).
         """
+        from .actor import TDEventLogActor
+        from .ccel import CCEL
+        from .source import CCEL_EVENT_LOG, open_source
+
+        ccel_file, eventlog_file, output_format = args if args else (None, None, FORMAT_TEXT)
+        writer = self.open_writer(output_format)
 
         LOG.info("=> Read CCEL ACPI Table")
-        ccelobj = CCEL.create_from_acpi_file()
+        ccelobj = CCEL.create_from_source(ccel_file)
         if ccelobj is None:
             return
-        ccelobj.dump()
 
         actor = TDEventLogActor(ccelobj.log_area_start_address,
-            ccelobj.log_area_minimum_length)
+            ccelobj.log_area_minimum_length,
+            source=open_source(eventlog_file, CCEL_EVENT_LOG))
+        if writer is not None:
+            with writer:
+                self._write_records(writer, ccelobj, actor)
+            return
+
+        ccelobj.dump()
 
         LOG.info("")
         LOG.info("=> Read Event Log Data - Address: 0x%X(0x%X)",
@@ -62,6 +101,24 @@ class TDXEventLogsCmd(TDXMeasurementCmdBase):
         LOG.info("=> Replay Rolling Hash - RTMR")
         actor.dump_rtmrs()
 
+    @staticmethod
+    def _write_records(writer, ccelobj, actor):
+        """
+        Write the CCEL table, each event and the RTMR values of each digest
+        bank, replayed while the events are streamed
+        """
+        from .actor import ReplayCheckpoint
+        from .output import ccel_record, event_record, rtmr_record
+
+        writer.write(ccel_record(ccelobj))
+        checkpoint = ReplayCheckpoint()
+        for number, event in enumerate(actor.iter_events()):
+            checkpoint.update(event, ccelobj.log_area_start_address)
+            writer.write(event_record(number, event))
+        for algorithm, bank in checkpoint.get_banks().items():
+            for index, value in bank.items():
+                writer.write(rtmr_record(index, algorithm, value))
+
 
 class TDXVerifyCmd(TDXMeasurementCmdBase):
     """
@@ -72,8 +129,190 @@ class TDXVerifyCmd(TDXMeasurementCmdBase):
         """
         Run cmd
         """
+        from .actor import VerifyActor, VerifyCache
+
+        cache_dir, = args
+        cache = VerifyCache(directory=cache_dir) if cache_dir is not None else None
+
         LOG.info("=> Verify RTMR")
-        VerifyActor().verify_rtmr()
+        VerifyActor(cache).verify_rtmr()
+
+
+class TDXBatchVerifyCmd(TDXMeasurementCmdBase):
+    """
+    Cmd executor for offline RTMR verification of collected evidence bundles
+    """
+
+    def run(self, *args):
+        """
+        Run cmd
+        """
+        from .actor import VerifyCache
+        from .batch import BatchVerifyActor
+
+        directory, stream, evidence, workers, chunksize, cache_size, cache_dir, output = args
+        cache = VerifyCache(cache_size, directory=cache_dir) if cache_size > 0 else None
+
+        LOG.info("=> Batch Verify RTMR")
+        with ExitStack() as stack:
+            # the evidence records are decoded by the workers
+            bundles = _open_bundles(stack, directory, stream, evidence, load=False)
+
+            output_file = sys.stdout if output is None else \
+                stack.enter_context(open(output, "w", encoding="utf-8"))
+
+            actor = BatchVerifyActor(workers, chunksize, cache)
+            for result in actor.verify(bundles):
+                output_file.write(json.dumps(result) + "\n")
+
+
+class TDXQuoteVerifyCmd(TDXMeasurementCmdBase):
+    """
+    Cmd executor for offline signature verification of TD quotes
+    """
+
+    def run(self, *args):
+        """
+        Run cmd
+        """
+        from .quoteverify import QuoteVerifier
+
+        quote_files, root_file, workers, output = args
+
+        LOG.info("=> Verify TD Quote")
+        verifier = QuoteVerifier.from_root_file(root_file)
+        with ExitStack() as stack:
+            output_file = sys.stdout if output is None else \
+                stack.enter_context(open(output, "w", encoding="utf-8"))
+
+            if len(quote_files) == 1:
+                with open(quote_files[0], "rb") as quote_file:
+                    results = [verifier.verify(quote_file.read())]
+            else:
+                results = verifier.verify_batch(
+                    (_read_file(path) for path in quote_files), workers)
+            for path, result in zip(quote_files, results):
+                result["id"] = path
+                output_file.write(json.dumps(result) + "\n")
+
+
+class TDXEventLogDiffCmd(TDXMeasurementCmdBase):
+    """
+    Cmd executor to diff an event log against a reference one
+    """
+
+    def run(self, *args):
+        """
+        Run cmd
+        """
+        from .actor import TDEventLogActor
+        from .eventlogdiff import diff_event_logs
+        from .source import open_source
+
+        reference_file, actual_file, algorithm, output = args
+
+        LOG.info("=> Diff Event Logs")
+        reference = TDEventLogActor(0, None, source=open_source(reference_file))
+        actual = TDEventLogActor(0, None, source=open_source(actual_file))
+        result = diff_event_logs(reference, actual, algorithm)
+        result.dump()
+
+        if output is None:
+            sys.stdout.write(json.dumps(result.to_dict()) + "\n")
+        else:
+            with open(output, "w", encoding="utf-8") as output_file:
+                json.dump(result.to_dict(), output_file)
+
+
+class TDXAppraiseCmd(TDXMeasurementCmdBase):
+    """
+    Cmd executor to appraise event logs against a reference measurement store
+    """
+
+    def run(self, *args):
+        """
+        Run cmd
+        """
+        from .batch import iter_bundle_dirs
+        from .refstore import ReferenceStore
+
+        store_file, manifests, directory, stream, evidence, workers, output = args
+
+        LOG.info("=> Appraise Event Logs")
+        with ExitStack() as stack:
+            store = stack.enter_context(ReferenceStore(store_file))
+            for manifest in manifests or []:
+                store.load_manifest(manifest)
+            if directory is None and stream is None and evidence is None:
+                for manifest in store.manifests():
+                    LOG.info("%s %s: %d measurements", manifest["name"],
+                             manifest["version"], manifest["measurements"])
+                return
+
+            if directory is not None:
+                # loaded by appraise_log, which reports an unreadable bundle
+                logs = iter_bundle_dirs(directory)
+            else:
+                # a bundle without event log is reported by appraise_log
+                logs = ({"id": bundle.get("id"), "eventlog": _to_bytes(bundle.get("eventlog"))}
+                        for bundle in _open_bundles(stack, directory, stream, evidence))
+
+            output_file = sys.stdout if output is None else \
+                stack.enter_context(open(output, "w", encoding="utf-8"))
+            for result in store.appraise_batch(logs, workers=workers or 1):
+                output_file.write(json.dumps(result) + "\n")
+
+
+def _to_bytes(data):
+    return bytes(data) if data is not None else None
+
+
+def _read_file(path):
+    with open(path, "rb") as fobj:
+        return fobj.read()
+
+
+@contextmanager
+def _open_append_atomic(path):
+    """
+    Binary file to append whole records to the file of the path, which is
+    truncated back to its previous size if an error is raised
+    """
+    # unbuffered, so that each record is appended by a single write
+    with open(path, "ab", buffering=0) as append_file:
+        start = append_file.seek(0, os.SEEK_END)
+        try:
+            yield append_file
+            os.fsync(append_file.fileno())
+        except BaseException:
+            append_file.truncate(start)
+            raise
+
+
+def _open_bundles(stack, directory, stream, evidence, load=True):
+    """
+    Iterate the evidence bundles of a directory, a JSON lines file or an
+    evidence file, "-" for stdin. Without load, the bundle directories and
+    the evidence records are yielded as they are, for verify_bundle.
+    """
+    from .batch import iter_bundle_dirs, iter_bundle_stream, iter_evidence_file, load_bundle_dir
+    from .evidence import decode_bundle
+
+    if directory is not None:
+        if not load:
+            return iter_bundle_dirs(directory)
+        return (load_bundle_dir(path) for path in iter_bundle_dirs(directory))
+    if evidence is not None:
+        if evidence == "-":
+            evidence_file = sys.stdin.buffer
+        else:
+            evidence_file = stack.enter_context(open(evidence, "rb")) # pylint: disable=consider-using-with
+        if not load:
+            return iter_evidence_file(evidence_file)
+        return (decode_bundle(record).to_dict() for record in iter_evidence_file(evidence_file))
+    if stream == "-":
+        return iter_bundle_stream(sys.stdin)
+    return iter_bundle_stream(stack.enter_context(open(stream, "r", encoding="utf-8")))
 
 
 class TDXTDReportCmd(TDXMeasurementCmdBase):
@@ -85,9 +324,19 @@ class TDXTDReportCmd(TDXMeasurementCmdBase):
         """
         Run cmd
         """
+        from .output import tdreport_record
+        from .tdreport import TdReport
+
+        output_format, = args if args else (FORMAT_TEXT,)
+        writer = self.open_writer(output_format)
 
         LOG.info("=> Dump TD Report")
-        TdReport.get_td_report().dump()
+        tdreport = TdReport.get_td_report()
+        if writer is not None:
+            with writer:
+                writer.write(tdreport_record(tdreport))
+            return
+        tdreport.dump()
 
 class TDXQuoteCmd(TDXMeasurementCmdBase):
     """
@@ -98,36 +347,110 @@ class TDXQuoteCmd(TDXMeasurementCmdBase):
         """
         Run cmd
         """
+        from .output import tdquote_record
+        from .tdquote import TdQuote, QuoteCache
 
-        LOG.info("=> Dump TD Quote")
+        output, nonce, user_data, quiet, cache_dir, output_format = args
+        writer = self.open_writer(output_format) if not quiet else None
 
-        output, nonce, user_data, quiet = args
+        LOG.info("=> Dump TD Quote")
         if nonce is not None:
             nonce = base64.b64decode(nonce)
         if user_data is not None:
             user_data = base64.b64decode(user_data)
 
-        tdquote = TdQuote.get_quote(nonce, user_data)
+        cache = QuoteCache(directory=cache_dir) if cache_dir is not None else None
+        tdquote = TdQuote.get_quote(nonce, user_data, cache=cache)
         if tdquote is not None:
-            if not quiet:
+            if writer is not None:
+                with writer:
+                    writer.write(tdquote_record(tdquote))
+            elif not quiet:
                 tdquote.dump()
             if output is not None:
                 with open(output, "wb") as output_file:
                     output_file.write(tdquote.data)
 
+class TDXEvidenceCmd(TDXMeasurementCmdBase):
+    """
+    Cmd executor to collect, pack or list compressed evidence bundles
+    """
+
+    def run(self, *args):
+        """
+        Run cmd
+        """
+        from .evidence import COMPRESSIONS, SECTION_KEYS, EvidenceReader, EvidenceWriter, \
+            collect_evidence
+        from .tdquote import TdQuote
+
+        (output, listed, bundle_id, nonce, user_data, no_quote, compression,
+         directory, stream, evidence) = args
+
+        if listed is not None:
+            LOG.info("=> List Evidence Bundles")
+            with open(listed, "rb") as evidence_file:
+                for record in EvidenceReader(evidence_file).scan():
+                    LOG.info("%s: %d bytes at offset %d, %d bytes of %s", record["id"],
+                             record["length"], record["offset"], record["body_length"],
+                             ", ".join(SECTION_KEYS.get(stype, str(stype))
+                                       for stype in record["sections"]))
+            return
+
+        with ExitStack() as stack:
+            output_file = sys.stdout.buffer if output == "-" else \
+                stack.enter_context(_open_append_atomic(output))
+            writer = stack.enter_context(
+                EvidenceWriter(output_file, COMPRESSIONS[compression] if compression else None))
+            if directory is None and stream is None and evidence is None:
+                LOG.info("=> Collect Evidence Bundle")
+                if nonce is not None:
+                    nonce = base64.b64decode(nonce)
+                if user_data is not None:
+                    user_data = base64.b64decode(user_data)
+                writer.write(collect_evidence(
+                    bundle_id, TdQuote.calc_report_data(nonce, user_data), not no_quote))
+            else:
+                LOG.info("=> Pack Evidence Bundles")
+                self._pack(writer, _open_bundles(stack, directory, stream, evidence, load=False))
+            LOG.info("Wrote %d evidence bundles, %d bytes", writer.count, writer.length)
+
+    @staticmethod
+    def _pack(writer, bundles):
+        from .batch import load_bundle_dir
+        from .evidence import decode_bundle
+
+        skipped = 0
+        for bundle in bundles:
+            try:
+                if isinstance(bundle, str):
+                    bundle = load_bundle_dir(bundle)
+                elif isinstance(bundle, (bytes, bytearray)):
+                    bundle = decode_bundle(bundle)
+            except (ImportError, OSError, ValueError) as err:
+                LOG.error("Skip the evidence bundle: %s: %s", type(err).__name__, err)
+                skipped += 1
+                continue
+            writer.write(bundle)
+        if skipped > 0:
+            LOG.error("Skipped %d evidence bundles", skipped)
+
+
 class TDXRTMRExtendCmd():
     """
     Cmd executor to extend RTMR register
     """
 
     def __init__(self):
-        logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+        configure_logging()
 
     @staticmethod
     def run(extend_raw_data, extend_str_data, extend_digest_data, extend_rtmr_index):
         """
         Run cmd
         """
+        from .rtmr import RTMR
+        from .tdreport import TdReport
 
         LOG.info("=> Extend RTMR")
         res = RTMR.extend_rtmr(extend_raw_data, extend_str_data,
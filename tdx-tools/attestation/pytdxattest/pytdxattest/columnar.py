@@ -0,0 +1,256 @@
+"""
+Columnar export of TD event logs for bulk analytics.
+
+The entries are decoded straight into fixed-width NumPy arrays, without one
+TDEventLogEntry object per entry:
+
+    rtmr            int8      RTMR index of each entry
+    etype           uint32    event type, see TDEventLogType
+    offset          uint64    offset of the entry in the event log data
+    length          uint32    length of the entry
+    digest          uint8     (N, 48) SHA-384 digests, zero if not present
+    event_offsets   uint64    (N + 1) offsets of each event payload in event_data
+    event_data      uint8     event payloads back to back
+
+The columns are saved to a .npz file, or to a directory of .npy files that
+can be memory-mapped when loaded again. NumPy is an optional dependency,
+only needed by this module.
+"""
+
+import os
+import struct
+import logging
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .binaryblob import UINT16, UINT32
+from .tdeventlog import TDEventLogType, TDEventLogSpecIdHeader, TCGAlgorithmRegistry
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+SHA384_DIGEST_LENGTH = 48
+
+# Register index and event type at the start of each entry
+ENTRY_START = struct.Struct("<LL")
+
+# Spec ID header up to its number of algorithms: register index, event type,
+# SHA1 digest, event size, signature, platform class, versions and UINTN size
+SPECID_HEADER_START = 56
+SPECID_SIGNATURE = b"Spec ID Event03\0"
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for the columnar export, "
+                          "please install pytdxattest[columnar]")
+
+
+def _read_digests(view, start, end, digest_sizes, algorithm):
+    """
+    Read the digests of the entry at start, return the offset after them
+    and the digest of the algorithm, None if the entry has none
+    """
+    if start + 12 > end:
+        raise ValueError("Truncated event log entry")
+    digest_count = UINT32.unpack_from(view, start + 8)[0]
+    index = start + 12
+    digest = None
+    for _ in range(digest_count):
+        if index + 2 > end:
+            raise ValueError("Truncated event log entry")
+        algoid = UINT16.unpack_from(view, index)[0]
+        size = digest_sizes.get(algoid)
+        if size is None:
+            raise ValueError(f"Unknown digest algorithm 0x{algoid:X} in the event "
+                             f"log entry at 0x{start:X}")
+        if index + 2 + size > end:
+            raise ValueError("Truncated event log entry")
+        if algoid == algorithm:
+            digest = view[index + 2:index + 2 + size]
+        index += 2 + size
+    return index, digest
+
+
+def _parse_specid_header(view, start, end, log_base):
+    """
+    Parse the spec ID header at start once its bounds are checked, raise
+    ValueError if it is truncated or not a spec ID header
+    """
+    if start + SPECID_HEADER_START + 4 > end:
+        raise ValueError("Truncated spec ID header")
+    signature = bytes(view[start + 32:start + 32 + len(SPECID_SIGNATURE)])
+    if signature != SPECID_SIGNATURE:
+        raise ValueError(f"Unknown spec ID header {signature!r} at 0x{start:X}")
+    count = UINT32.unpack_from(view, start + SPECID_HEADER_START)[0]
+    vendor_offset = start + SPECID_HEADER_START + 4 + 4 * count
+    if vendor_offset + 1 > end or vendor_offset + 1 + view[vendor_offset] > end:
+        raise ValueError("Truncated spec ID header")
+    specid_header = TDEventLogSpecIdHeader(log_base + start)
+    return start + specid_header.parse(view, start), specid_header.digest_sizes
+
+
+class TDEventLogColumns:
+    """
+    Event log entries as NumPy columns
+    """
+
+    FIELDS = ("rtmr", "etype", "offset", "length", "digest",
+              "event_offsets", "event_data")
+
+    def __init__(self, *, rtmr, etype, offset, length, digest, event_offsets, event_data):
+        _require_numpy()
+        self.rtmr = rtmr
+        self.etype = etype
+        self.offset = offset
+        self.length = length
+        self.digest = digest
+        self.event_offsets = event_offsets
+        self.event_data = event_data
+
+    def __len__(self):
+        return len(self.rtmr)
+
+    def get_event(self, number: int):
+        """
+        Event payload of an entry by its number
+        """
+        start, end = self.event_offsets[number], self.event_offsets[number + 1]
+        return self.event_data[start:end]
+
+    def count_digests(self, etype: int = None):
+        """
+        Distinct digests and how often they occur, most common first. Only
+        the entries of the given event type are counted if it is set.
+        """
+        digests = self.digest if etype is None else self.digest[self.etype == etype]
+        if len(digests) == 0:
+            return digests, np.zeros(0, dtype=np.int64)
+        unique, counts = np.unique(digests, axis=0, return_counts=True)
+        order = np.argsort(counts, kind="stable")[::-1]
+        return unique[order], counts[order]
+
+    @staticmethod
+    def from_data(data, log_base: int = 0, log_length: int = None,
+                  algorithm: int = TCGAlgorithmRegistry.TPM_ALG_SHA384):
+        """
+        Walk the event log data once and build the columns. The digest column
+        takes the digests of the given algorithm. Raise ValueError on a
+        malformed or truncated entry.
+        """
+        _require_numpy()
+        view = memoryview(data)
+        end = len(view) if log_length is None else min(log_length, len(view))
+
+        rtmrs = array("b")
+        etypes = array("I")
+        offsets = array("Q")
+        lengths = array("I")
+        event_offsets = array("Q", [0])
+        digests = bytearray()
+        event_data = bytearray()
+        missing_digest = bytes(SHA384_DIGEST_LENGTH)
+        digest_sizes = {}
+        digest_length = None
+
+        index = 0
+        while index + 8 <= end:
+            start = index
+            register, etype = ENTRY_START.unpack_from(view, index)
+            if register == 0xFFFFFFFF:
+                break
+
+            if etype == TDEventLogType.EV_NO_ACTION:
+                index, digest_sizes = _parse_specid_header(view, start, end, log_base)
+                missing_digest = bytes(digest_sizes.get(algorithm, SHA384_DIGEST_LENGTH))
+                continue
+
+            if not digest_sizes:
+                raise ValueError(f"Event log entry at 0x{start:X} before the spec ID header")
+            index, digest = _read_digests(view, index, end, digest_sizes, algorithm)
+            if digest is None:
+                digest = missing_digest
+            if digests and len(digest) != digest_length:
+                raise ValueError(f"Digest of {len(digest)} bytes in the event log entry at "
+                                 f"0x{start:X}, after digests of {digest_length} bytes")
+            digest_length = len(digest)
+            if index + 4 > end:
+                raise ValueError("Truncated event log entry")
+            event_size = UINT32.unpack_from(view, index)[0]
+            index += 4
+            if index + event_size > end:
+                raise ValueError("Truncated event log entry")
+
+            rtmrs.append(register - 1)
+            etypes.append(etype)
+            offsets.append(start)
+            lengths.append(index + event_size - start)
+            digests += digest
+            event_data += view[index:index + event_size]
+            event_offsets.append(len(event_data))
+            index += event_size
+
+        if not digests:
+            digest_length = len(missing_digest)
+        return TDEventLogColumns(
+            rtmr=np.frombuffer(rtmrs, dtype=np.int8),
+            etype=np.frombuffer(etypes, dtype=np.uint32),
+            offset=np.frombuffer(offsets, dtype=np.uint64),
+            length=np.frombuffer(lengths, dtype=np.uint32),
+            digest=np.frombuffer(digests, dtype=np.uint8).reshape(-1, digest_length),
+            event_offsets=np.frombuffer(event_offsets, dtype=np.uint64),
+            event_data=np.frombuffer(event_data, dtype=np.uint8))
+
+    @staticmethod
+    def concatenate(columns_list):
+        """
+        Merge the columns of several event logs, e.g. from a whole fleet
+        """
+        _require_numpy()
+        merged = {}
+        for field in ("rtmr", "etype", "offset", "length", "digest", "event_data"):
+            merged[field] = np.concatenate([getattr(c, field) for c in columns_list])
+        # rebase the payload offsets of each log after the previous payloads
+        event_offsets, base = [np.zeros(1, dtype=np.uint64)], 0
+        for columns in columns_list:
+            event_offsets.append(columns.event_offsets[1:] + np.uint64(base))
+            base += len(columns.event_data)
+        merged["event_offsets"] = np.concatenate(event_offsets)
+        return TDEventLogColumns(**merged)
+
+    def save_npz(self, path: str, compressed: bool = False) -> None:
+        """
+        Save all columns into one .npz file
+        """
+        save = np.savez_compressed if compressed else np.savez
+        save(path, **{field: getattr(self, field) for field in self.FIELDS})
+
+    def save_npy(self, directory: str) -> None:
+        """
+        Save each column as a .npy file in the directory, to be loaded
+        memory-mapped
+        """
+        os.makedirs(directory, exist_ok=True)
+        for field in self.FIELDS:
+            np.save(os.path.join(directory, field + ".npy"), getattr(self, field))
+
+    @staticmethod
+    def load(path: str, mmap: bool = True):
+        """
+        Load columns saved by save_npz or save_npy. The columns in a .npy
+        directory are memory-mapped read only unless mmap is False.
+        """
+        _require_numpy()
+        if os.path.isdir(path):
+            mmap_mode = "r" if mmap else None
+            return TDEventLogColumns(**{
+                field: np.load(os.path.join(path, field + ".npy"), mmap_mode=mmap_mode)
+                for field in TDEventLogColumns.FIELDS})
+        with np.load(path) as npz:
+            return TDEventLogColumns(**{field: npz[field]
+                                        for field in TDEventLogColumns.FIELDS})
@@ -0,0 +1,123 @@
+"""
+Pluggable backend of the TDX guest device and firmware files.
+
+All the accesses to the TDX guest device node and to the CCEL ACPI files go
+through the device backend of the process: whether the paths exist, open,
+ioctl and close on the device node, and reading the sysfs files. By default
+it is the host, i.e. the real device in a TD guest. The software emulator
+in emulator.py implements the same ioctls, so the actors and the command
+line tools run unchanged without a TD, e.g. to benchmark them in CI.
+
+The backend is selected by the PYTDXATTEST_DEVICE environment variable,
+"host" or "emulator", or set with set_device_backend().
+"""
+
+import os
+import fcntl
+import logging
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+DEVICE_BACKEND_ENV = "PYTDXATTEST_DEVICE"
+DEVICE_BACKEND_HOST = "host"
+DEVICE_BACKEND_EMULATOR = "emulator"
+
+
+class DeviceBackend:
+    """
+    Interface of a device backend, with the semantics of the os and fcntl
+    functions of the same names. Failures raise OSError.
+    """
+
+    def exists(self, path) -> bool:
+        """
+        Whether the device node or the file exists
+        """
+        raise NotImplementedError
+
+    def open(self, path, flags=os.O_RDWR) -> int:
+        """
+        Open the device node, return its file descriptor
+        """
+        raise NotImplementedError
+
+    def ioctl(self, fd, request, arg):
+        """
+        Perform the ioctl request on the device node. A mutable buffer
+        argument is updated in place.
+        """
+        raise NotImplementedError
+
+    def close(self, fd):
+        """
+        Close the device node
+        """
+        raise NotImplementedError
+
+    def read_file(self, path) -> bytes:
+        """
+        Read a whole file, such as a sysfs ACPI table
+        """
+        raise NotImplementedError
+
+
+class HostDeviceBackend(DeviceBackend):
+    """
+    The device node and the files of the host
+    """
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def open(self, path, flags=os.O_RDWR):
+        return os.open(path, flags)
+
+    def ioctl(self, fd, request, arg):
+        return fcntl.ioctl(fd, request, arg)
+
+    def close(self, fd):
+        os.close(fd)
+
+    def read_file(self, path):
+        with open(path, "rb") as fobj:
+            return fobj.read()
+
+
+# Backend of the process, created on first use
+_DEVICE_BACKEND = None
+
+
+def _create_device_backend():
+    name = os.environ.get(DEVICE_BACKEND_ENV, DEVICE_BACKEND_HOST)
+    if name == DEVICE_BACKEND_EMULATOR:
+        # pylint: disable=import-outside-toplevel, cyclic-import
+        from .emulator import TdxEmulator
+        LOG.info("Using the TDX guest device emulator")
+        return TdxEmulator.from_environment()
+    if name != DEVICE_BACKEND_HOST:
+        LOG.error("Unknown device backend %s, using the host device", name)
+    return HostDeviceBackend()
+
+
+def get_device_backend() -> DeviceBackend:
+    """
+    Get the device backend of the process
+    """
+    global _DEVICE_BACKEND # pylint: disable=global-statement
+    if _DEVICE_BACKEND is None:
+        _DEVICE_BACKEND = _create_device_backend()
+    return _DEVICE_BACKEND
+
+
+def set_device_backend(backend: DeviceBackend) -> None:
+    """
+    Set the device backend of the process, None to select it from the
+    environment again. The device node is probed again on next use.
+    """
+    global _DEVICE_BACKEND # pylint: disable=global-statement
+    _DEVICE_BACKEND = backend
+    # pylint: disable=import-outside-toplevel, cyclic-import
+    from .utility import DeviceNode
+    DeviceNode.reset_probe()
@@ -0,0 +1,272 @@
+"""
+Software emulator of a TDX guest, to run and benchmark the tool without a TD.
+
+TdxEmulator is a device backend, see device.py, that emulates:
+
+    * the TDX guest device node of TDX 1.0 (/dev/tdx-guest) or TDX 1.5
+      (/dev/tdx_guest), with the GET_REPORT, GET_QUOTE (1.0 only) and
+      EXTEND_RTMR ioctls on the same request structures as the kernel
+    * the CCEL ACPI table and a synthetic event log of a configurable
+      number of events, under the sysfs paths of the real ones
+
+The RTMR values start as the replay of the event log, so TD reports verify
+against it, and change with the extends. The state lives in the process
+only. The measurements are derived from a seed, so every process emulating
+with the same settings sees the same TD.
+
+The quotes of the emulated TDX 1.0 device are unsigned, see
+qgs.build_unsigned_quote. TDX 1.5 devices get quotes from QGS, which can be
+a LocalQgsServer.
+
+Settings from the environment, when selected with PYTDXATTEST_DEVICE:
+
+    PYTDXATTEST_EMULATOR_VERSION    TDX version, "1.0" (default) or "1.5"
+    PYTDXATTEST_EMULATOR_EVENTS     number of events in the event log
+    PYTDXATTEST_EMULATOR_EVENT_SIZE size of each event payload in bytes
+"""
+
+import os
+import ctypes
+import errno
+import hashlib
+import logging
+import struct
+import threading
+
+from .device import DeviceBackend
+from .rtmr import RTMR, RTMRExtender
+from .source import CCEL_ACPI_TABLE, CCEL_EVENT_LOG
+from .tdeventlog import TDEventLogType, TCGAlgorithmRegistry
+from .qgs import build_unsigned_quote, qgs_msg_quote_req_report, qgs_msg_quote_resp_create
+from .utility import DEVICE_NODE_NAME_1_0, DEVICE_NODE_NAME_1_5, \
+    TDX_CMD_GET_REPORT_V1_0, TDX_CMD_GET_QUOTE_V1_0, TDX_CMD_GET_REPORT0_V1_5, \
+    TDX_VERSION_1_0, TDX_VERSION_1_5, TCB_INFO_VALID_VAL_1_0, TCB_INFO_VALID_VAL_1_5, \
+    TDX_REPORTDATA_LEN, TDX_REPORT_LEN
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+EMULATOR_VERSION_ENV = "PYTDXATTEST_EMULATOR_VERSION"
+EMULATOR_EVENTS_ENV = "PYTDXATTEST_EMULATOR_EVENTS"
+EMULATOR_EVENT_SIZE_ENV = "PYTDXATTEST_EMULATOR_EVENT_SIZE"
+
+DEVICE_NODE_BY_VERSION = {
+    TDX_VERSION_1_0: DEVICE_NODE_NAME_1_0,
+    TDX_VERSION_1_5: DEVICE_NODE_NAME_1_5
+}
+
+# Event types of the synthetic event log, in turn, with the RTMR they go to
+EMULATED_EVENTS = (
+    (0, TDEventLogType.EV_EFI_PLATFORM_FIRMWARE_BLOB),
+    (0, TDEventLogType.EV_EFI_VARIABLE_DRIVER_CONFIG),
+    (0, TDEventLogType.EV_SEPARATOR),
+    (1, TDEventLogType.EV_EFI_BOOT_SERVICES_APPLICATION),
+    (1, TDEventLogType.EV_EFI_ACTION),
+    (2, TDEventLogType.EV_IPL),
+)
+
+# Log area of the CCEL table
+EMULATED_LOG_AREA_START = 0x7F000000
+EMULATED_LOG_AREA_MIN_LENGTH = 0x10000
+
+# struct tdx_quote_hdr before the data: version, status, in_len, out_len
+QUOTE_HDR = struct.Struct("QQII")
+
+
+def build_event_log(events, event_size=64, algorithms=(TCGAlgorithmRegistry.TPM_ALG_SHA384,)):
+    """
+    Build a synthetic crypto agile event log of the given number of events,
+    with one digest per algorithm ID and payloads of event_size bytes.
+    Return the log and its replay, the RTMR values of the SHA384 bank.
+    """
+    hash_functions = [(algoid, TCGAlgorithmRegistry.get_hash_function(algoid))
+                      for algoid in algorithms]
+    spec_id = b"Spec ID Event03\0" + struct.pack("<IBBBB", 0, 0, 2, 0, 2) + \
+        struct.pack("<I", len(hash_functions)) + \
+        b"".join(struct.pack("<HH", algoid, hash_function().digest_size)
+                 for algoid, hash_function in hash_functions) + b"\0"
+    log = bytearray(struct.pack("<II", 0, TDEventLogType.EV_NO_ACTION) + bytes(20) +
+                    struct.pack("<I", len(spec_id)) + spec_id)
+
+    rtmrs = [bytes(RTMR.RTMR_LENGTH_BY_BYTES)] * RTMR.RTMR_COUNT
+    header = struct.Struct("<III")
+    for number in range(events):
+        index, etype = EMULATED_EVENTS[number % len(EMULATED_EVENTS)]
+        payload = (b"event %d " % number).ljust(event_size, b".")
+        log += header.pack(index + 1, etype, len(hash_functions))
+        for algoid, hash_function in hash_functions:
+            digest = hash_function(payload).digest()
+            log += struct.pack("<H", algoid) + digest
+            if algoid == TCGAlgorithmRegistry.TPM_ALG_SHA384:
+                rtmrs[index] = hashlib.sha384(rtmrs[index] + digest).digest()
+        log += struct.pack("<I", len(payload)) + payload
+
+    # the rest of the log area is erased flash
+    log += b"\xff" * max(EMULATED_LOG_AREA_MIN_LENGTH - len(log), 64)
+    return bytes(log), tuple(rtmrs)
+
+
+class TdxEmulator(DeviceBackend):
+    """
+    Device backend emulating a TDX guest, see the module documentation
+    """
+
+    FIRST_FD = 1000
+
+    def __init__(self, version=TDX_VERSION_1_0, events=64, event_size=64, seed=b"pytdxattest"):
+        if version not in DEVICE_NODE_BY_VERSION:
+            raise ValueError(f"Unsupported TDX version {version}")
+        self.version = version
+        self.device_node = DEVICE_NODE_BY_VERSION[version]
+        self._seed = bytes(seed)
+        self._lock = threading.Lock()
+        self._fds = set()
+        self._next_fd = self.FIRST_FD
+
+        self.event_log, self._initial_rtmrs = build_event_log(events, event_size)
+        self.ccel_table = self._build_ccel_table(len(self.event_log))
+        self.rtmrs = list(self._initial_rtmrs)
+        self.counters = {"reports": 0, "quotes": 0, "extends": 0}
+
+    @staticmethod
+    def from_environment():
+        """
+        Create the emulator with the settings in the environment
+        """
+        return TdxEmulator(
+            version=os.environ.get(EMULATOR_VERSION_ENV, TDX_VERSION_1_0),
+            events=int(os.environ.get(EMULATOR_EVENTS_ENV, "64")),
+            event_size=int(os.environ.get(EMULATOR_EVENT_SIZE_ENV, "64")))
+
+    def _measurement(self, name):
+        return hashlib.sha384(self._seed + b"/" + name).digest()
+
+    @staticmethod
+    def _build_ccel_table(log_length):
+        table = bytearray(struct.pack("<4sIBB6s8sI4sI", b"CCEL", 56, 1, 0, b"INTEL ",
+                                      b"EMULATED", 1, b"PTDX", 1))
+        table += struct.pack("<BBHQQ", 2, 0, 0, log_length, EMULATED_LOG_AREA_START)
+        table[9] = (-sum(table)) & 0xFF
+        return bytes(table)
+
+    def reset(self):
+        """
+        Bring the RTMR values back to the replay of the event log
+        """
+        with self._lock:
+            self.rtmrs = list(self._initial_rtmrs)
+
+    def build_report(self, report_data=b"") -> bytes:
+        """
+        Build the TDREPORT_STRUCT of the emulated TD for the report data
+        """
+        is_1_5 = self.version == TDX_VERSION_1_5
+        tee_tcb_info = bytearray(0xef)
+        tee_tcb_info[0x0:0x8] = TCB_INFO_VALID_VAL_1_5 if is_1_5 else TCB_INFO_VALID_VAL_1_0
+        # tee_tcb_svn of module 1.3 for TDX 1.5, 0.3 for TDX 1.0
+        tee_tcb_info[0x8:0xa] = b"\x03\x01" if is_1_5 else b"\x03\x00"
+        tee_tcb_info[0x18:0x48] = self._measurement(b"mrseam")
+        tee_tcb_info[0x48:0x78] = self._measurement(b"mrsignerseam")
+
+        td_info = bytearray(0x200)
+        td_info[0x8:0x10] = struct.pack("<Q", 0xE7)
+        td_info[0x10:0x40] = self._measurement(b"mrtd")
+        with self._lock:
+            td_info[0xd0:0x190] = b"".join(self.rtmrs)
+        if is_1_5:
+            td_info[0x190:0x1c0] = self._measurement(b"servtd")
+
+        report_mac = bytearray(0x100)
+        report_mac[0x0:0x4] = bytes([0x81, 0, 1 if is_1_5 else 0, 0])
+        report_mac[0x20:0x50] = hashlib.sha384(tee_tcb_info).digest()
+        report_mac[0x50:0x80] = hashlib.sha384(td_info).digest()
+        report_mac[0x80:0xc0] = bytes(report_data)[:TDX_REPORTDATA_LEN].ljust(
+            TDX_REPORTDATA_LEN, b"\0")
+        report_mac[0xe0:0x100] = hashlib.sha256(self._seed + bytes(report_mac[:0xe0])).digest()
+
+        report = bytes(report_mac) + bytes(tee_tcb_info) + bytes(0x11) + bytes(td_info)
+        assert len(report) == TDX_REPORT_LEN
+        return report
+
+    def extend(self, digest, index):
+        """
+        Extend a digest into an RTMR, only RTMR 2 and 3 can be extended
+        """
+        if not 2 <= index < RTMR.RTMR_COUNT or len(digest) != RTMR.RTMR_LENGTH_BY_BYTES:
+            raise OSError(errno.EINVAL, "Invalid RTMR extend request")
+        with self._lock:
+            self.rtmrs[index] = hashlib.sha384(self.rtmrs[index] + bytes(digest)).digest()
+
+    def _get_report_v1_0(self, arg):
+        _, reportdata_addr, reportdata_len, tdreport_addr, tdreport_len = \
+            struct.unpack("BQLQL", arg)
+        report = self.build_report(ctypes.string_at(reportdata_addr, reportdata_len))
+        ctypes.memmove(tdreport_addr, report, min(tdreport_len, len(report)))
+
+    def _get_report0_v1_5(self, arg):
+        if not isinstance(arg, bytearray):
+            raise OSError(errno.EFAULT, "Request buffer is not writable")
+        arg[TDX_REPORTDATA_LEN:] = self.build_report(bytes(arg[:TDX_REPORTDATA_LEN]))
+
+    def _get_quote_v1_0(self, arg):
+        buf_addr, buf_len = struct.unpack("QQ", arg)
+        buf = (ctypes.c_char * buf_len).from_address(buf_addr)
+        version, _, in_len, _ = QUOTE_HDR.unpack_from(buf)
+        msg_start = QUOTE_HDR.size + 4
+        msg = bytes(buf[msg_start:QUOTE_HDR.size + in_len])
+        resp = qgs_msg_quote_resp_create(build_unsigned_quote(qgs_msg_quote_req_report(msg)))
+        out = QUOTE_HDR.pack(version, 0, in_len, len(resp) + 4) + \
+            len(resp).to_bytes(4, "big") + resp
+        if len(out) > buf_len:
+            raise OSError(errno.ENOSPC, "Quote buffer is too small")
+        ctypes.memmove(buf_addr, out, len(out))
+
+    def _extend_rtmr(self, arg):
+        digest, index = RTMRExtender.EXTEND_RTMR_REQ.unpack(bytes(arg))
+        self.extend(digest, index)
+
+    def exists(self, path):
+        return path in (self.device_node, RTMR.TDX_ATTEST_FILE,
+                        CCEL_ACPI_TABLE, CCEL_EVENT_LOG)
+
+    def open(self, path, flags=os.O_RDWR):
+        if path not in (self.device_node, RTMR.TDX_ATTEST_FILE):
+            raise OSError(errno.ENOENT, "No such emulated device", path)
+        with self._lock:
+            fd = self._next_fd
+            self._next_fd += 1
+            self._fds.add(fd)
+        return fd
+
+    def ioctl(self, fd, request, arg):
+        if fd not in self._fds:
+            raise OSError(errno.EBADF, "Bad emulated file descriptor")
+        if request == RTMRExtender.TDX_CMD_EXTEND_RTMR:
+            self._extend_rtmr(arg)
+            self.counters["extends"] += 1
+        elif request == TDX_CMD_GET_REPORT_V1_0 and self.version == TDX_VERSION_1_0:
+            self._get_report_v1_0(arg)
+            self.counters["reports"] += 1
+        elif request == TDX_CMD_GET_QUOTE_V1_0 and self.version == TDX_VERSION_1_0:
+            self._get_quote_v1_0(arg)
+            self.counters["quotes"] += 1
+        elif request == TDX_CMD_GET_REPORT0_V1_5 and self.version == TDX_VERSION_1_5:
+            self._get_report0_v1_5(arg)
+            self.counters["reports"] += 1
+        else:
+            raise OSError(errno.ENOTTY, "Unsupported emulated ioctl")
+        return 0
+
+    def close(self, fd):
+        with self._lock:
+            if fd not in self._fds:
+                raise OSError(errno.EBADF, "Bad emulated file descriptor")
+            self._fds.discard(fd)
+
+    def read_file(self, path):
+        if path == CCEL_ACPI_TABLE:
+            return self.ccel_table
+        if path == CCEL_EVENT_LOG:
+            return self.event_log
+        raise OSError(errno.ENOENT, "No such emulated file", path)
@@ -0,0 +1,468 @@
+"""
+Typed views of the event data of the common TD event log entries.
+
+The event data of an entry is opaque bytes. decode_event() wraps it in the
+view of its event type, without parsing anything: the payload is decoded
+the first time one of its fields is read, then the fields are kept. With
+TDEventLogEntry.decoded memoizing the view per entry, a policy filtering a
+log on a few decoded fields only decodes the entries it reads.
+
+    EV_EFI_VARIABLE_DRIVER_CONFIG,      EfiVariableData, UEFI_VARIABLE_DATA
+    EV_EFI_VARIABLE_AUTHORITY
+    EV_EFI_VARIABLE_BOOT,               EfiBootVariableData, with BootOrder
+    EV_EFI_VARIABLE_BOOT2               and the Boot#### load options
+    EV_EFI_GPT_EVENT                    EfiGptData, UEFI_GPT_DATA
+    EV_EFI_BOOT_SERVICES_APPLICATION,   EfiImageLoadEvent,
+    EV_EFI_BOOT_SERVICES_DRIVER,        UEFI_IMAGE_LOAD_EVENT with its
+    EV_EFI_RUNTIME_SERVICES_DRIVER      device path as text
+    EV_EFI_PLATFORM_FIRMWARE_BLOB       EfiPlatformFirmwareBlob
+    EV_EFI_PLATFORM_FIRMWARE_BLOB2      EfiPlatformFirmwareBlob2
+    EV_IPL, EV_EFI_ACTION, EV_ACTION    EventString, e.g. the grub commands
+                                        and kernel command line
+
+The structures are defined in the TCG PC Client Platform Firmware Profile
+and the UEFI specifications. A field of a payload that does not match its
+structure raises ValueError when it is read.
+"""
+
+import re
+import uuid
+import struct
+from typing import Dict, List
+
+from .binaryblob import UINT16, UINT32, UINT64
+from .tdeventlog import TDEventLogType
+
+__author__ = "cpio"
+
+# UEFI_VARIABLE_DATA: VariableName, UnicodeNameLength, VariableDataLength
+EFI_VARIABLE_HEADER = struct.Struct("<16sQQ")
+# UEFI_IMAGE_LOAD_EVENT: ImageLocationInMemory, ImageLengthInMemory,
+# ImageLinkTimeAddress, LengthOfDevicePath
+EFI_IMAGE_LOAD_HEADER = struct.Struct("<4Q")
+# UEFI_PLATFORM_FIRMWARE_BLOB: BlobBase, BlobLength
+EFI_PLATFORM_FIRMWARE_BLOB = struct.Struct("<2Q")
+# EFI_PARTITION_TABLE_HEADER, 92 bytes
+EFI_PARTITION_TABLE_HEADER = struct.Struct("<8sIIII4Q16sQIII")
+# EFI_PARTITION_ENTRY without its name
+EFI_PARTITION_ENTRY = struct.Struct("<16s16s3Q")
+EFI_PARTITION_NAME_LENGTH = 72
+# EFI_DEVICE_PATH_PROTOCOL node header: Type, SubType, Length
+DEVICE_PATH_NODE = struct.Struct("<BBH")
+
+DEVICE_PATH_TYPE_HARDWARE = 0x01
+DEVICE_PATH_TYPE_ACPI = 0x02
+DEVICE_PATH_TYPE_MESSAGING = 0x03
+DEVICE_PATH_TYPE_MEDIA = 0x04
+DEVICE_PATH_TYPE_END = 0x7F
+DEVICE_PATH_SUBTYPE_END_INSTANCE = 0x01
+DEVICE_PATH_SUBTYPE_END_ENTIRE = 0xFF
+DEVICE_PATH_SUBTYPE_FILE_PATH = 0x04
+
+# compressed EISA ID of "PNP" in the low 16 bits of an ACPI _HID
+EISA_PNP_ID = 0x41D0
+
+BOOT_OPTION_NAME = re.compile(r"^Boot[0-9A-Fa-f]{4}$")
+
+
+def format_guid(data) -> str:
+    """
+    EFI_GUID in its registry format, from its mixed-endian bytes
+    """
+    return str(uuid.UUID(bytes_le=bytes(data))).upper()
+
+
+def _utf16(data) -> str:
+    return bytes(data).decode("utf-16-le").split("\x00", 1)[0]
+
+
+def _acpi_node(data) -> str:
+    hid, uid = struct.unpack_from("<II", data)
+    if hid == EISA_PNP_ID | 0x0A03 << 16:
+        return f"PciRoot(0x{uid:X})"
+    if hid == EISA_PNP_ID | 0x0A08 << 16:
+        return f"PcieRoot(0x{uid:X})"
+    if hid & 0xFFFF == EISA_PNP_ID:
+        return f"Acpi(PNP{hid >> 16:04X},0x{uid:X})"
+    return f"Acpi(0x{hid:08X},0x{uid:X})"
+
+
+def _hard_drive_node(data) -> str:
+    number, start, size, signature, mbr_type, signature_type = \
+        struct.unpack_from("<IQQ16sBB", data)
+    if signature_type == 0x02:
+        return f"HD({number},GPT,{format_guid(signature)},0x{start:X},0x{size:X})"
+    if signature_type == 0x01:
+        mbr_signature, = UINT32.unpack_from(signature)
+        return f"HD({number},MBR,0x{mbr_signature:08X},0x{start:X},0x{size:X})"
+    return f"HD({number},{mbr_type},0,0x{start:X},0x{size:X})"
+
+
+def _hex_node(name, layout):
+    fields = struct.Struct(layout)
+    return lambda data: \
+        f"{name}({','.join(f'0x{value:X}' for value in fields.unpack_from(data))})"
+
+
+def _guid_node(name):
+    return lambda data: f"{name}({format_guid(data[:16])})"
+
+
+# (type, subtype) -> text of the node data, after EDK2 DevicePathToText
+DEVICE_PATH_NODES = {
+    (DEVICE_PATH_TYPE_HARDWARE, 0x01):
+        lambda data: f"Pci(0x{data[1]:X},0x{data[0]:X})",
+    (DEVICE_PATH_TYPE_HARDWARE, 0x03): _hex_node("MemoryMapped", "<IQQ"),
+    (DEVICE_PATH_TYPE_HARDWARE, 0x04): _guid_node("VenHw"),
+    (DEVICE_PATH_TYPE_ACPI, 0x01): _acpi_node,
+    (DEVICE_PATH_TYPE_MESSAGING, 0x02): _hex_node("Scsi", "<HH"),
+    (DEVICE_PATH_TYPE_MESSAGING, 0x05): _hex_node("USB", "<BB"),
+    (DEVICE_PATH_TYPE_MESSAGING, 0x0A): _guid_node("VenMsg"),
+    (DEVICE_PATH_TYPE_MESSAGING, 0x12): _hex_node("Sata", "<3H"),
+    (DEVICE_PATH_TYPE_MESSAGING, 0x17):
+        lambda data: f"NVMe(0x{UINT32.unpack_from(data)[0]:X}," +
+                     "-".join(f"{value:02X}" for value in bytes(data[4:12])) + ")",
+    (DEVICE_PATH_TYPE_MEDIA, 0x01): _hard_drive_node,
+    (DEVICE_PATH_TYPE_MEDIA, 0x03): _guid_node("VenMedia"),
+    (DEVICE_PATH_TYPE_MEDIA, DEVICE_PATH_SUBTYPE_FILE_PATH): _utf16,
+    (DEVICE_PATH_TYPE_MEDIA, 0x06): _guid_node("FvFile"),
+    (DEVICE_PATH_TYPE_MEDIA, 0x07): _guid_node("Fv"),
+    (DEVICE_PATH_TYPE_MEDIA, 0x08): _hex_node("Offset", "<QQ"),
+}
+
+
+def parse_device_path(data) -> List[tuple]:
+    """
+    Nodes of an EFI device path as (type, subtype, data), up to its end
+    node. The instances of a multi-instance path are separated by an
+    (END, END_INSTANCE) node.
+    """
+    view = memoryview(data).cast("B")
+    nodes = []
+    offset = 0
+    while offset + DEVICE_PATH_NODE.size <= len(view):
+        node_type, subtype, length = DEVICE_PATH_NODE.unpack_from(view, offset)
+        if length < DEVICE_PATH_NODE.size or offset + length > len(view):
+            raise ValueError(f"Invalid device path node length {length} at {offset}")
+        if node_type == DEVICE_PATH_TYPE_END and subtype == DEVICE_PATH_SUBTYPE_END_ENTIRE:
+            break
+        nodes.append((node_type, subtype, view[offset + DEVICE_PATH_NODE.size:offset + length]))
+        offset += length
+    return nodes
+
+
+def device_path_to_text(data) -> str:
+    """
+    Text of an EFI device path, e.g.
+    PciRoot(0x0)/Pci(0x3,0x0)/HD(1,GPT,<guid>,0x800,0x32000)/\\EFI\\BOOT\\BOOTX64.EFI
+    with the nodes without a text form as Path(type,subtype,hex data)
+    """
+    instances = [[]]
+    for node_type, subtype, node_data in parse_device_path(data):
+        if node_type == DEVICE_PATH_TYPE_END:
+            instances.append([])
+            continue
+        node_text = DEVICE_PATH_NODES.get((node_type, subtype))
+        instances[-1].append(
+            node_text(node_data) if node_text is not None else
+            f"Path({node_type},{subtype},{bytes(node_data).hex().upper()})")
+    return ",".join("/".join(nodes) for nodes in instances)
+
+
+def _file_path(data) -> str:
+    # last file path node of a device path, the path of the image in its file system
+    paths = [_utf16(node_data) for node_type, subtype, node_data in parse_device_path(data)
+             if (node_type, subtype) == (DEVICE_PATH_TYPE_MEDIA, DEVICE_PATH_SUBTYPE_FILE_PATH)]
+    return paths[-1] if paths else None
+
+
+class PayloadField:
+    """
+    Descriptor of a decoded field of an EventPayload
+    """
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.get(self.name)
+
+
+class EventPayload:
+    """
+    Typed view of the event data of an entry.
+
+    Subclasses list their FIELDS and decode them all at once in _decode(),
+    called on the first access to a field.
+    """
+
+    __slots__ = ("_data", "_fields")
+
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls.FIELDS:
+            if not isinstance(cls.__dict__.get(name), PayloadField):
+                setattr(cls, name, PayloadField(name))
+
+    def __init__(self, data):
+        self._data = data
+        self._fields = None
+
+    @property
+    def data(self):
+        """
+        Raw event data
+        """
+        return self._data
+
+    @property
+    def is_decoded(self) -> bool:
+        """
+        Whether the fields were decoded already
+        """
+        return self._fields is not None
+
+    def get(self, name):
+        """
+        Value of a decoded field
+        """
+        if self._fields is None:
+            try:
+                self._fields = self._decode(memoryview(self._data).cast("B"))
+            except (struct.error, IndexError, UnicodeDecodeError, ValueError) as err:
+                raise ValueError(f"Malformed {type(self).__name__}: {err}") from err
+        return self._fields[name]
+
+    def to_dict(self) -> Dict:
+        """
+        All the decoded fields
+        """
+        return {name: self.get(name) for name in self.FIELDS}
+
+    def _decode(self, view) -> Dict:
+        raise NotImplementedError
+
+
+class EfiVariableData(EventPayload):
+    """
+    UEFI_VARIABLE_DATA of the EFI variables measured, e.g. SecureBoot, PK,
+    KEK, db and dbx, or the authority of an image in db
+    """
+
+    __slots__ = ()
+
+    FIELDS = ("variable_guid", "variable_name", "variable_data")
+
+    def _decode(self, view):
+        guid, name_length, data_length = EFI_VARIABLE_HEADER.unpack_from(view)
+        name_end = EFI_VARIABLE_HEADER.size + name_length * 2
+        if name_end + data_length > len(view):
+            raise ValueError("Variable name and data beyond the event data")
+        return {
+            "variable_guid": format_guid(guid),
+            "variable_name": bytes(view[EFI_VARIABLE_HEADER.size:name_end]).decode("utf-16-le"),
+            "variable_data": view[name_end:name_end + data_length]
+        }
+
+
+class EfiBootVariableData(EfiVariableData):
+    """
+    UEFI_VARIABLE_DATA of the boot variables. The boot_order of BootOrder
+    is its list of option numbers, and the Boot#### options are decoded as
+    EFI_LOAD_OPTION with their attributes, description and device path as
+    text. The fields that do not apply to the variable are None.
+    """
+
+    __slots__ = ()
+
+    FIELDS = EfiVariableData.FIELDS + ("boot_order", "attributes", "description",
+                                       "device_path")
+
+    def _decode(self, view):
+        fields = super()._decode(view)
+        fields.update({"boot_order": None, "attributes": None, "description": None,
+                       "device_path": None})
+        data = fields["variable_data"]
+        if fields["variable_name"] == "BootOrder":
+            fields["boot_order"] = [UINT16.unpack_from(data, offset)[0]
+                                    for offset in range(0, len(data) - 1, 2)]
+        elif BOOT_OPTION_NAME.match(fields["variable_name"]):
+            # EFI_LOAD_OPTION: Attributes, FilePathListLength, Description
+            # as a null-terminated UTF-16 string, FilePathList
+            attributes, = UINT32.unpack_from(data)
+            path_length, = UINT16.unpack_from(data, 4)
+            end = 6
+            while bytes(data[end:end + 2]) != b"\x00\x00":
+                if end + 2 > len(data):
+                    raise ValueError("Unterminated load option description")
+                end += 2
+            fields["attributes"] = attributes
+            fields["description"] = bytes(data[6:end]).decode("utf-16-le")
+            fields["device_path"] = device_path_to_text(data[end + 2:end + 2 + path_length])
+        return fields
+
+
+class EfiGptData(EventPayload):
+    """
+    UEFI_GPT_DATA, the GPT header of the boot disk and its partitions, each
+    a dict of type_guid, unique_guid, starting_lba, ending_lba, attributes
+    and name
+    """
+
+    __slots__ = ()
+
+    FIELDS = ("disk_guid", "header", "partitions")
+
+    def _decode(self, view):
+        (signature, revision, header_size, header_crc32, _, my_lba, alternate_lba,
+         first_usable_lba, last_usable_lba, disk_guid, partition_entry_lba,
+         number_of_partition_entries, size_of_partition_entry,
+         partition_entry_array_crc32) = EFI_PARTITION_TABLE_HEADER.unpack_from(view)
+        if signature != b"EFI PART":
+            raise ValueError(f"Invalid GPT signature {signature}")
+        offset = EFI_PARTITION_TABLE_HEADER.size
+        number_of_partitions, = UINT64.unpack_from(view, offset)
+        offset += 8
+        if size_of_partition_entry < EFI_PARTITION_ENTRY.size + EFI_PARTITION_NAME_LENGTH or \
+                offset + number_of_partitions * size_of_partition_entry > len(view):
+            raise ValueError("Partition entries beyond the event data")
+
+        partitions = []
+        for _ in range(number_of_partitions):
+            type_guid, unique_guid, starting_lba, ending_lba, attributes = \
+                EFI_PARTITION_ENTRY.unpack_from(view, offset)
+            name_offset = offset + EFI_PARTITION_ENTRY.size
+            partitions.append({
+                "type_guid": format_guid(type_guid),
+                "unique_guid": format_guid(unique_guid),
+                "starting_lba": starting_lba,
+                "ending_lba": ending_lba,
+                "attributes": attributes,
+                "name": _utf16(view[name_offset:name_offset + EFI_PARTITION_NAME_LENGTH])
+            })
+            offset += size_of_partition_entry
+        return {
+            "disk_guid": format_guid(disk_guid),
+            "header": {
+                "revision": revision,
+                "header_size": header_size,
+                "header_crc32": header_crc32,
+                "my_lba": my_lba,
+                "alternate_lba": alternate_lba,
+                "first_usable_lba": first_usable_lba,
+                "last_usable_lba": last_usable_lba,
+                "partition_entry_lba": partition_entry_lba,
+                "number_of_partition_entries": number_of_partition_entries,
+                "size_of_partition_entry": size_of_partition_entry,
+                "partition_entry_array_crc32": partition_entry_array_crc32
+            },
+            "partitions": partitions
+        }
+
+
+class EfiImageLoadEvent(EventPayload):
+    """
+    UEFI_IMAGE_LOAD_EVENT of the PE images loaded, e.g. shim, grub or the
+    kernel. device_path is the text of the image device path and file_path
+    its last file path node, None if it has none.
+    """
+
+    __slots__ = ()
+
+    FIELDS = ("image_location", "image_length", "image_link_time_address", "device_path",
+              "file_path")
+
+    def _decode(self, view):
+        location, length, link_time_address, path_length = \
+            EFI_IMAGE_LOAD_HEADER.unpack_from(view)
+        start = EFI_IMAGE_LOAD_HEADER.size
+        if start + path_length > len(view):
+            raise ValueError("Device path beyond the event data")
+        path = view[start:start + path_length]
+        return {
+            "image_location": location,
+            "image_length": length,
+            "image_link_time_address": link_time_address,
+            "device_path": device_path_to_text(path),
+            "file_path": _file_path(path)
+        }
+
+
+class EfiPlatformFirmwareBlob(EventPayload):
+    """
+    UEFI_PLATFORM_FIRMWARE_BLOB, the firmware volume measured
+    """
+
+    __slots__ = ()
+
+    FIELDS = ("blob_base", "blob_length")
+
+    def _decode(self, view):
+        base, length = EFI_PLATFORM_FIRMWARE_BLOB.unpack_from(view)
+        return {"blob_base": base, "blob_length": length}
+
+
+class EfiPlatformFirmwareBlob2(EventPayload):
+    """
+    UEFI_PLATFORM_FIRMWARE_BLOB2, the firmware blob measured with its
+    description, e.g. the TD HOB or the configuration firmware volume
+    """
+
+    __slots__ = ()
+
+    FIELDS = ("description", "blob_base", "blob_length")
+
+    def _decode(self, view):
+        size = view[0]
+        base, length = EFI_PLATFORM_FIRMWARE_BLOB.unpack_from(view, 1 + size)
+        return {"description": bytes(view[1:1 + size]).decode("utf-8", "replace"),
+                "blob_base": base, "blob_length": length}
+
+
+class EventString(EventPayload):
+    """
+    Event data that is a string, without its terminating null characters,
+    e.g. the grub commands and kernel command line of EV_IPL
+    """
+
+    __slots__ = ()
+
+    FIELDS = ("text",)
+
+    def _decode(self, view):
+        return {"text": bytes(view).rstrip(b"\x00").decode("utf-8", "replace")}
+
+
+# event type -> view of its event data
+DECODERS = {
+    TDEventLogType.EV_EFI_VARIABLE_DRIVER_CONFIG: EfiVariableData,
+    TDEventLogType.EV_EFI_VARIABLE_AUTHORITY: EfiVariableData,
+    TDEventLogType.EV_EFI_VARIABLE_BOOT: EfiBootVariableData,
+    TDEventLogType.EV_EFI_VARIABLE_BOOT2: EfiBootVariableData,
+    TDEventLogType.EV_EFI_GPT_EVENT: EfiGptData,
+    TDEventLogType.EV_EFI_BOOT_SERVICES_APPLICATION: EfiImageLoadEvent,
+    TDEventLogType.EV_EFI_BOOT_SERVICES_DRIVER: EfiImageLoadEvent,
+    TDEventLogType.EV_EFI_RUNTIME_SERVICES_DRIVER: EfiImageLoadEvent,
+    TDEventLogType.EV_EFI_PLATFORM_FIRMWARE_BLOB: EfiPlatformFirmwareBlob,
+    TDEventLogType.EV_EFI_PLATFORM_FIRMWARE_BLOB2: EfiPlatformFirmwareBlob2,
+    TDEventLogType.EV_IPL: EventString,
+    TDEventLogType.EV_EFI_ACTION: EventString,
+    TDEventLogType.EV_ACTION: EventString,
+}
+
+
+def decode_event(etype: int, data) -> EventPayload:
+    """
+    Typed view of the event data of the given event type, not decoded yet.
+    None if the event type has no decoder or there is no event data.
+    """
+    decoder = DECODERS.get(etype)
+    if decoder is None or data is None or len(data) == 0:
+        return None
+    return decoder(data)
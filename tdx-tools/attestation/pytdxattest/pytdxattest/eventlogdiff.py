@@ -0,0 +1,250 @@
+"""
+Diff of two TD event logs, e.g. of a failed TD against a reference boot.
+
+The entries of both logs are grouped by RTMR and aligned per RTMR on their
+(event type, digest) key. Equal keys are matched in log order; on a
+mismatch, the key of each side is looked up ahead in the other side through
+a hash index of the positions of every key, and the shorter run is reported
+as inserted or removed. A pair of entries of the same type that are found
+nowhere ahead is reported as changed. Each position is visited once, so
+the diff is linear in the number of entries.
+
+The result of each RTMR lists its differences as compact records:
+
+    [op, reference number, actual number, event type, reference digest,
+     actual digest]
+
+with op "inserted", "removed" or "changed", the numbers of the entries in
+their log as in TDEventLogIndex (None on the side without the entry) and the
+digests in hex, plus the first divergence point and the count of each op.
+"""
+
+import logging
+from collections import deque
+from typing import Dict, List, Tuple
+
+from .actor import TDEventLogActor
+from .tdeventlog import TDEventLogEntry, TDEventLogType, TCGAlgorithmRegistry
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+DIFF_INSERTED = "inserted"
+DIFF_REMOVED = "removed"
+DIFF_CHANGED = "changed"
+
+
+class RtmrDiff:
+    """
+    Differences of the entries extended into one RTMR
+    """
+
+    __slots__ = ("rtmr", "reference_events", "actual_events", "records",
+                 "first_divergence", "counts")
+
+    def __init__(self, rtmr: int, reference_events: int, actual_events: int):
+        self.rtmr = rtmr
+        self.reference_events = reference_events
+        self.actual_events = actual_events
+        self.records = []
+        # (reference number, actual number) of the first entries that differ
+        self.first_divergence = None
+        self.counts = {DIFF_INSERTED: 0, DIFF_REMOVED: 0, DIFF_CHANGED: 0}
+
+    @property
+    def identical(self) -> bool:
+        """
+        Whether both logs extended the same entries into the RTMR
+        """
+        return not self.records
+
+    def add(self, operation, reference, actual, etype):
+        """
+        Add a difference, reference and actual are (number, digest) or None
+        """
+        self.counts[operation] += 1
+        self.records.append([
+            operation,
+            reference[0] if reference is not None else None,
+            actual[0] if actual is not None else None,
+            etype,
+            reference[1].hex() if reference is not None else None,
+            actual[1].hex() if actual is not None else None])
+
+    def to_dict(self) -> Dict:
+        """
+        Machine-readable form of the differences
+        """
+        result = {"events": [self.reference_events, self.actual_events],
+                  "first_divergence": None, "diff": self.records}
+        result.update(self.counts)
+        if self.first_divergence is not None:
+            result["first_divergence"] = {"reference": self.first_divergence[0],
+                                          "actual": self.first_divergence[1]}
+        return result
+
+
+class EventLogDiff:
+    """
+    Differences of two event logs, by RTMR
+    """
+
+    def __init__(self, algorithm: int = TCGAlgorithmRegistry.TPM_ALG_SHA384):
+        self.algorithm = algorithm
+        self.rtmrs = {}
+
+    @property
+    def identical(self) -> bool:
+        """
+        Whether both logs extended the same entries into every RTMR
+        """
+        return all(rtmr_diff.identical for rtmr_diff in self.rtmrs.values())
+
+    def to_dict(self) -> Dict:
+        """
+        Machine-readable form of the differences, see the module
+        documentation
+        """
+        return {
+            "identical": self.identical,
+            "algorithm": TCGAlgorithmRegistry.get_algorithm_string(self.algorithm),
+            "rtmrs": {str(rtmr): rtmr_diff.to_dict()
+                      for rtmr, rtmr_diff in sorted(self.rtmrs.items())}
+        }
+
+    def dump(self):
+        """
+        Dump the differences
+        """
+        for rtmr, rtmr_diff in sorted(self.rtmrs.items()):
+            LOG.info("==== RTMR[%d] ====", rtmr)
+            LOG.info("Events            : %d / %d", rtmr_diff.reference_events,
+                     rtmr_diff.actual_events)
+            if rtmr_diff.identical:
+                LOG.info("Identical")
+                continue
+            LOG.info("First divergence  : reference %s, actual %s", *rtmr_diff.first_divergence)
+            for operation, reference, actual, etype, reference_digest, actual_digest \
+                    in rtmr_diff.records:
+                LOG.info("%-8s %6s %6s  %s  %s", operation,
+                         "-" if reference is None else reference,
+                         "-" if actual is None else actual,
+                         TDEventLogType.get_type_string(etype),
+                         actual_digest if reference_digest is None else reference_digest)
+
+
+def _group_by_rtmr(actor: TDEventLogActor, algorithm: int) -> Dict[int, List[Tuple]]:
+    """
+    Group the (number, (event type, digest)) of the entries by RTMR
+    """
+    index = actor.get_index()
+    groups = {}
+    for number in range(len(index)):
+        entry: TDEventLogEntry = index.get_entry(number)
+        key = (entry.etype, entry.get_digest(algorithm) or b"")
+        groups.setdefault(entry.rtmr, []).append((number, key))
+    return groups
+
+
+def _index_positions(entries: List[Tuple], start: int, end: int) -> Dict[Tuple, deque]:
+    """
+    Positions of each key between start and end, in increasing order
+    """
+    positions = {}
+    for position in range(start, end):
+        positions.setdefault(entries[position][1], deque()).append(position)
+    return positions
+
+
+def _next_position(positions: Dict[Tuple, deque], key: Tuple, start: int) -> int:
+    """
+    First position of the key at or after start, None if there is none.
+    The positions before start are dropped, as start only moves forward.
+    """
+    queue = positions.get(key)
+    if queue is None:
+        return None
+    while queue and queue[0] < start:
+        queue.popleft()
+    return queue[0] if queue else None
+
+
+def _add_run(rtmr_diff: RtmrDiff, operation: str, entries: List[Tuple]):
+    for number, (etype, digest) in entries:
+        if operation == DIFF_INSERTED:
+            rtmr_diff.add(operation, None, (number, digest), etype)
+        else:
+            rtmr_diff.add(operation, (number, digest), None, etype)
+
+
+def _diff_rtmr(rtmr: int, reference: List[Tuple], actual: List[Tuple]) -> RtmrDiff:
+    rtmr_diff = RtmrDiff(rtmr, len(reference), len(actual))
+
+    # logs of the same boot flow mostly differ in the middle, if at all
+    i = 0
+    limit = min(len(reference), len(actual))
+    while i < limit and reference[i][1] == actual[i][1]:
+        i += 1
+    reference_end, actual_end = len(reference), len(actual)
+    while reference_end > i and actual_end > i and \
+            reference[reference_end - 1][1] == actual[actual_end - 1][1]:
+        reference_end -= 1
+        actual_end -= 1
+    if i == reference_end and i == actual_end:
+        return rtmr_diff
+
+    rtmr_diff.first_divergence = (
+        reference[i][0] if i < reference_end else None,
+        actual[i][0] if i < actual_end else None)
+    reference_positions = _index_positions(reference, i, reference_end)
+    actual_positions = _index_positions(actual, i, actual_end)
+    j = i
+
+    while i < reference_end and j < actual_end:
+        reference_key, actual_key = reference[i][1], actual[j][1]
+        if reference_key == actual_key:
+            i += 1
+            j += 1
+            continue
+
+        # where the current entry of each side shows up again on the other
+        in_actual = _next_position(actual_positions, reference_key, j)
+        in_reference = _next_position(reference_positions, actual_key, i)
+
+        if in_actual is not None and \
+                (in_reference is None or in_actual - j <= in_reference - i):
+            _add_run(rtmr_diff, DIFF_INSERTED, actual[j:in_actual])
+            j = in_actual
+        elif in_reference is not None:
+            _add_run(rtmr_diff, DIFF_REMOVED, reference[i:in_reference])
+            i = in_reference
+        elif reference_key[0] == actual_key[0]:
+            rtmr_diff.add(DIFF_CHANGED, (reference[i][0], reference_key[1]),
+                          (actual[j][0], actual_key[1]), reference_key[0])
+            i += 1
+            j += 1
+        else:
+            _add_run(rtmr_diff, DIFF_REMOVED, reference[i:i + 1])
+            _add_run(rtmr_diff, DIFF_INSERTED, actual[j:j + 1])
+            i += 1
+            j += 1
+
+    _add_run(rtmr_diff, DIFF_REMOVED, reference[i:reference_end])
+    _add_run(rtmr_diff, DIFF_INSERTED, actual[j:actual_end])
+    return rtmr_diff
+
+
+def diff_event_logs(reference: TDEventLogActor, actual: TDEventLogActor,
+                    algorithm: int = TCGAlgorithmRegistry.TPM_ALG_SHA384) -> EventLogDiff:
+    """
+    Diff the entries of two event logs per RTMR, comparing the digests of
+    the given algorithm
+    """
+    reference_groups = _group_by_rtmr(reference, algorithm)
+    actual_groups = _group_by_rtmr(actual, algorithm)
+    result = EventLogDiff(algorithm)
+    for rtmr in sorted(set(reference_groups) | set(actual_groups)):
+        result.rtmrs[rtmr] = _diff_rtmr(rtmr, reference_groups.get(rtmr, []),
+                                        actual_groups.get(rtmr, []))
+    return result
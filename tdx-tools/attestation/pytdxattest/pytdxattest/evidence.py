@@ -0,0 +1,448 @@
+"""
+Evidence bundle container, to ship the attestation data of many TDs to a
+verifier in one compact file.
+
+An evidence bundle holds the CCEL ACPI table, the event log, the TD report
+and the TD quote of one TD, and a JSON metadata section with e.g. the TDX
+version of the report. A container file is a sequence of bundle records,
+so records can be appended to it and files can be concatenated:
+
+    record header   magic "TDXE", format version, compression, number of
+                    sections, length of the id, length of the compressed
+                    body, length of the body, little endian
+    id              UTF-8 id of the TD
+    section table   per section: type, length and SHA-384 digest of its data
+    body            the data of the sections one after the other, compressed
+                    as a whole
+
+The body is compressed with zlib, or with zstd or lz4 if their optional
+packages are installed, pytdxattest[compress]. The digests of the sections
+are checked when a bundle is decoded. EvidenceReader reads one record at a
+time, and its scan() skips the bodies, so a large file is never loaded at
+once. The records can also be handed over undecoded, e.g. to the workers of
+the batch verification that decode them in parallel.
+"""
+
+import json
+import time
+import zlib
+import socket
+import struct
+import hashlib
+import logging
+from typing import Dict, Iterator
+
+try:
+    import zstandard
+    _ZSTD_ERRORS = (zstandard.ZstdError,)
+except ImportError:
+    zstandard = None
+    _ZSTD_ERRORS = ()
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None # pylint: disable=invalid-name
+
+from .actor import TDEventLogActor
+from .ccel import CCEL
+from .tdquote import TdQuote
+from .tdreport import TdReport
+from .utility import TDX_VERSION_1_0
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+EVIDENCE_MAGIC = b"TDXE"
+EVIDENCE_VERSION = 1
+# magic, version, compression, section count, id length, body length,
+# uncompressed body length
+RECORD_HEADER = struct.Struct("<4sBBHHII")
+# section type, data length, SHA-384 digest of the data
+SECTION_ENTRY = struct.Struct("<BI48s")
+# Upper bound of a body, to reject a corrupted length
+MAX_BODY_LENGTH = 1 << 28
+
+SECTION_CCEL = 1
+SECTION_EVENTLOG = 2
+SECTION_TDREPORT = 3
+SECTION_TDQUOTE = 4
+SECTION_METADATA = 5
+
+# section type -> key of the bundle dicts of the batch verification
+SECTION_KEYS = {
+    SECTION_CCEL: "ccel",
+    SECTION_EVENTLOG: "eventlog",
+    SECTION_TDREPORT: "tdreport",
+    SECTION_TDQUOTE: "tdquote",
+    SECTION_METADATA: "metadata",
+}
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSION_LZ4 = 3
+
+COMPRESSIONS = {
+    "none": COMPRESSION_NONE,
+    "zlib": COMPRESSION_ZLIB,
+    "zstd": COMPRESSION_ZSTD,
+    "lz4": COMPRESSION_LZ4,
+}
+
+
+def _require_compression(compression):
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ImportError("zstandard is required for zstd evidence bundles, "
+                          "please install pytdxattest[compress]")
+    if compression == COMPRESSION_LZ4 and lz4 is None:
+        raise ImportError("lz4 is required for lz4 evidence bundles, "
+                          "please install pytdxattest[compress]")
+    if compression not in COMPRESSIONS.values():
+        raise ValueError(f"Unsupported evidence compression {compression}")
+
+
+def default_compression() -> int:
+    """
+    Best compression available, zstd if installed, else zlib
+    """
+    return COMPRESSION_ZSTD if zstandard is not None else COMPRESSION_ZLIB
+
+
+def _compress(compression, data, level):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(data, 6 if level is None else level)
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if compression == COMPRESSION_LZ4:
+        return lz4.frame.compress(data, compression_level=0 if level is None else level)
+    return data
+
+
+def _decompress(compression, data, length):
+    try:
+        data = _decompress_body(compression, data, length)
+    except (zlib.error, RuntimeError) + _ZSTD_ERRORS as err:
+        # lz4 raises RuntimeError
+        raise ValueError(f"Corrupted evidence body: {err}") from err
+    if len(data) != length:
+        raise ValueError(f"Evidence body of {len(data)} bytes instead of {length}")
+    return data
+
+
+def _decompress_body(compression, data, length):
+    if compression == COMPRESSION_ZLIB:
+        # bounded, so a corrupted record cannot expand without limit
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, length)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Evidence body longer than its header")
+    elif compression == COMPRESSION_ZSTD:
+        data = zstandard.ZstdDecompressor().decompress(data, max_output_size=length)
+    elif compression == COMPRESSION_LZ4:
+        data = lz4.frame.LZ4FrameDecompressor().decompress(data, max_length=length)
+    return data
+
+
+class EvidenceBundle:
+    """
+    Evidence of one TD, the data of its sections by section type. The
+    typed accessors build the CCEL, TDEventLogActor, TdReport and TdQuote
+    of the sections present, None for the missing ones.
+    """
+
+    def __init__(self, bundle_id: str, sections: Dict[int, bytes] = None,
+                 digests: Dict[int, bytes] = None):
+        self.id = bundle_id
+        self.sections = {stype: bytes(data) for stype, data in (sections or {}).items()
+                         if data is not None}
+        # digests of the sections read from a record, computed on demand
+        # for a new bundle
+        self._digests = dict(digests or {})
+
+    @staticmethod
+    def from_dict(bundle: Dict) -> "EvidenceBundle":
+        """
+        Bundle of a dict with the id and the section data by key, as the
+        bundles of the batch verification
+        """
+        sections = {stype: bundle.get(key) for stype, key in SECTION_KEYS.items()}
+        metadata = sections[SECTION_METADATA]
+        if isinstance(metadata, dict):
+            sections[SECTION_METADATA] = json.dumps(metadata, sort_keys=True).encode()
+        return EvidenceBundle(bundle.get("id"), sections)
+
+    def to_dict(self) -> Dict:
+        """
+        The id and the section data by key, as the bundles of the batch
+        verification
+        """
+        bundle = {"id": self.id}
+        for stype, key in SECTION_KEYS.items():
+            bundle[key] = self.sections.get(stype)
+        bundle["metadata"] = self.metadata
+        return bundle
+
+    def digest(self, stype: int) -> bytes:
+        """
+        SHA-384 digest of the data of a section, None if it is missing
+        """
+        if stype not in self.sections:
+            return None
+        if stype not in self._digests:
+            self._digests[stype] = hashlib.sha384(self.sections[stype]).digest()
+        return self._digests[stype]
+
+    @property
+    def metadata(self) -> Dict:
+        """
+        Metadata of the bundle, an empty dict if there is none
+        """
+        data = self.sections.get(SECTION_METADATA)
+        return json.loads(data) if data else {}
+
+    def get_ccel(self) -> CCEL:
+        """
+        CCEL ACPI table
+        """
+        data = self.sections.get(SECTION_CCEL)
+        return CCEL(data) if data is not None else None
+
+    def get_event_log_actor(self) -> TDEventLogActor:
+        """
+        Event log actor over the event log, at the address of the CCEL
+        table if there is one
+        """
+        data = self.sections.get(SECTION_EVENTLOG)
+        if data is None:
+            return None
+        ccelobj = self.get_ccel()
+        if ccelobj is not None and ccelobj.is_valid():
+            return TDEventLogActor(ccelobj.log_area_start_address,
+                                   ccelobj.log_area_minimum_length, data=data)
+        return TDEventLogActor(0, None, data=data)
+
+    def get_td_report(self) -> TdReport:
+        """
+        TD report, in the layout of the TDX version of the metadata, 1.0 if
+        it has none
+        """
+        data = self.sections.get(SECTION_TDREPORT)
+        if data is None:
+            return None
+        return TdReport(data, version=self.metadata.get("tdx_version", TDX_VERSION_1_0))
+
+    def get_td_quote(self) -> TdQuote:
+        """
+        TD quote
+        """
+        data = self.sections.get(SECTION_TDQUOTE)
+        return TdQuote(data) if data is not None else None
+
+
+def encode_bundle(bundle: EvidenceBundle, compression: int = None, level: int = None) -> bytes:
+    """
+    Encode a bundle as a record, compressed with the given COMPRESSION_*,
+    the default_compression() if None
+    """
+    compression = default_compression() if compression is None else compression
+    _require_compression(compression)
+    bundle_id = str(bundle.id if bundle.id is not None else "").encode("utf-8")
+    stypes = sorted(bundle.sections)
+    body = b"".join(bundle.sections[stype] for stype in stypes)
+    compressed = _compress(compression, body, level)
+    if len(body) > MAX_BODY_LENGTH:
+        raise ValueError(f"Evidence bundle {bundle.id} is too large")
+    table = b"".join(SECTION_ENTRY.pack(stype, len(bundle.sections[stype]), bundle.digest(stype))
+                     for stype in stypes)
+    return RECORD_HEADER.pack(EVIDENCE_MAGIC, EVIDENCE_VERSION, compression, len(stypes),
+                              len(bundle_id), len(compressed), len(body)) + \
+        bundle_id + table + compressed
+
+
+def _parse_header(header):
+    magic, version, compression, count, id_length, length, raw_length = \
+        RECORD_HEADER.unpack(header)
+    if magic != EVIDENCE_MAGIC:
+        raise ValueError("Not an evidence bundle record")
+    if version != EVIDENCE_VERSION:
+        raise ValueError(f"Unsupported evidence bundle version {version}")
+    if length > MAX_BODY_LENGTH or raw_length > MAX_BODY_LENGTH:
+        raise ValueError("Invalid evidence body length")
+    return compression, count, id_length, length, raw_length
+
+
+def decode_bundle(record, verify: bool = True) -> EvidenceBundle:
+    """
+    Decode a bundle record. With verify, the digest of each section is
+    checked. Raise ValueError on a malformed record or a wrong digest.
+    """
+    record = memoryview(record)
+    if len(record) < RECORD_HEADER.size:
+        raise ValueError("Truncated evidence bundle")
+    compression, count, id_length, length, raw_length = \
+        _parse_header(record[:RECORD_HEADER.size])
+    _require_compression(compression)
+    offset = RECORD_HEADER.size + id_length + count * SECTION_ENTRY.size
+    if len(record) != offset + length:
+        raise ValueError("Truncated evidence bundle")
+    bundle_id = bytes(record[RECORD_HEADER.size:RECORD_HEADER.size + id_length]).decode("utf-8")
+    body = _decompress(compression, bytes(record[offset:]), raw_length)
+
+    sections = {}
+    digests = {}
+    start = 0
+    for stype, section_length, digest in SECTION_ENTRY.iter_unpack(
+            record[RECORD_HEADER.size + id_length:offset]):
+        data = body[start:start + section_length]
+        start += section_length
+        if len(data) != section_length:
+            raise ValueError(f"Section {stype} beyond the evidence body")
+        if verify and hashlib.sha384(data).digest() != digest:
+            raise ValueError(f"Wrong digest of section {stype} of evidence bundle {bundle_id}")
+        sections[stype] = data
+        digests[stype] = digest
+    return EvidenceBundle(bundle_id, sections, digests)
+
+
+class EvidenceWriter:
+    """
+    Write bundle records to a binary stream, e.g. a file opened in "ab" to
+    append to it
+    """
+
+    def __init__(self, stream, compression: int = None, level: int = None):
+        self._stream = stream
+        self._compression = default_compression() if compression is None else compression
+        self._level = level
+        _require_compression(self._compression)
+        self.count = 0
+        self.length = 0
+
+    def write(self, bundle) -> int:
+        """
+        Write an EvidenceBundle, or a bundle dict, return the length of its
+        record
+        """
+        if isinstance(bundle, dict):
+            bundle = EvidenceBundle.from_dict(bundle)
+        record = encode_bundle(bundle, self._compression, self._level)
+        self._stream.write(record)
+        self.count += 1
+        self.length += len(record)
+        return len(record)
+
+    def close(self):
+        """
+        Flush the stream, which is left open
+        """
+        self._stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class EvidenceReader:
+    """
+    Read the bundle records of a binary stream one at a time
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        # offset of the next record in the stream
+        self.offset = 0
+
+    def _read_exact(self, length, what):
+        data = self._stream.read(length)
+        if len(data) != length:
+            raise ValueError(f"Truncated evidence {what} at offset {self.offset}")
+        return data
+
+    def _read_header(self):
+        header = self._stream.read(RECORD_HEADER.size)
+        if not header:
+            return None
+        if len(header) != RECORD_HEADER.size:
+            raise ValueError(f"Truncated evidence record header at offset {self.offset}")
+        return header, _parse_header(header)
+
+    def iter_records(self) -> Iterator[bytes]:
+        """
+        Yield the raw records, to be decoded with decode_bundle
+        """
+        while True:
+            header = self._read_header()
+            if header is None:
+                return
+            header, (_, count, id_length, length, _) = header
+            rest = self._read_exact(id_length + count * SECTION_ENTRY.size + length, "record")
+            self.offset += len(header) + len(rest)
+            yield header + rest
+
+    def __iter__(self) -> Iterator[EvidenceBundle]:
+        for record in self.iter_records():
+            yield decode_bundle(record)
+
+    def scan(self) -> Iterator[Dict]:
+        """
+        Yield the id, offset, length and sections of each record without
+        reading its body, the sections as {type: (length, digest)}
+        """
+        while True:
+            start = self.offset
+            header = self._read_header()
+            if header is None:
+                return
+            header, (compression, count, id_length, length, raw_length) = header
+            bundle_id = self._read_exact(id_length, "record id").decode("utf-8")
+            table = self._read_exact(count * SECTION_ENTRY.size, "section table")
+            if self._stream.seekable():
+                self._stream.seek(length, 1)
+            else:
+                self._read_exact(length, "record body")
+            self.offset = start + len(header) + id_length + len(table) + length
+            yield {
+                "id": bundle_id,
+                "offset": start,
+                "length": self.offset - start,
+                "compression": compression,
+                "body_length": raw_length,
+                "sections": {stype: (section_length, digest) for stype, section_length, digest
+                             in SECTION_ENTRY.iter_unpack(table)},
+            }
+
+
+def collect_evidence(bundle_id: str = None, report_data: bytes = None,
+                     with_quote: bool = True) -> EvidenceBundle:
+    """
+    Collect the evidence of the TD it runs in: its CCEL table, event log,
+    TD report and TD quote for the report data, by default with the host
+    name as id. Raise OSError if the CCEL table or the event log cannot be
+    read.
+    """
+    ccelobj = CCEL.create_from_source(None)
+    if ccelobj is None:
+        raise OSError("Could not read the CCEL ACPI table")
+    actor = TDEventLogActor(ccelobj.log_area_start_address, ccelobj.log_area_minimum_length)
+    if actor.data is None:
+        raise OSError("Could not read the event log")
+
+    tdreport = TdReport.get_td_report(report_data)
+    sections = {
+        SECTION_CCEL: ccelobj.data,
+        SECTION_EVENTLOG: actor.data,
+        SECTION_TDREPORT: tdreport.data,
+        SECTION_METADATA: json.dumps({"tdx_version": tdreport.version,
+                                      "collected": time.time()}, sort_keys=True).encode()
+    }
+    if with_quote:
+        tdquote = TdQuote.get_quote(report_data=report_data)
+        if tdquote is None:
+            LOG.error("Could not get the TD quote, the bundle has none")
+        else:
+            sections[SECTION_TDQUOTE] = tdquote.data
+    return EvidenceBundle(bundle_id or socket.gethostname(), sections)
@@ -0,0 +1,276 @@
+"""
+Follow the IMA measurement list and anchor the new measurements into an RTMR.
+
+The binary measurement list of IMA only grows while the system runs. Each
+entry is, in host byte order:
+
+    pcr                 u32
+    template_digest     20 bytes, SHA-1
+    template_name_len   u32
+    template_name       template_name_len bytes
+    template_data_len   u32
+    template_data       template_data_len bytes
+
+With the ima-ng and ima-sig templates, the template data starts with the
+file data digest as "<algo>:\\0<digest>" and the file name, each prefixed
+with its u32 length.
+
+ImaFollower keeps the offset of the entries already extended in a
+checkpoint file along with the boot id, so each poll only parses and extends
+the entries appended since, and the list is read from the start again after
+a reboot.
+"""
+
+import os
+import json
+import time
+import struct
+import logging
+import tempfile
+
+from .rtmr import RTMR, RTMRExtender
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+IMA_BINARY_MEASUREMENTS = "/sys/kernel/security/ima/binary_runtime_measurements"
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+BOOT_AGGREGATE = "boot_aggregate"
+
+DEFAULT_RTMR_INDEX = 3
+
+# Templates with the file data digest and the file name first in their data
+IMA_NG_TEMPLATES = ("ima-ng", "ima-sig", "ima-modsig", "ima-buf")
+
+IMA_TEMPLATE_DIGEST_LENGTH = 20
+IMA_UINT32 = struct.Struct("=I")
+
+
+class ImaEntry:
+    """
+    Entry of the IMA measurement list
+    """
+
+    __slots__ = ("pcr", "template_name", "algorithm", "digest", "filename")
+
+    def __init__(self, pcr, template_name, algorithm=None, digest=None, filename=None):
+        self.pcr = pcr
+        self.template_name = template_name
+        self.algorithm = algorithm
+        self.digest = digest
+        self.filename = filename
+
+
+def _parse_ima_ng_data(data):
+    """
+    Get the file data digest algorithm, the digest and the file name of
+    ima-ng template data
+    """
+    length, = IMA_UINT32.unpack_from(data, 0)
+    field = bytes(data[4:4 + length])
+    algorithm, separator, digest = field.partition(b":\0")
+    if not separator:
+        # ima-ng with a SHA-1 or MD5 digest only, without the algorithm
+        algorithm, digest = b"sha1", field
+    index = 4 + length
+    length, = IMA_UINT32.unpack_from(data, index)
+    filename = bytes(data[index + 4:index + 4 + length]).rstrip(b"\0")
+    return algorithm.decode(), digest, filename.decode(errors="replace")
+
+
+def iter_ima_entries(data, offset=0):
+    """
+    Yield (entry, offset of the next entry) for the complete entries of the
+    binary measurement list from the offset. A partial entry at the end is
+    left for the next read, and the entries stop before a malformed one.
+    """
+    view = memoryview(data)
+    end = len(view)
+    index = offset
+    while index + 4 + IMA_TEMPLATE_DIGEST_LENGTH + 4 <= end:
+        pcr, = IMA_UINT32.unpack_from(view, index)
+        name_index = index + 4 + IMA_TEMPLATE_DIGEST_LENGTH
+        name_length, = IMA_UINT32.unpack_from(view, name_index)
+        data_index = name_index + 4 + name_length
+        if data_index + 4 > end:
+            return
+        data_length, = IMA_UINT32.unpack_from(view, data_index)
+        next_index = data_index + 4 + data_length
+        if next_index > end:
+            return
+
+        template_name = bytes(view[name_index + 4:data_index]).decode(errors="replace")
+        entry = ImaEntry(pcr, template_name)
+        if template_name in IMA_NG_TEMPLATES:
+            try:
+                entry.algorithm, entry.digest, entry.filename = \
+                    _parse_ima_ng_data(view[data_index + 4:next_index])
+            except (struct.error, ValueError) as err:
+                # stop before the entry, so its offset is not consumed
+                LOG.error("Malformed %s template data of the IMA entry at offset %d: %s",
+                          template_name, index, err)
+                return
+        yield entry, next_index
+        index = next_index
+
+
+def read_boot_id(path=BOOT_ID_FILE):
+    """
+    Get the id of the current boot, or None if unknown
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as fobj:
+            return fobj.read().strip()
+    except OSError:
+        return None
+
+
+class ImaCheckpoint:
+    """
+    Position in the IMA measurement list of the entries already extended,
+    saved as JSON in a file. It only applies to the boot it was saved in.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.offset = 0
+        self.count = 0
+        self.boot_id = None
+
+    def load(self, boot_id):
+        """
+        Load the checkpoint, and start over if it is from another boot
+        """
+        self.offset, self.count, self.boot_id = 0, 0, boot_id
+        if self.path is None or not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, "r", encoding="utf-8") as fobj:
+                saved = json.load(fobj)
+        except (OSError, ValueError):
+            LOG.error("Invalid IMA checkpoint %s, start over", self.path)
+            return self
+        if saved.get("boot_id") != boot_id:
+            LOG.info("IMA checkpoint is from another boot, start over")
+            return self
+        self.offset = int(saved.get("offset", 0))
+        self.count = int(saved.get("count", 0))
+        return self
+
+    def save(self):
+        """
+        Save the checkpoint, replacing the file atomically
+        """
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fobj:
+                json.dump({"boot_id": self.boot_id, "offset": self.offset,
+                           "count": self.count}, fobj)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            LOG.error("Fail to save IMA checkpoint %s", self.path)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class ImaFollower:
+    """
+    Extend the SHA384 file data digests of new IMA measurements into an
+    RTMR register. The boot_aggregate entry and the digests of other
+    algorithms are skipped, as RTMR only accepts SHA384 digests.
+
+    The checkpoint is saved after the digests of a poll are extended. If the
+    follower stops in between, the entries of that poll are extended again
+    on the next start.
+    """
+
+    def __init__(self, rtmr_index=DEFAULT_RTMR_INDEX, checkpoint_file=None,
+                 measurements=IMA_BINARY_MEASUREMENTS, extender=None):
+        if int(rtmr_index) < 2:
+            raise ValueError(f"Invalid RTMR index {rtmr_index}, only 2 and 3 can be extended")
+        self.rtmr_index = int(rtmr_index)
+        self.measurements = measurements
+        self.checkpoint = ImaCheckpoint(checkpoint_file).load(read_boot_id())
+        self._own_extender = extender is None
+        self._extender = extender if extender is not None else RTMRExtender()
+
+    def _read_new_data(self):
+        """
+        Read the measurement list from the checkpoint offset
+        """
+        with open(self.measurements, "rb") as fobj:
+            fobj.seek(self.checkpoint.offset)
+            return fobj.read()
+
+    def poll(self) -> int:
+        """
+        Extend the measurements appended since the last poll. Return the
+        number of digests extended, or -1 on failure.
+        """
+        try:
+            data = self._read_new_data()
+        except OSError:
+            LOG.error("Could not read IMA measurements in %s", self.measurements)
+            return -1
+
+        digests = []
+        # position after the entry of each digest, and after the last entry
+        positions = []
+        position = (0, 0)
+        for entry, consumed in iter_ima_entries(data):
+            position = (consumed, position[1] + 1)
+            if entry.filename == BOOT_AGGREGATE:
+                continue
+            if entry.algorithm != "sha384" or \
+                    len(entry.digest) != RTMR.RTMR_LENGTH_BY_BYTES:
+                LOG.debug("Skip measurement of %s not using sha384", entry.filename)
+                continue
+            digests.append(entry.digest)
+            positions.append(position)
+
+        if digests and self._own_extender and not self._extender.reopen():
+            LOG.error("Could not open the device file to extend %d measurements",
+                      len(digests))
+            return -1
+        extended = RTMR.extend_rtmr_digests(digests, self.rtmr_index, self._extender)
+        if extended != len(digests):
+            LOG.error("Failed to extend %d of %d measurements",
+                      len(digests) - extended, len(digests))
+            # resume after the last measurement extended
+            position = positions[extended - 1] if extended > 0 else (0, 0)
+
+        if position[1] > 0:
+            self.checkpoint.offset += position[0]
+            self.checkpoint.count += position[1]
+            self.checkpoint.save()
+            LOG.info("Extended %d measurements of %d new IMA entries into RTMR[%d]",
+                     extended, position[1], self.rtmr_index)
+        return extended if extended == len(digests) else -1
+
+    def run(self, interval=5.0, count=None):
+        """
+        Poll every interval seconds, count times or forever
+        """
+        polled = 0
+        while count is None or polled < count:
+            self.poll()
+            polled += 1
+            if count is None or polled < count:
+                time.sleep(interval)
+
+    def close(self):
+        """
+        Close the device file if it was opened by the follower
+        """
+        if self._own_extender:
+            self._extender.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,494 @@
+"""
+Single entry point of the tools, tdxattest <subcommand>.
+
+The subcommands are the tdx_* tools, which run their own subcommand through
+run_command. Only the modules the chosen subcommand needs are imported, see
+cli.py, so a tool starts about as fast as the interpreter itself.
+
+For agents calling the tools in a loop, tdxattest --serve <socket> keeps one
+resident process that runs the requests of clients on a unix socket, one
+at a time, without paying the start of a new interpreter for each:
+
+    tdxattest --serve /run/tdxattest.sock &
+    tdxattest -S /run/tdxattest.sock tdreport -f json
+
+The client sends its arguments and working directory, the server sends
+back what the subcommand writes to stdout and stderr, then its exit
+status. Each message is a frame of a channel byte and the length of the
+payload as a 4-byte big endian integer. The standard input of the client
+is not forwarded, so "-" reads nothing in a served subcommand.
+"""
+
+import io
+import os
+import sys
+import json
+import socket
+import struct
+import logging
+import argparse
+import socketserver
+
+# The command of a subcommand, and any other module of the package, is
+# imported when it runs, so a client of the server does not import any of
+# them.
+# pylint: disable=import-outside-toplevel
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+SERVE_FRAME_HEADER = struct.Struct(">BI")
+SERVE_EXIT_STATUS = struct.Struct(">i")
+SERVE_REQUEST = ord("a")
+SERVE_STDOUT = ord("o")
+SERVE_STDERR = ord("e")
+SERVE_EXIT = ord("x")
+
+# Upper bound of a request, to reject a corrupted length prefix
+SERVE_REQUEST_MAX_LENGTH = 1 << 20
+SERVE_BUFFER_SIZE = 1 << 16
+
+# Names of the TCGAlgorithmRegistry.TPM_ALG_* digest algorithms
+DIGEST_ALGORITHMS = ('sha256', 'sha384', 'sha512')
+
+
+def _add_format_argument(parser):
+    # output.OUTPUT_FORMATS, not imported for the other subcommands
+    parser.add_argument('-f', '--format', type=str, choices=('text', 'json', 'ndjson', 'cbor'),
+                        default='text', help='Output format, text or records streamed to stdout',
+                        dest='output_format')
+
+
+def _eventlogs_arguments(parser):
+    parser.add_argument('-c', type=str, dest='ccel_file',
+                        help='Read the CCEL ACPI table from the file instead of sysfs')
+    parser.add_argument('-e', type=str, dest='eventlog_file',
+                        help='Read the event log from the file instead of sysfs, "-" for stdin')
+    _add_format_argument(parser)
+
+
+def _run_eventlogs(args):
+    from .cli import TDXEventLogsCmd
+    TDXEventLogsCmd().run(args.ccel_file, args.eventlog_file, args.output_format)
+
+
+def _tdreport_arguments(parser):
+    _add_format_argument(parser)
+
+
+def _run_tdreport(args):
+    from .cli import TDXTDReportCmd
+    TDXTDReportCmd().run(args.output_format)
+
+
+def _verify_rtmr_arguments(parser):
+    parser.add_argument('-c', type=str, dest='cache_dir',
+                        help='Reuse the result cached in the directory while the event log '
+                             'and RTMR values are unchanged')
+
+
+def _run_verify_rtmr(args):
+    from .cli import TDXVerifyCmd
+    TDXVerifyCmd().run(args.cache_dir)
+
+
+def _extend_rtmr_arguments(parser):
+    parser.add_argument('-s', type=str, help='Extend string value to rtmr register',
+                        dest='rtmr_extend_str')
+    parser.add_argument('-d', type=str, dest='rtmr_extend_digest',
+                        help='Extend digest value to rtmr register. Must be sha384 digest')
+    parser.add_argument('-r', type=str, help='Extend raw value to rtmr register. Must be 48B.',
+                        dest='rtmr_extend_raw')
+    parser.add_argument('-i', type=int, default=2, help='RTMR register to extend',
+                        dest='extended_rtmr_index')
+
+
+def _run_extend_rtmr(args):
+    from .cli import TDXRTMRExtendCmd
+    if args.rtmr_extend_raw is not None or args.rtmr_extend_str is not None or \
+            args.rtmr_extend_digest is not None:
+        TDXRTMRExtendCmd().run(args.rtmr_extend_raw, args.rtmr_extend_str,
+                               args.rtmr_extend_digest, args.extended_rtmr_index)
+
+
+def _quote_arguments(parser):
+    parser.add_argument('-o', type=str, help='Save TD Quote to the path', dest='output')
+    parser.add_argument('-n', type=str, dest='nonce',
+                        help='The base64 encoded nonce to be measured in report data')
+    parser.add_argument('-u', type=str, dest='user_data',
+                        help='The base64 encoded user data to be measured in report data')
+    parser.add_argument('-q', default=False, help='Do not display TD Quote', dest='quiet',
+                        action="store_true")
+    parser.add_argument('-c', type=str, dest='cache_dir',
+                        help='Reuse the quote cached in the directory while the report data '
+                             'and RTMR values are unchanged')
+    _add_format_argument(parser)
+
+
+def _run_quote(args):
+    from .cli import TDXQuoteCmd
+    TDXQuoteCmd().run(args.output, args.nonce, args.user_data, args.quiet, args.cache_dir,
+                      args.output_format)
+
+
+def _add_bundles_arguments(parser, required):
+    group = parser.add_mutually_exclusive_group(required=required)
+    group.add_argument('-d', type=str, dest='directory',
+                       help='Directory with one evidence bundle directory per TD')
+    group.add_argument('-s', type=str, dest='stream',
+                       help='File of JSON lines evidence bundles, "-" for stdin')
+    group.add_argument('-e', type=str, dest='evidence',
+                       help='File of compressed evidence bundle records, "-" for stdin')
+
+
+def _batch_verify_arguments(parser):
+    _add_bundles_arguments(parser, True)
+    parser.add_argument('-w', type=int, default=None, help='Number of worker processes',
+                        dest='workers')
+    parser.add_argument('-c', type=int, default=16, dest='chunksize',
+                        help='Number of bundles sent to a worker at once')
+    parser.add_argument('-m', type=int, default=1024, dest='cache_size',
+                        help='Number of results cached by each worker to skip the replay of '
+                             'duplicated event logs, 0 to disable the cache')
+    parser.add_argument('-C', type=str, dest='cache_dir',
+                        help='Also cache the results in the directory, across runs')
+    parser.add_argument('-o', type=str, help='Save the JSON lines results to the path',
+                        dest='output')
+
+
+def _run_batch_verify(args):
+    from .cli import TDXBatchVerifyCmd
+    TDXBatchVerifyCmd().run(args.directory, args.stream, args.evidence, args.workers,
+                            args.chunksize, args.cache_size, args.cache_dir, args.output)
+
+
+def _verify_quote_arguments(parser):
+    parser.add_argument('quotes', type=str, nargs='+', help='TD quote files')
+    parser.add_argument('-r', type=str, required=True, dest='root',
+                        help='PEM or DER file of the trusted root CA certificates')
+    parser.add_argument('-w', type=int, default=None, help='Number of worker processes',
+                        dest='workers')
+    parser.add_argument('-o', type=str, help='Save the JSON lines results to the path',
+                        dest='output')
+
+
+def _run_verify_quote(args):
+    from .cli import TDXQuoteVerifyCmd
+    TDXQuoteVerifyCmd().run(args.quotes, args.root, args.workers, args.output)
+
+
+def _eventlog_diff_arguments(parser):
+    parser.add_argument('reference', type=str, help='Event log file of the reference boot')
+    parser.add_argument('actual', type=str, help='Event log file to compare, "-" for stdin')
+    parser.add_argument('-a', type=str, choices=DIGEST_ALGORITHMS, default='sha384',
+                        help='Digest algorithm to compare', dest='algorithm')
+    parser.add_argument('-o', type=str, help='Save the JSON result to the path', dest='output')
+
+
+def _run_eventlog_diff(args):
+    from .cli import TDXEventLogDiffCmd
+    from .tdeventlog import TCGAlgorithmRegistry
+    algorithm = getattr(TCGAlgorithmRegistry, "TPM_ALG_" + args.algorithm.upper())
+    TDXEventLogDiffCmd().run(args.reference, args.actual, algorithm, args.output)
+
+
+def _appraise_arguments(parser):
+    parser.add_argument('-r', type=str, required=True, dest='store',
+                        help='SQLite file of the reference measurement store')
+    parser.add_argument('-m', type=str, action='append', dest='manifests',
+                        help='Load the JSON manifest into the store first, can be repeated')
+    _add_bundles_arguments(parser, False)
+    parser.add_argument('-w', type=int, default=1, help='Number of worker processes',
+                        dest='workers')
+    parser.add_argument('-o', type=str, help='Save the JSON lines results to the path',
+                        dest='output')
+
+
+def _run_appraise(args):
+    from .cli import TDXAppraiseCmd
+    TDXAppraiseCmd().run(args.store, args.manifests, args.directory, args.stream,
+                         args.evidence, args.workers, args.output)
+
+
+def _evidence_arguments(parser):
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-o', type=str, dest='output',
+                       help='Append the evidence bundles to the file, "-" for stdout')
+    group.add_argument('-l', type=str, dest='list',
+                       help='List the evidence bundles of the file')
+    parser.add_argument('-i', type=str, dest='bundle_id',
+                        help='Id of the collected bundle, the host name by default')
+    parser.add_argument('-n', type=str, dest='nonce',
+                        help='The base64 encoded nonce to be measured in report data')
+    parser.add_argument('-u', type=str, dest='user_data',
+                        help='The base64 encoded user data to be measured in report data')
+    parser.add_argument('-q', default=False, action='store_true', dest='no_quote',
+                        help='Do not get a TD quote for the collected bundle')
+    # evidence.COMPRESSIONS, not imported for the other subcommands
+    parser.add_argument('-z', type=str, choices=('lz4', 'none', 'zlib', 'zstd'), dest='compression',
+                        help='Compression of the bundles, zstd if installed, else zlib')
+    _add_bundles_arguments(parser, False)
+
+
+def _run_evidence(args):
+    from .cli import TDXEvidenceCmd
+    TDXEvidenceCmd().run(args.output, args.list, args.bundle_id, args.nonce, args.user_data,
+                         args.no_quote, args.compression, args.directory, args.stream,
+                         args.evidence)
+
+
+# name -> (description, function adding the arguments, function running it)
+SUBCOMMANDS = {
+    "eventlogs": ("The utility to dump TD event logs and replay RTMR",
+                  _eventlogs_arguments, _run_eventlogs),
+    "tdreport": ("The utility to dump the TD report in TD guest",
+                 _tdreport_arguments, _run_tdreport),
+    "verify-rtmr": ("The utility to verify RTMR with the TD event logs",
+                    _verify_rtmr_arguments, _run_verify_rtmr),
+    "extend-rtmr": ("The utility to write data into RTMR register",
+                    _extend_rtmr_arguments, _run_extend_rtmr),
+    "quote": ("The utility to get TD Quote in TD guest",
+              _quote_arguments, _run_quote),
+    "batch-verify": ("The utility to verify RTMR of collected TD evidence bundles offline",
+                     _batch_verify_arguments, _run_batch_verify),
+    "verify-quote": ("The utility to verify the signatures of TD quotes offline",
+                     _verify_quote_arguments, _run_verify_quote),
+    "eventlog-diff": ("The utility to diff a TD event log against the event log of a "
+                      "reference boot", _eventlog_diff_arguments, _run_eventlog_diff),
+    "appraise": ("The utility to appraise TD event logs against reference measurements",
+                 _appraise_arguments, _run_appraise),
+    "evidence": ("The utility to collect TD evidence bundles, or to pack collected ones, "
+                 "into a compressed evidence file", _evidence_arguments, _run_evidence),
+}
+
+
+def _configure_logging():
+    from .cli import configure_logging
+    configure_logging()
+
+
+def _run(args) -> int:
+    """
+    Run the subcommand of the parsed arguments, return the exit status
+    """
+    status = args.run(args)
+    return status if status is not None else 0
+
+
+def run_command(name: str, argv=None, prog: str = None) -> int:
+    """
+    Parse the arguments of one subcommand, sys.argv by default, and run it.
+    Return the exit status.
+    """
+    description, add_arguments, run = SUBCOMMANDS[name]
+    parser = argparse.ArgumentParser(prog=prog, description=description)
+    add_arguments(parser)
+    parser.set_defaults(run=run)
+    args = parser.parse_args(argv)
+    _configure_logging()
+    return _run(args)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Parser of tdxattest and all its subcommands
+    """
+    parser = argparse.ArgumentParser(prog="tdxattest", description="TDX attestation tools")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--serve', type=str, metavar='SOCKET', dest='serve',
+                       help='Serve the subcommands of clients on the unix socket')
+    group.add_argument('-S', '--socket', type=str, metavar='SOCKET', dest='socket',
+                       help='Run the subcommand in the server on the unix socket')
+    subparsers = parser.add_subparsers(dest='command', metavar='<subcommand>')
+    for name, (description, add_arguments, run) in SUBCOMMANDS.items():
+        subparser = subparsers.add_parser(name, help=description, description=description)
+        add_arguments(subparser)
+        subparser.set_defaults(run=run)
+    return parser
+
+
+def main(argv=None) -> int:
+    """
+    Entry point of tdxattest, return the exit status
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.serve is not None:
+        if args.command is not None:
+            parser.error("--serve takes no subcommand")
+        _configure_logging()
+        return serve(args.serve)
+    if args.command is None:
+        parser.error("a subcommand is required")
+    if args.socket is not None:
+        return run_client(args.socket, argv)
+    _configure_logging()
+    return _run(args)
+
+
+def _send_frame(sock, channel, payload):
+    sock.sendall(SERVE_FRAME_HEADER.pack(channel, len(payload)) + payload)
+
+
+def _recv_frame(sock, max_length=None):
+    from .qgs import recv_exact
+    channel, length = SERVE_FRAME_HEADER.unpack(recv_exact(sock, SERVE_FRAME_HEADER.size))
+    if max_length is not None and length > max_length:
+        raise ConnectionError(f"Invalid frame length {length}")
+    return channel, recv_exact(sock, length)
+
+
+class _FrameWriter(io.RawIOBase):
+    """
+    Output of a served subcommand, sent to the client in frames of a channel
+    """
+
+    def __init__(self, sock, channel):
+        super().__init__()
+        self._sock = sock
+        self._channel = channel
+
+    def writable(self):
+        return True
+
+    def write(self, data): # pylint: disable=arguments-renamed
+        _send_frame(self._sock, self._channel, bytes(data))
+        return len(data)
+
+
+def _open_channel(sock, channel):
+    return io.TextIOWrapper(io.BufferedWriter(_FrameWriter(sock, channel), SERVE_BUFFER_SIZE),
+                            encoding="utf-8")
+
+
+def _exit_status(code) -> int:
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write(f"{code}\n")
+    return 1
+
+
+class _ServeRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            channel, payload = _recv_frame(self.request, SERVE_REQUEST_MAX_LENGTH)
+            request = json.loads(payload)
+            if channel != SERVE_REQUEST or not isinstance(request.get("argv"), list):
+                raise ValueError("Not a request")
+        except (OSError, ConnectionError, ValueError, AttributeError) as err:
+            LOG.error("Invalid request: %s", err)
+            return
+        try:
+            status = self.server.run_request(request["argv"], request.get("cwd"), self.request)
+            _send_frame(self.request, SERVE_EXIT, SERVE_EXIT_STATUS.pack(status))
+        except OSError as err:
+            LOG.error("Client left: %s", err)
+
+
+class AttestationServer(socketserver.UnixStreamServer):
+    """
+    Resident tools on a unix socket, see the module documentation. The
+    requests are run one at a time, as the subcommands share the device,
+    the log and the standard streams of the process. The socket is only
+    accessible to the user running the server.
+    """
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _ServeRequestHandler)
+        finally:
+            os.umask(umask)
+        self.parser = build_parser()
+        self.requests = 0
+
+    def run_request(self, argv, cwd, sock) -> int:
+        """
+        Run the subcommand of a client with its stdout and stderr, and the
+        log, sent to the client. Return the exit status.
+        """
+        self.requests += 1
+        stdout = _open_channel(sock, SERVE_STDOUT)
+        stderr = _open_channel(sock, SERVE_STDERR)
+        saved = (sys.stdin, sys.stdout, sys.stderr, os.getcwd())
+        root = logging.getLogger()
+        level = root.level
+        handlers = [handler for handler in root.handlers
+                    if isinstance(handler, logging.StreamHandler)
+                    and not isinstance(handler, logging.FileHandler)]
+        streams = [handler.setStream(stderr) for handler in handlers]
+        sys.stdin, sys.stdout, sys.stderr = io.TextIOWrapper(io.BytesIO()), stdout, stderr
+        try:
+            if cwd is not None:
+                os.chdir(cwd)
+            args = self.parser.parse_args(argv)
+            if args.serve is not None or args.command is None:
+                self.parser.error("a subcommand is required")
+            status = _run(args)
+        except SystemExit as err:
+            status = _exit_status(err.code)
+        except Exception: # pylint: disable=broad-except
+            LOG.exception("Fail to run %s", " ".join(argv))
+            status = 1
+        finally:
+            for handler, stream in zip(handlers, streams):
+                handler.setStream(stream)
+            root.setLevel(level)
+            sys.stdin, sys.stdout, sys.stderr = saved[:3]
+            os.chdir(saved[3])
+            stdout.close()
+            stderr.close()
+        return status
+
+
+def serve(path: str) -> int:
+    """
+    Serve the subcommands of clients on the unix socket until interrupted
+    """
+    with AttestationServer(path) as server:
+        LOG.info("Serving on %s", path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+    LOG.info("Served %d requests", server.requests)
+    return 0
+
+
+def run_client(path: str, argv) -> int:
+    """
+    Run a subcommand in the server on the unix socket, with its output
+    written to stdout and stderr. Return its exit status.
+    """
+    payload = json.dumps({"argv": list(argv), "cwd": os.getcwd()}).encode()
+    outputs = {SERVE_STDOUT: sys.stdout.buffer, SERVE_STDERR: sys.stderr.buffer}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            _send_frame(sock, SERVE_REQUEST, payload)
+            while True:
+                channel, data = _recv_frame(sock)
+                if channel == SERVE_EXIT:
+                    status, = SERVE_EXIT_STATUS.unpack(data)
+                    return status
+                if channel not in outputs:
+                    raise ConnectionError(f"Invalid frame channel {channel}")
+                outputs[channel].write(data)
+    except (OSError, ConnectionError) as err:
+        sys.stderr.write(f"Fail to run the subcommand in {path}: {err}\n")
+        return 1
+    finally:
+        sys.stdout.buffer.flush()
+        sys.stderr.buffer.flush()
@@ -0,0 +1,257 @@
+"""
+Machine-readable output of the command line tools.
+
+The tools stream one record per event log entry, TD report or TD quote to
+stdout, through a large write buffer, in one of the formats:
+
+    json    one JSON array of all the records
+    ndjson  one JSON record per line
+    cbor    a sequence of CBOR data items, one per record (RFC 8742)
+
+A record is a dict, its "record" key tells its kind. Binary fields are
+bytes, written as hex strings in JSON and as byte strings in CBOR.
+"""
+
+import io
+import sys
+import json
+import struct
+from typing import Dict
+
+from .tdeventlog import TDEventLogEntry, TDEventLogType, TCGAlgorithmRegistry
+
+__author__ = "cpio"
+
+FORMAT_TEXT = "text"
+FORMAT_JSON = "json"
+FORMAT_NDJSON = "ndjson"
+FORMAT_CBOR = "cbor"
+OUTPUT_FORMATS = (FORMAT_TEXT, FORMAT_JSON, FORMAT_NDJSON, FORMAT_CBOR)
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+CBOR_UINT = 0
+CBOR_NEGINT = 1
+CBOR_BYTES = 2
+CBOR_TEXT = 3
+CBOR_ARRAY = 4
+CBOR_MAP = 5
+CBOR_FALSE = b"\xf4"
+CBOR_TRUE = b"\xf5"
+CBOR_NULL = b"\xf6"
+CBOR_FLOAT64 = struct.Struct(">Bd")
+
+
+def _cbor_head(major, value, out):
+    if value < 24:
+        out.append(major << 5 | value)
+    elif value < 0x100:
+        out += struct.pack(">BB", major << 5 | 24, value)
+    elif value < 0x10000:
+        out += struct.pack(">BH", major << 5 | 25, value)
+    elif value < 0x100000000:
+        out += struct.pack(">BI", major << 5 | 26, value)
+    elif value < 0x10000000000000000:
+        out += struct.pack(">BQ", major << 5 | 27, value)
+    else:
+        raise ValueError(f"Integer {value} is too large for CBOR")
+
+
+def _cbor_encode(obj, out): # pylint: disable=too-many-branches
+    # bool first, as it is an int
+    if obj is None:
+        out += CBOR_NULL
+    elif obj is True:
+        out += CBOR_TRUE
+    elif obj is False:
+        out += CBOR_FALSE
+    elif isinstance(obj, int):
+        if obj >= 0:
+            _cbor_head(CBOR_UINT, obj, out)
+        else:
+            _cbor_head(CBOR_NEGINT, -1 - obj, out)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        _cbor_head(CBOR_BYTES, len(obj) if not isinstance(obj, memoryview) else obj.nbytes, out)
+        out += obj
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        _cbor_head(CBOR_TEXT, len(data), out)
+        out += data
+    elif isinstance(obj, (list, tuple)):
+        _cbor_head(CBOR_ARRAY, len(obj), out)
+        for item in obj:
+            _cbor_encode(item, out)
+    elif isinstance(obj, dict):
+        _cbor_head(CBOR_MAP, len(obj), out)
+        for key, value in obj.items():
+            _cbor_encode(key, out)
+            _cbor_encode(value, out)
+    elif isinstance(obj, float):
+        out += CBOR_FLOAT64.pack(0xfb, obj)
+    else:
+        raise TypeError(f"Cannot encode {type(obj).__name__} in CBOR")
+
+
+def encode_cbor(obj) -> bytes:
+    """
+    Encode None, bool, int, float, bytes, str, list, tuple and dict values
+    as a CBOR data item, with definite lengths
+    """
+    out = bytearray()
+    _cbor_encode(obj, out)
+    return bytes(out)
+
+
+def _json_default(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return bytes(obj).hex()
+    raise TypeError(f"Cannot encode {type(obj).__name__} in JSON")
+
+
+class RecordWriter:
+    """
+    Write records to a binary stream, stdout by default, in one of the
+    machine-readable formats. The records are encoded one at a time and
+    go through a write buffer, so a long stream is never held in memory.
+    """
+
+    def __init__(self, output_format: str, stream=None, buffer_size: int = OUTPUT_BUFFER_SIZE):
+        if output_format not in (FORMAT_JSON, FORMAT_NDJSON, FORMAT_CBOR):
+            raise ValueError(f"Unsupported output format {output_format}")
+        self.output_format = output_format
+        self.count = 0
+        self._own_stream = False
+        if stream is None:
+            sys.stdout.flush()
+            try:
+                # closed by close(), without closing the file descriptor of stdout
+                stream = io.open(sys.stdout.fileno(), "wb", buffering=buffer_size, # pylint: disable=consider-using-with
+                                 closefd=False)
+                self._own_stream = True
+            except (AttributeError, io.UnsupportedOperation):
+                # stdout redirected to a stream without a file, as in serve mode
+                stream = sys.stdout.buffer
+        self._stream = stream
+        self._encoder = json.JSONEncoder(separators=(",", ":"), default=_json_default)
+
+    def write(self, record: Dict) -> None:
+        """
+        Write one record
+        """
+        if self.output_format == FORMAT_CBOR:
+            self._stream.write(encode_cbor(record))
+        elif self.output_format == FORMAT_NDJSON:
+            self._stream.write(self._encoder.encode(record).encode() + b"\n")
+        else:
+            separator = b",\n" if self.count > 0 else b"[\n"
+            self._stream.write(separator + self._encoder.encode(record).encode())
+        self.count += 1
+
+    def close(self) -> None:
+        """
+        End the output and flush it
+        """
+        if self._stream is None:
+            return
+        if self.output_format == FORMAT_JSON:
+            self._stream.write(b"\n]\n" if self.count > 0 else b"[]\n")
+        if self._own_stream:
+            self._stream.close()
+        else:
+            self._stream.flush()
+        self._stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def struct_record(view) -> Dict:
+    """
+    Fields of a StructView, as bytes
+    """
+    return {name: bytes(getattr(view, name)) for name in view.fields}
+
+
+def event_record(number: int, event) -> Dict:
+    """
+    Record of an event log entry or of the spec ID header, by its number in
+    the log as in the dump of the event logs
+    """
+    if not isinstance(event, TDEventLogEntry):
+        return {
+            "record": "specid",
+            "number": number,
+            "address": event.address,
+            "length": event.length,
+            "algorithms": {TCGAlgorithmRegistry.get_algorithm_string(algoid): size
+                           for algoid, size in event.digest_sizes.items()}
+        }
+    return {
+        "record": "event",
+        "number": number,
+        "address": event.address,
+        "length": event.length,
+        "rtmr": event.rtmr,
+        "type": event.etype,
+        "type_name": TDEventLogType.get_type_string(event.etype),
+        "digests": {TCGAlgorithmRegistry.get_algorithm_string(algoid): digest
+                    for algoid, digest in zip(event.algorithm_ids, event.digests)},
+        "event": bytes(event.event) if event.event is not None else b""
+    }
+
+
+def rtmr_record(index: int, algorithm: int, value: bytes) -> Dict:
+    """
+    Record of an RTMR value replayed from the event log
+    """
+    return {"record": "rtmr", "index": index,
+            "algorithm": TCGAlgorithmRegistry.get_algorithm_string(algorithm), "value": value}
+
+
+def ccel_record(ccel) -> Dict:
+    """
+    Record of the CCEL ACPI table
+    """
+    return {
+        "record": "ccel",
+        "revision": ccel.revision,
+        "length": ccel.length,
+        "checksum": ccel.checksum,
+        "oem_id": bytes(ccel.oem_id),
+        "cc_type": ccel.cc_type,
+        "cc_subtype": ccel.cc_subtype,
+        "log_area_minimum_length": ccel.log_area_minimum_length,
+        "log_area_start_address": ccel.log_area_start_address
+    }
+
+
+def tdreport_record(tdreport) -> Dict:
+    """
+    Record of a TD report with the fields of its structures
+    """
+    return {
+        "record": "tdreport",
+        "version": tdreport.version,
+        "report_mac_struct": struct_record(tdreport.report_mac_struct),
+        "tee_tcb_info": struct_record(tdreport.tee_tcb_info),
+        "td_info": struct_record(tdreport.td_info)
+    }
+
+
+def tdquote_record(tdquote) -> Dict:
+    """
+    Record of a TD quote with the fields of its header and body
+    """
+    return {
+        "record": "tdquote",
+        "quote_version": tdquote.quote_version,
+        "body_version": tdquote.body_version,
+        "length": tdquote.length,
+        "header": struct_record(tdquote.header),
+        "body": struct_record(tdquote.body),
+        # after the signed header and body, and the length of the signature data
+        "signature_data": bytes(tdquote.data[len(tdquote.signed_data) + 4:])
+    }
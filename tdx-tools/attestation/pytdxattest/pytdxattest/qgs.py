@@ -0,0 +1,347 @@
+"""
+Direct transport to the Quote Generation Service (QGS).
+
+The QGS messages are the ones the TDX guest driver forwards to the host for
+the GetQuote TDVMCALL, see
+https://github.com/intel/SGXDataCenterAttestationPrimitives (qgs_msg_lib).
+On the socket, each message is prefixed with its length as a 4-byte big
+endian integer, as in the GetQuote shared buffer.
+
+QgsClient talks to QGS over AF_VSOCK, by default on the host (CID 2) and
+port 4050, or over a unix socket. The connection is kept open across
+requests and several requests can be sent before reading their responses,
+which QGS returns in order. LocalQgsServer is a stand-in QGS on a unix
+socket for tests, answering with quotes built from the TD reports.
+"""
+
+import os
+import socket
+import struct
+import logging
+import threading
+import socketserver
+from typing import List
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+QGS_VSOCK_CID = 2
+QGS_VSOCK_PORT = 4050
+
+QGS_MSG_MAJOR_VERSION = 1
+QGS_MSG_MINOR_VERSION = 0
+QGS_MSG_GET_QUOTE_REQ = 0
+QGS_MSG_GET_QUOTE_RESP = 1
+QGS_MSG_ERROR_UNEXPECTED = 0x12001
+
+# qgs_msg_header_t: major_version, minor_version, type, size, error_code
+QGS_MSG_HEADER = struct.Struct("<2H3I")
+# qgs_msg_get_quote_req_t after the header: report_size, id_list_size
+QGS_MSG_QUOTE_REQ = struct.Struct("<2I")
+# qgs_msg_get_quote_resp_t after the header: selected_id_size, quote_size
+QGS_MSG_QUOTE_RESP = struct.Struct("<2I")
+QGS_FRAME_LENGTH = struct.Struct(">I")
+
+# Upper bound of a QGS message, to reject a corrupted length prefix
+QGS_MSG_MAX_LENGTH = 16 * 4096
+
+
+def qgs_msg_quote_req(tdreport) -> bytes:
+    """
+    Create the QGS message to get the quote of a TD report
+    qgs_msg_header_t & qgs_msg_get_quote_req_t
+    uint16_t major_version = 1;
+    uint16_t minor_version = 0;
+    uint32_t type = 0 (GET_QUOTE_REQ);
+    // size of the whole message, include this header, in byte
+    uint32_t size = header + report_size + id_list_size;
+    uint32_t error_code = 0; // used in response only
+
+    uint32_t report_size = report_size; // cannot be 0
+    uint32_t id_list_size = 0; // length of id_list, in byte, can be 0
+    uint8_t report_id_list[] = NULL;
+    """
+    tdreport = bytes(tdreport) if tdreport is not None else b""
+    msg_size = QGS_MSG_HEADER.size + QGS_MSG_QUOTE_REQ.size + len(tdreport)
+    return QGS_MSG_HEADER.pack(QGS_MSG_MAJOR_VERSION, QGS_MSG_MINOR_VERSION,
+                               QGS_MSG_GET_QUOTE_REQ, msg_size, 0) + \
+        QGS_MSG_QUOTE_REQ.pack(len(tdreport), 0) + tdreport
+
+
+def qgs_msg_quote_resp(buf):
+    """
+    Parse the quote from the QGS response message, or None if QGS failed
+    qgs_msg_header_t & qgs_msg_get_quote_resp_t
+    uint16_t major_version = 1;
+    uint16_t minor_version = 0;
+    uint32_t type = 1 (GET_QUOTE_RESP);
+    uint32_t size = header + quote;
+    uint32_t error_code = 0; // used in response only
+
+    uint32_t selected_id_size;  // can be 0 in case only one id is sent in request
+    uint32_t quote_size;        // length of quote_data, in byte
+    uint8_t id_quote[];         // selected id followed by quote
+    """
+    if len(buf) < QGS_MSG_HEADER.size + QGS_MSG_QUOTE_RESP.size:
+        LOG.error("QGS response is too short")
+        return None
+    major_version, _, msg_type, _, error_code = QGS_MSG_HEADER.unpack_from(buf)
+    if major_version != QGS_MSG_MAJOR_VERSION or msg_type != QGS_MSG_GET_QUOTE_RESP:
+        LOG.error("Unexpected QGS message version %d type %d", major_version, msg_type)
+        return None
+    if error_code != 0:
+        LOG.error("QGS failed to generate the quote, error 0x%X", error_code)
+        return None
+    selected_id_size, quote_size = QGS_MSG_QUOTE_RESP.unpack_from(buf, QGS_MSG_HEADER.size)
+    start = QGS_MSG_HEADER.size + QGS_MSG_QUOTE_RESP.size + selected_id_size
+    return bytes(buf[start:start + quote_size])
+
+
+def qgs_msg_quote_resp_create(quote, error_code=0) -> bytes:
+    """
+    Create the QGS response message with the quote, used by LocalQgsServer
+    """
+    quote = bytes(quote) if quote is not None else b""
+    msg_size = QGS_MSG_HEADER.size + QGS_MSG_QUOTE_RESP.size + len(quote)
+    return QGS_MSG_HEADER.pack(QGS_MSG_MAJOR_VERSION, QGS_MSG_MINOR_VERSION,
+                               QGS_MSG_GET_QUOTE_RESP, msg_size, error_code) + \
+        QGS_MSG_QUOTE_RESP.pack(0, len(quote)) + quote
+
+
+def qgs_msg_quote_req_report(buf):
+    """
+    Get the TD report from the QGS request message, used by LocalQgsServer
+    """
+    _, _, msg_type, _, _ = QGS_MSG_HEADER.unpack_from(buf)
+    if msg_type != QGS_MSG_GET_QUOTE_REQ:
+        raise ValueError(f"Unexpected QGS message type {msg_type}")
+    report_size, _ = QGS_MSG_QUOTE_REQ.unpack_from(buf, QGS_MSG_HEADER.size)
+    start = QGS_MSG_HEADER.size + QGS_MSG_QUOTE_REQ.size
+    return bytes(buf[start:start + report_size])
+
+
+def recv_exact(sock, length):
+    """
+    Receive exactly length bytes from a stream socket
+    """
+    buf = bytearray(length)
+    view = memoryview(buf)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += count
+    return buf
+
+
+def recv_frame(sock):
+    """
+    Receive one length prefixed QGS message
+    """
+    length, = QGS_FRAME_LENGTH.unpack(recv_exact(sock, QGS_FRAME_LENGTH.size))
+    if length > QGS_MSG_MAX_LENGTH:
+        raise ConnectionError(f"Invalid QGS message length {length}")
+    return recv_exact(sock, length)
+
+
+def frame(msg) -> bytes:
+    """
+    Prefix a QGS message with its length
+    """
+    return QGS_FRAME_LENGTH.pack(len(msg)) + msg
+
+
+class QgsClient:
+    """
+    Client of QGS over AF_VSOCK, with address (cid, port), or over a unix
+    socket, with the path of the socket as address.
+
+    The connection is opened on the first request and kept for the next
+    ones. get_quotes() sends up to pipeline_depth requests before reading
+    their responses. If the connection breaks, it is opened again and the
+    requests without a response are sent once more. The client can be
+    shared across threads, requests are serialized on the connection.
+    """
+
+    def __init__(self, address=(QGS_VSOCK_CID, QGS_VSOCK_PORT), timeout=30.0,
+                 pipeline_depth=8):
+        self.address = address
+        self._timeout = timeout
+        self._pipeline_depth = max(1, pipeline_depth)
+        self._sock = None
+        self._lock = threading.Lock()
+        self.connections = 0
+
+    def _connect(self):
+        if isinstance(self.address, (str, bytes, os.PathLike)):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            if not hasattr(socket, "AF_VSOCK"):
+                raise OSError("AF_VSOCK is not supported on this platform")
+            sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM) # pylint: disable=no-member
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self.connections += 1
+
+    def _close_locked(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _exchange(self, tdreports):
+        if self._sock is None:
+            self._connect()
+        self._sock.sendall(b"".join(frame(qgs_msg_quote_req(tdreport))
+                                    for tdreport in tdreports))
+        return [qgs_msg_quote_resp(recv_frame(self._sock)) for _ in tdreports]
+
+    def _get_quotes_locked(self, tdreports):
+        quotes = []
+        while len(quotes) < len(tdreports):
+            window = tdreports[len(quotes):len(quotes) + self._pipeline_depth]
+            try:
+                quotes += self._exchange(window)
+            except (OSError, ConnectionError):
+                # the connection may have been closed by QGS while idle
+                self._close_locked()
+                try:
+                    quotes += self._exchange(window)
+                except (OSError, ConnectionError) as err:
+                    self._close_locked()
+                    LOG.error("Fail to get quotes from QGS at %s: %s", self.address, err)
+                    quotes += [None] * len(window)
+        return quotes
+
+    def get_quote(self, tdreport):
+        """
+        Get the quote of a TD report, or None on failure
+        """
+        return self.get_quotes([tdreport])[0]
+
+    def get_quotes(self, tdreports) -> List:
+        """
+        Get the quotes of the TD reports over the same connection, pipelined.
+        A failed quote is None in the returned list.
+        """
+        tdreports = list(tdreports)
+        with self._lock:
+            return self._get_quotes_locked(tdreports)
+
+    def close(self):
+        """
+        Close the connection to QGS
+        """
+        with self._lock:
+            self._close_locked()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def build_unsigned_quote(tdreport) -> bytes:
+    """
+    Build a TD quote v4 with the measurements of a TDX 1.0 layout TD report
+    and an empty signature, as returned by LocalQgsServer. It is parsed as a
+    real quote, but it is not signed and fails verification.
+    """
+    tdreport = bytes(tdreport)
+    tee_tcb_info = tdreport[0x100:0x1ef]
+    td_info = tdreport[0x200:0x400]
+    header = struct.pack("<2HI2H", 4, 2, 0x81, 0, 0) + bytes(16 + 20)
+    body = tee_tcb_info[0x8:0x18] + tee_tcb_info[0x18:0x78] + tee_tcb_info[0x78:0x80] + \
+        td_info[0x0:0x8] + td_info[0x8:0x190] + tdreport[0x80:0xc0]
+    # signature, attestation key, then the QE report certification data
+    # with the QE report, its signature, no auth data and no PCK chain
+    qe_cert_data = bytes(0x180 + 0x40) + struct.pack("<H", 0) + struct.pack("<HI", 5, 0)
+    signature_data = bytes(0x80) + struct.pack("<HI", 6, len(qe_cert_data)) + qe_cert_data
+    return header + body + struct.pack("<I", len(signature_data)) + signature_data
+
+
+class _QgsRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        server.active.add(self.request)
+        try:
+            self._serve(server)
+        finally:
+            server.active.discard(self.request)
+
+    def _serve(self, server):
+        while True:
+            try:
+                msg = recv_frame(self.request)
+            except (OSError, ConnectionError):
+                return
+            server.requests += 1
+            try:
+                quote = server.quote_generator(qgs_msg_quote_req_report(msg))
+                resp = qgs_msg_quote_resp_create(quote)
+            except (ValueError, struct.error) as err:
+                LOG.error("Fail to generate quote: %s", err)
+                resp = qgs_msg_quote_resp_create(None, QGS_MSG_ERROR_UNEXPECTED)
+            self.request.sendall(frame(resp))
+
+
+class LocalQgsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Stand-in QGS on a unix socket, serving each connection in a thread
+    until the client closes it. quote_generator turns a TD report into the
+    quote bytes, build_unsigned_quote by default. The numbers of connections
+    and requests served are counted.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, quote_generator=build_unsigned_quote):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, _QgsRequestHandler)
+        self.quote_generator = quote_generator
+        self.connections = 0
+        self.requests = 0
+        # connections being served, closed with the server
+        self.active = set()
+        self._thread = None
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """
+        Stop serving, close the connections and remove the socket
+        """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        for sock in list(self.active):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,330 @@
+"""
+Offline verification of the ECDSA signatures of TD quotes.
+
+A quote is verified against locally supplied trusted root CA certificates,
+without calling an external service:
+
+    1. the PCK certificate chain in the quote chains up to a trusted root,
+       each issuer is a CA allowed to sign certificates at its depth in the
+       chain, and each certificate is in its validity period
+    2. the QE report is signed by the PCK key
+    3. the QE report data binds the attestation key:
+       SHA-256(attestation_key || qe_auth_data) || 32 zero bytes
+    4. the quote header and body are signed by the attestation key
+
+The TCB status of the platform, i.e. the TCB info, QE identity and CRL
+collateral, is not appraised here.
+
+Certificate chains, public keys and verified QE reports are memoized by
+fingerprint, as all the quotes from a platform carry the same ones, so a
+quote from a known platform costs a single ECDSA verification. The
+cryptography package is an optional dependency, only needed by this module.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+except ImportError:
+    x509 = None
+
+from .batch import STATUS_PASS, STATUS_FAIL, STATUS_ERROR, iter_chunks
+from .cache import LRUCache
+from .tdquote import TdQuote, ATTESTATION_KEY_TYPE_ECDSA_P256, \
+    CERT_DATA_TYPE_PCK_CERT_CHAIN, ECDSA_SIGNATURE_LENGTH
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+PEM_END_CERTIFICATE = b"-----END CERTIFICATE-----"
+
+CHECK_PCK_CERT_CHAIN = "pck_cert_chain"
+CHECK_QE_REPORT_SIGNATURE = "qe_report_signature"
+CHECK_QE_REPORT_DATA = "qe_report_data"
+CHECK_QUOTE_SIGNATURE = "quote_signature"
+
+
+def _require_cryptography():
+    if x509 is None:
+        raise ImportError("cryptography is required to verify quotes, "
+                          "please install pytdxattest[verify]")
+
+
+def _fingerprint(data) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def _verify_raw_signature(public_key, signature, data) -> bool:
+    """
+    Verify an ECDSA P-256 SHA-256 signature given as r || s
+    """
+    half = ECDSA_SIGNATURE_LENGTH // 2
+    der_signature = encode_dss_signature(
+        int.from_bytes(signature[:half], "big"), int.from_bytes(signature[half:], "big"))
+    try:
+        public_key.verify(der_signature, bytes(data), ec.ECDSA(hashes.SHA256()))
+    except InvalidSignature:
+        return False
+    return True
+
+
+def split_pem_chain(pem_chain) -> List[bytes]:
+    """
+    Split a PEM certificate chain into one PEM block per certificate
+    """
+    blocks = []
+    for block in bytes(pem_chain).split(PEM_END_CERTIFICATE):
+        block = block.strip(b"\0\r\n ")
+        if block:
+            blocks.append(block + b"\n" + PEM_END_CERTIFICATE + b"\n")
+    return blocks
+
+
+class QuoteVerifier:
+    """
+    Verifier of TD quote signatures against a set of trusted root CA
+    certificates, given as PEM or DER bytes.
+
+    The verifier keeps bounded caches of the certificate chains it has
+    verified, the attestation keys and the QE reports, keyed by the SHA-256
+    fingerprint of their bytes. A verified chain is checked again against
+    the time of each quote verification.
+    """
+
+    def __init__(self, trusted_roots: Iterable[bytes], cache_size: int = 1024):
+        _require_cryptography()
+        self._trusted_roots = {}
+        for root in trusted_roots:
+            certificate = self._load_certificate(root)
+            der = certificate.public_bytes(serialization.Encoding.DER)
+            self._trusted_roots[_fingerprint(der)] = certificate
+        if not self._trusted_roots:
+            raise ValueError("No trusted root certificate")
+        # fingerprint of the PEM chain -> (certificates, PCK public key)
+        self._chains = LRUCache(cache_size)
+        # attestation key bytes -> public key
+        self._attestation_keys = LRUCache(cache_size)
+        # fingerprint of the QE report, its signature and the PCK chain
+        self._qe_reports = LRUCache(cache_size)
+
+    @staticmethod
+    def _load_certificate(data):
+        data = bytes(data)
+        if data.lstrip().startswith(b"-----BEGIN"):
+            return x509.load_pem_x509_certificate(data)
+        return x509.load_der_x509_certificate(data)
+
+    @staticmethod
+    def from_root_file(path: str, cache_size: int = 1024):
+        """
+        Create a verifier trusting the root certificates in a PEM or DER file
+        """
+        with open(path, "rb") as fobj:
+            data = fobj.read()
+        roots = split_pem_chain(data) if PEM_END_CERTIFICATE in data else [data]
+        return QuoteVerifier(roots, cache_size)
+
+    @property
+    def trusted_roots(self) -> List[bytes]:
+        """
+        The trusted root certificates in PEM
+        """
+        return [certificate.public_bytes(serialization.Encoding.PEM)
+                for certificate in self._trusted_roots.values()]
+
+    @staticmethod
+    def _is_valid_at(certificate, now) -> bool:
+        if hasattr(certificate, "not_valid_before_utc"):
+            return certificate.not_valid_before_utc <= now <= certificate.not_valid_after_utc
+        now = now.replace(tzinfo=None)
+        return certificate.not_valid_before <= now <= certificate.not_valid_after
+
+    @staticmethod
+    def _is_ca_at(issuer, depth) -> bool:
+        """
+        Whether the certificate may issue certificates with depth CA
+        certificates below it: CA:TRUE and a path length of at least depth
+        in its basic constraints, and the keyCertSign key usage
+        """
+        try:
+            constraints = issuer.extensions.get_extension_for_class(x509.BasicConstraints).value
+            key_usage = issuer.extensions.get_extension_for_class(x509.KeyUsage).value
+        except x509.ExtensionNotFound:
+            return False
+        return constraints.ca and key_usage.key_cert_sign and \
+            (constraints.path_length is None or constraints.path_length >= depth)
+
+    def _is_issued_by(self, certificate, issuer, depth) -> bool:
+        try:
+            certificate.verify_directly_issued_by(issuer)
+        except (ValueError, TypeError, InvalidSignature):
+            return False
+        return self._is_ca_at(issuer, depth)
+
+    def _verify_chain(self, pem_chain):
+        """
+        Verify the PCK certificate chain up to a trusted root, return the
+        certificates from the PCK certificate up, or None if not trusted
+        """
+        certificates = [x509.load_pem_x509_certificate(block)
+                        for block in split_pem_chain(pem_chain)]
+        if not certificates:
+            return None
+
+        # the issuer at depth d has d CA certificates below it, the PCK
+        # certificate excluded
+        for depth, (certificate, issuer) in enumerate(zip(certificates, certificates[1:])):
+            if not self._is_issued_by(certificate, issuer, depth):
+                LOG.error("Certificate %s is not issued by the CA %s",
+                          certificate.subject.rfc4514_string(), issuer.subject.rfc4514_string())
+                return None
+
+        # the last certificate is either a trusted root or issued by one
+        last = certificates[-1]
+        if _fingerprint(last.public_bytes(serialization.Encoding.DER)) in self._trusted_roots:
+            return certificates
+        for root in self._trusted_roots.values():
+            if self._is_issued_by(last, root, len(certificates) - 1):
+                return certificates + [root]
+        LOG.error("Certificate chain does not end at a trusted root")
+        return None
+
+    def _get_pck_key(self, pem_chain, now):
+        key = _fingerprint(pem_chain)
+        entry = self._chains.get(key)
+        if entry is None:
+            certificates = self._verify_chain(pem_chain)
+            if certificates is None:
+                return None
+            entry = (certificates, certificates[0].public_key())
+            self._chains.put(key, entry)
+
+        certificates, pck_key = entry
+        for certificate in certificates:
+            if not self._is_valid_at(certificate, now):
+                LOG.error("Certificate %s is expired or not yet valid",
+                          certificate.subject.rfc4514_string())
+                return None
+        return pck_key
+
+    def _get_attestation_key(self, raw_key):
+        raw_key = bytes(raw_key)
+        public_key = self._attestation_keys.get(raw_key)
+        if public_key is None:
+            public_key = ec.EllipticCurvePublicKey.from_encoded_point(
+                ec.SECP256R1(), b"\x04" + raw_key)
+            self._attestation_keys.put(raw_key, public_key)
+        return public_key
+
+    def _verify_qe_report(self, signature_data, pck_key, chain_key) -> bool:
+        qe_report = signature_data.qe_report.data
+        qe_report_signature = signature_data.qe_report_signature
+        key = _fingerprint(bytes(qe_report) + bytes(qe_report_signature) + chain_key)
+        if self._qe_reports.get(key) is not None:
+            return True
+        if not _verify_raw_signature(pck_key, qe_report_signature, qe_report):
+            return False
+        self._qe_reports.put(key, True)
+        return True
+
+    @staticmethod
+    def _verify_qe_report_data(signature_data) -> bool:
+        expected = hashlib.sha256(bytes(signature_data.attestation_key) +
+                                  bytes(signature_data.qe_auth_data)).digest()
+        report_data = signature_data.qe_report.report_data
+        return report_data[:32] == expected and not any(report_data[32:])
+
+    def verify(self, quote, now: datetime.datetime = None) -> Dict:
+        """
+        Verify the signatures of a quote, a TdQuote or its bytes, at the given
+        time or now. Return one result record with the status and the result
+        of each check. Checks after a failed one are not run.
+        """
+        _require_cryptography()
+        result = {"status": STATUS_ERROR, "checks": {}}
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            if not isinstance(quote, TdQuote):
+                quote = TdQuote(quote)
+            result["report_data"] = quote.report_data.hex()
+            if int.from_bytes(quote.header.attestation_key_type, "little") != \
+                    ATTESTATION_KEY_TYPE_ECDSA_P256:
+                raise ValueError("Unsupported attestation key type")
+            signature_data = quote.signature_data
+            if signature_data.pck_cert_data_type != CERT_DATA_TYPE_PCK_CERT_CHAIN:
+                raise ValueError("Quote does not carry the PCK certificate chain")
+
+            checks = result["checks"]
+            pem_chain = bytes(signature_data.pck_cert_chain)
+            pck_key = self._get_pck_key(pem_chain, now)
+            checks[CHECK_PCK_CERT_CHAIN] = pck_key is not None
+            if pck_key is not None:
+                checks[CHECK_QE_REPORT_SIGNATURE] = self._verify_qe_report(
+                    signature_data, pck_key, _fingerprint(pem_chain))
+            if checks.get(CHECK_QE_REPORT_SIGNATURE):
+                checks[CHECK_QE_REPORT_DATA] = self._verify_qe_report_data(signature_data)
+            if checks.get(CHECK_QE_REPORT_DATA):
+                checks[CHECK_QUOTE_SIGNATURE] = _verify_raw_signature(
+                    self._get_attestation_key(signature_data.attestation_key),
+                    signature_data.signature, quote.signed_data)
+            passed = len(checks) == 4 and all(checks.values())
+            result["status"] = STATUS_PASS if passed else STATUS_FAIL
+        except (AssertionError, ValueError, TypeError) as err:
+            result["error"] = f"{type(err).__name__}: {err}"
+        return result
+
+    def verify_batch(self, quotes: Iterable, workers: int = None,
+                     chunksize: int = 64) -> Iterator[Dict]:
+        """
+        Verify many quotes in bytes over a pool of worker processes, each with
+        its own verifier and caches. Results are yielded in the order of the
+        input, with the position of the quote as id.
+        """
+        workers = workers or os.cpu_count() or 1
+        started = time.monotonic()
+        count = 0
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(self.trusted_roots,)) as executor:
+            for chunk in iter_chunks((bytes(quote) for quote in quotes), chunksize):
+                pending.append(executor.submit(_verify_chunk, chunk, count))
+                count += len(chunk)
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+        seconds = max(time.monotonic() - started, 1e-9)
+        LOG.info("Verified %d quotes in %.3f s, %.1f quotes/s", count, seconds, count / seconds)
+
+
+# Verifier of a worker process, created once by the pool initializer so that
+# its caches are shared by all the chunks the worker verifies
+_WORKER_VERIFIER = None
+
+
+def _init_worker(trusted_roots):
+    global _WORKER_VERIFIER # pylint: disable=global-statement
+    _WORKER_VERIFIER = QuoteVerifier(trusted_roots)
+
+
+def _verify_chunk(quotes: List[bytes], first: int) -> List[Dict]:
+    results = []
+    for number, quote in enumerate(quotes, first):
+        result = _WORKER_VERIFIER.verify(quote)
+        result["id"] = number
+        results.append(result)
+    return results
@@ -0,0 +1,302 @@
+"""
+Store of reference measurements, to appraise event logs against allow-lists
+of known-good digests such as OVMF, shim, grub and kernel builds.
+
+The store is a SQLite database with an index on the digest. It is filled
+from JSON manifests, one per component release:
+
+    {
+        "name": "ovmf-stable",
+        "version": "2024.02",
+        "measurements": [
+            {"digest": "<hex>", "algorithm": "sha384", "rtmr": 0,
+             "component": "OVMF"}
+        ]
+    }
+
+The algorithm defaults to sha384. A measurement with an RTMR index only
+matches entries extended into that RTMR, one without matches any. Loading
+a manifest again replaces its previous measurements.
+
+The appraisal looks up the distinct digests of an event log in batches of
+indexed queries, and the lookups are memoized across logs, so appraising
+many logs of the same fleet mostly hits the memo.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List
+
+from .actor import TDEventLogActor
+from .batch import STATUS_PASS, STATUS_FAIL, STATUS_ERROR, iter_chunks, load_bundle_dir
+from .cache import LRUCache
+from .tdeventlog import TCGAlgorithmRegistry
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+ALGORITHM_IDS = {
+    "sha256": TCGAlgorithmRegistry.TPM_ALG_SHA256,
+    "sha384": TCGAlgorithmRegistry.TPM_ALG_SHA384,
+    "sha512": TCGAlgorithmRegistry.TPM_ALG_SHA512
+}
+
+# Number of digests looked up per query, below the SQLite variable limit
+LOOKUP_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifests (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    version TEXT,
+    loaded REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    digest BLOB NOT NULL,
+    algorithm INTEGER NOT NULL,
+    rtmr INTEGER,
+    component TEXT,
+    manifest_id INTEGER NOT NULL REFERENCES manifests(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS measurements_digest ON measurements(digest, algorithm);
+CREATE INDEX IF NOT EXISTS measurements_manifest ON measurements(manifest_id);
+"""
+
+
+class ReferenceStore:
+    """
+    SQLite store of reference measurements, see the module documentation.
+    The path ":memory:" keeps the store in the process only.
+    """
+
+    def __init__(self, path: str = ":memory:", cache_size: int = 65536):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(SCHEMA)
+        # (algorithm, digest) -> tuple of (rtmr, manifest, component)
+        self._lookups = LRUCache(cache_size)
+
+    def close(self):
+        """
+        Close the database
+        """
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def load_manifest(self, manifest) -> int:
+        """
+        Load a manifest, a dict or the path of its JSON file, replacing the
+        measurements of a manifest of the same name. Return the number of
+        measurements loaded.
+        """
+        if not isinstance(manifest, dict):
+            with open(manifest, "r", encoding="utf-8") as fobj:
+                manifest = json.load(fobj)
+
+        rows = []
+        for measurement in manifest.get("measurements", []):
+            algorithm = measurement.get("algorithm", "sha384")
+            if algorithm not in ALGORITHM_IDS:
+                raise ValueError(f"Unsupported digest algorithm {algorithm}")
+            rtmr = measurement.get("rtmr")
+            rows.append((bytes.fromhex(measurement["digest"]), ALGORITHM_IDS[algorithm],
+                         int(rtmr) if rtmr is not None else None,
+                         measurement.get("component")))
+
+        with self._connection:
+            self._connection.execute("DELETE FROM manifests WHERE name = ?",
+                                     (manifest["name"],))
+            cursor = self._connection.execute(
+                "INSERT INTO manifests (name, version, loaded) VALUES (?, ?, ?)",
+                (manifest["name"], manifest.get("version"), time.time()))
+            manifest_id = cursor.lastrowid
+            self._connection.executemany(
+                "INSERT INTO measurements (digest, algorithm, rtmr, component, manifest_id) "
+                "VALUES (?, ?, ?, ?, ?)", [row + (manifest_id,) for row in rows])
+        self._lookups.clear()
+        LOG.info("Loaded %d measurements of manifest %s", len(rows), manifest["name"])
+        return len(rows)
+
+    def remove_manifest(self, name: str) -> None:
+        """
+        Remove a manifest and its measurements
+        """
+        with self._connection:
+            self._connection.execute("DELETE FROM manifests WHERE name = ?", (name,))
+        self._lookups.clear()
+
+    def manifests(self) -> List[Dict]:
+        """
+        The manifests in the store, with their number of measurements
+        """
+        cursor = self._connection.execute(
+            "SELECT name, version, loaded, "
+            "(SELECT COUNT(*) FROM measurements WHERE manifest_id = manifests.id) "
+            "FROM manifests ORDER BY name")
+        return [{"name": name, "version": version, "loaded": loaded, "measurements": count}
+                for name, version, loaded, count in cursor]
+
+    def lookup_many(self, digests: Iterable[bytes],
+                    algorithm: int = TCGAlgorithmRegistry.TPM_ALG_SHA384) -> Dict[bytes, tuple]:
+        """
+        Look up digests, return the (rtmr, manifest, component) references
+        of each one, an empty tuple for an unknown digest
+        """
+        found = {}
+        missing = []
+        for digest in set(digests):
+            references = self._lookups.get((algorithm, digest))
+            if references is None:
+                missing.append(digest)
+            else:
+                found[digest] = references
+
+        for batch in iter_chunks(missing, LOOKUP_BATCH):
+            references = {digest: [] for digest in batch}
+            cursor = self._connection.execute(
+                "SELECT measurements.digest, measurements.rtmr, manifests.name, "
+                "measurements.component FROM measurements "
+                "JOIN manifests ON manifests.id = measurements.manifest_id "
+                "WHERE measurements.algorithm = ? AND measurements.digest IN "
+                f"({', '.join('?' * len(batch))})", [algorithm] + batch)
+            for digest, rtmr, name, component in cursor:
+                references[digest].append((rtmr, name, component))
+            for digest, digest_references in references.items():
+                found[digest] = tuple(digest_references)
+                self._lookups.put((algorithm, digest), found[digest])
+        return found
+
+    def lookup(self, digest, algorithm: int = TCGAlgorithmRegistry.TPM_ALG_SHA384) -> tuple:
+        """
+        References of a digest, as bytes or hex string
+        """
+        if isinstance(digest, str):
+            digest = bytes.fromhex(digest)
+        return self.lookup_many([bytes(digest)], algorithm)[bytes(digest)]
+
+    def appraise(self, actor: TDEventLogActor, etypes: Iterable[int] = None,
+                 algorithm: int = TCGAlgorithmRegistry.TPM_ALG_SHA384) -> Dict:
+        """
+        Appraise the entries of an event log, or those of the given event
+        types, against the store. The log passes if every entry appraised
+        has a reference for its RTMR. Return one result record with the
+        unknown entries as [number, rtmr, event type, digest] and the
+        number of entries matched per manifest.
+        """
+        etypes = set(etypes) if etypes is not None else None
+        index = actor.get_index()
+        if len(index) == 0:
+            raise ValueError("No entry in the event log")
+        entries = []
+        for number in range(len(index)):
+            entry = index.get_entry(number)
+            if etypes is None or entry.etype in etypes:
+                entries.append((number, entry.rtmr, entry.etype,
+                                entry.get_digest(algorithm) or b""))
+
+        references = self.lookup_many((entry[3] for entry in entries), algorithm)
+        result = {"status": STATUS_FAIL, "events": len(entries), "matched": 0,
+                  "unknown": [], "manifests": {}}
+        for number, rtmr, etype, digest in entries:
+            names = {name for ref_rtmr, name, _ in references[digest]
+                     if ref_rtmr is None or ref_rtmr == rtmr}
+            if not names:
+                result["unknown"].append([number, rtmr, etype, digest.hex()])
+                continue
+            result["matched"] += 1
+            for name in names:
+                result["manifests"][name] = result["manifests"].get(name, 0) + 1
+        if not result["unknown"]:
+            result["status"] = STATUS_PASS
+        return result
+
+    def appraise_log(self, log, etypes: Iterable[int] = None,
+                     algorithm: int = TCGAlgorithmRegistry.TPM_ALG_SHA384) -> Dict:
+        """
+        Appraise an event log in bytes, a dict with its "id" and "eventlog",
+        or the path of a bundle directory, see appraise. Errors are reported
+        in the result.
+        """
+        log_id = None
+        try:
+            if isinstance(log, str):
+                log_id = os.path.basename(os.path.normpath(log))
+                log = load_bundle_dir(log, with_tdreport=False)
+            if isinstance(log, dict):
+                log_id, log = log.get("id"), log.get("eventlog")
+            if log is None:
+                raise ValueError("No event log in the bundle")
+            result = self.appraise(TDEventLogActor(0, None, data=log), etypes, algorithm)
+        except (AssertionError, KeyError, OSError, ValueError) as err:
+            result = {"status": STATUS_ERROR, "error": f"{type(err).__name__}: {err}"}
+        result["id"] = log_id
+        return result
+
+    def appraise_batch(self, logs: Iterable, etypes: Iterable[int] = None,
+                       algorithm: int = TCGAlgorithmRegistry.TPM_ALG_SHA384,
+                       workers: int = 1, chunksize: int = 16) -> Iterator[Dict]:
+        """
+        Appraise many event logs, see appraise_log, sharing the memoized
+        lookups. With several workers, the logs are spread over worker
+        processes each opening the store file, which must not be
+        ":memory:". Results are yielded in the order of the input, with the
+        position of the log as id if it has none.
+        """
+        etypes = list(etypes) if etypes is not None else None
+        started = time.monotonic()
+        count = 0
+        if workers <= 1:
+            for count, log in enumerate(logs, 1):
+                yield _with_id(self.appraise_log(log, etypes, algorithm), count - 1)
+        else:
+            if self.path == ":memory:":
+                raise ValueError("An in-memory store cannot be shared with worker processes")
+            pending = deque()
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self.path,)) as executor:
+                for chunk in iter_chunks(logs, chunksize):
+                    pending.append(executor.submit(_appraise_chunk, chunk, count,
+                                                   etypes, algorithm))
+                    count += len(chunk)
+                    if len(pending) >= workers * 2:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+
+        seconds = max(time.monotonic() - started, 1e-9)
+        LOG.info("Appraised %d event logs in %.3f s, %.1f logs/s", count, seconds, count / seconds)
+
+
+def _with_id(result: Dict, number: int) -> Dict:
+    if result.get("id") is None:
+        result["id"] = number
+    return result
+
+
+# Store of a worker process, opened once by the pool initializer so that its
+# memoized lookups are shared by all the chunks the worker appraises
+_WORKER_STORE = None
+
+
+def _init_worker(path):
+    global _WORKER_STORE # pylint: disable=global-statement
+    if not os.path.exists(path):
+        raise OSError(f"Reference store {path} does not exist")
+    _WORKER_STORE = ReferenceStore(path)
+
+
+def _appraise_chunk(logs: List, first: int, etypes, algorithm) -> List[Dict]:
+    return [_with_id(_WORKER_STORE.appraise_log(log, etypes, algorithm), number)
+            for number, log in enumerate(logs, first)]
@@ -3,11 +3,11 @@ RTMR data structures
 """
 
 import os
-import fcntl
 import struct
 import logging
 import hashlib
 from .binaryblob import BinaryBlob
+from .device import get_device_backend
 
 __author__ = 'cpio'
 LOG = logging.getLogger(__name__)
@@ -39,24 +39,6 @@ class RTMR(BinaryBlob):
         """
         Perform ioctl on the device file /dev/tdx_guest to extend rtmr
         """
-        if not os.path.exists(RTMR.TDX_ATTEST_FILE):
-            LOG.error("Could not find device node %s. Kernel version 6.2 above supports RTMR write",
-                      RTMR.TDX_ATTEST_FILE)
-            return None
-
-        try:
-            fd_tdx_attest = os.open(RTMR.TDX_ATTEST_FILE, os.O_RDWR)
-        except (PermissionError, IOError, OSError):
-            LOG.error("Fail to open file %s", RTMR.TDX_ATTEST_FILE)
-            return None
-
-        #Perform extend through ioctl call
-        #Reference: Structure of tdx_extend_rtmr_req in /include/uapi/linux/tdx-guest.h
-        #struct tdx_extend_rtmr_req {
-        #    __u8 data[TDX_EXTEND_RTMR_DATA_LEN];
-        #    __u8 index;
-        #};
-
         extend_data = bytearray(64)
 
         if str_extend_data is not None:
@@ -73,18 +55,120 @@ class RTMR(BinaryBlob):
                 LOG.error("Invalid length for the extend data. Should be 48B length.")
                 return RTMR.EXTEND_FAILURE_WITH_WRONG_INPUT
 
-        req = struct.pack("@48sB", extend_data, int(extend_rtmr_index))
+        with RTMRExtender() as extender:
+            if not extender.is_open:
+                return None
+            if not extender.extend(extend_data, extend_rtmr_index):
+                return RTMR.EXTEND_FAILURE
 
-        #Reference: command used for tdx rtmr extend defined in /include/uapi/linux/tdx-guest.h
-        #define TDX_CMD_EXTEND_RTMR		_IOR('T', 3, struct tdx_extend_rtmr_req)
+        LOG.info("RTMR extend success.")
+        return RTMR.EXTEND_SUCCESS
+
+    @staticmethod
+    def extend_rtmr_digests(digests, extend_rtmr_index, extender=None):
+        """
+        Extend the SHA384 digests in order into the rtmr, opening the device
+        file once for all of them unless an open RTMRExtender is given.
+        Return the number of digests extended, which stops at the first
+        failure.
+        """
+        if extender is None:
+            with RTMRExtender() as own_extender:
+                return RTMR.extend_rtmr_digests(digests, extend_rtmr_index, own_extender)
+        return extender.extend_all(digests, extend_rtmr_index)
+
+
+class RTMRExtender:
+    """
+    Keep the device file /dev/tdx_guest open to extend many digests into the
+    RTMR registers, without opening and closing it for each of them. Use it
+    as a context manager, or call close() when done.
+    """
+
+    #Reference: Structure of tdx_extend_rtmr_req in /include/uapi/linux/tdx-guest.h
+    #struct tdx_extend_rtmr_req {
+    #    __u8 data[TDX_EXTEND_RTMR_DATA_LEN];
+    #    __u8 index;
+    #};
+    EXTEND_RTMR_REQ = struct.Struct("@48sB")
+
+    #Reference: command used for tdx rtmr extend defined in /include/uapi/linux/tdx-guest.h
+    #define TDX_CMD_EXTEND_RTMR		_IOR('T', 3, struct tdx_extend_rtmr_req)
+    TDX_CMD_EXTEND_RTMR = int.from_bytes(struct.pack('Hcb', 0x3180, b'T', 3), 'big')
+
+    def __init__(self, device_file=RTMR.TDX_ATTEST_FILE):
+        self.device_file = device_file
+        self._backend = get_device_backend()
+        self._fd = None
+        self.extended = 0
+        self._open()
+
+    def _open(self):
+        if not self._backend.exists(self.device_file):
+            LOG.error("Could not find device node %s. Kernel version 6.2 above supports RTMR write",
+                      self.device_file)
+            return
         try:
-            fcntl.ioctl(fd_tdx_attest,
-                        int.from_bytes(struct.pack('Hcb', 0x3180, b'T', 3), 'big'), req)
+            self._fd = self._backend.open(self.device_file, os.O_RDWR)
+        except (PermissionError, IOError, OSError):
+            LOG.error("Fail to open file %s", self.device_file)
+
+    @property
+    def is_open(self):
+        """
+        Whether the device file is open
+        """
+        return self._fd is not None
+
+    def reopen(self) -> bool:
+        """
+        Open the device file if it is not open, e.g. after it failed to
+        open. Return whether it is open.
+        """
+        if self._fd is None:
+            self._open()
+        return self._fd is not None
+
+    def extend(self, digest, extend_rtmr_index) -> bool:
+        """
+        Extend one 48-byte digest into the rtmr
+        """
+        if self._fd is None:
+            return False
+        if len(digest) != RTMR.RTMR_LENGTH_BY_BYTES:
+            LOG.error("Invalid length for the extend data. Should be 48B length.")
+            return False
+        req = self.EXTEND_RTMR_REQ.pack(bytes(digest), int(extend_rtmr_index))
+        try:
+            self._backend.ioctl(self._fd, self.TDX_CMD_EXTEND_RTMR, req)
         except OSError:
-            LOG.info("Fail to execute ioctl for file %s", RTMR.TDX_ATTEST_FILE)
-            os.close(fd_tdx_attest)
-            return RTMR.EXTEND_FAILURE
+            LOG.info("Fail to execute ioctl for file %s", self.device_file)
+            return False
+        self.extended += 1
+        return True
 
-        os.close(fd_tdx_attest)
-        LOG.info("RTMR extend success.")
-        return RTMR.EXTEND_SUCCESS
+    def extend_all(self, digests, extend_rtmr_index) -> int:
+        """
+        Extend the digests in order, stopping at the first failure. Return
+        the number of digests extended.
+        """
+        count = 0
+        for digest in digests:
+            if not self.extend(digest, extend_rtmr_index):
+                break
+            count += 1
+        return count
+
+    def close(self):
+        """
+        Close the device file
+        """
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            self._backend.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,145 @@
+"""
+Sources of the binary data parsed by the tool: the CCEL ACPI table and the
+TD event log. They can come from sysfs within a TD guest, or from a captured
+file, stdin or a buffer in memory, so the parser also runs off-guest.
+"""
+
+import os
+import sys
+import mmap
+import logging
+
+from .device import get_device_backend
+
+__author__ = "cpio"
+
+LOG = logging.getLogger(__name__)
+
+CCEL_ACPI_TABLE = "/sys/firmware/acpi/tables/CCEL"
+CCEL_EVENT_LOG = "/sys/firmware/acpi/tables/data/CCEL"
+
+
+class DataSource:
+    """
+    Base class of a data source. read() returns the whole data as a
+    bytes-like object, or None if it cannot be read. It can be called again
+    to get the current data when it grows, e.g. a runtime event log.
+    """
+
+    def read(self):
+        """
+        Read the data
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release the resources held by the source
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SysfsSource(DataSource):
+    """
+    A file under sysfs, such as the ACPI tables. sysfs attributes do not
+    support mmap, so the file is read at once, through the device backend.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        backend = get_device_backend()
+        if not backend.exists(self.path):
+            LOG.error("Could not find the file %s", self.path)
+            return None
+        try:
+            return backend.read_file(self.path)
+        except (PermissionError, OSError):
+            LOG.error("Need root permission to open file %s", self.path)
+            return None
+
+
+class FileSource(DataSource):
+    """
+    A regular file, e.g. a captured event log. It is memory-mapped read only
+    so that large files are parsed in place without being copied.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mmap = None
+
+    def read(self):
+        self.close()
+        try:
+            with open(self.path, "rb") as fobj:
+                if os.fstat(fobj.fileno()).st_size == 0:
+                    return b""
+                self._mmap = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+                return self._mmap
+        except (PermissionError, OSError):
+            LOG.error("Fail to open file %s", self.path)
+            return None
+
+    def close(self):
+        if self._mmap is None:
+            return
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Entries parsed from the data still reference it, the mapping
+            # is released with the last of them.
+            pass
+        self._mmap = None
+
+
+class StdinSource(DataSource):
+    """
+    Data piped to stdin. It can only be consumed once, later reads return
+    the same data.
+    """
+
+    def __init__(self, stream=None):
+        self._stream = stream if stream is not None else sys.stdin.buffer
+        self._data = None
+
+    def read(self):
+        if self._data is None:
+            self._data = self._stream.read()
+        return self._data
+
+
+class BufferSource(DataSource):
+    """
+    Data already in memory, such as bytes, bytearray or memoryview
+    """
+
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+
+def open_source(location, default=None) -> DataSource:
+    """
+    Create a source from its location: None for the given default sysfs
+    file, "-" for stdin, a path for a regular file, or a bytes-like object.
+    """
+    if isinstance(location, DataSource):
+        return location
+    if location is None:
+        return SysfsSource(default)
+    if location == "-":
+        return StdinSource()
+    if isinstance(location, (bytes, bytearray, memoryview, mmap.mmap)):
+        return BufferSource(location)
+    if str(location).startswith("/sys/"):
+        return SysfsSource(location)
+    return FileSource(location)
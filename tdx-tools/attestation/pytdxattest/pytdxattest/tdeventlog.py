@@ -3,7 +3,8 @@ TD Event log package.
 """
 
 import logging
-from typing import List
+import hashlib
+from typing import Dict, List, Union
 
 from .binaryblob import BinaryBlob
 
@@ -11,6 +12,9 @@ __author__ = "cpio"
 
 LOG = logging.getLogger(__name__)
 
+# Decoded event of an entry not decoded yet, as None is a decoded event
+_NOT_DECODED = object()
+
 
 # pylint: disable=too-few-public-methods
 class TDEventLogType:
@@ -51,6 +55,10 @@ class TDEventLogType:
     EV_EFI_ACTION = EV_EFI_EVENT_BASE + 0x7
     EV_EFI_PLATFORM_FIRMWARE_BLOB = EV_EFI_EVENT_BASE + 0x8
     EV_EFI_HANDOFF_TABLES = EV_EFI_EVENT_BASE + 0x9
+    # TCG PC Client Platform Firmware Profile Specification
+    EV_EFI_PLATFORM_FIRMWARE_BLOB2 = EV_EFI_EVENT_BASE + 0xa
+    EV_EFI_HANDOFF_TABLES2 = EV_EFI_EVENT_BASE + 0xb
+    EV_EFI_VARIABLE_BOOT2 = EV_EFI_EVENT_BASE + 0xc
     EV_EFI_VARIABLE_AUTHORITY = EV_EFI_EVENT_BASE + 0xe0
 
     EVENT_TABLE = {
@@ -83,6 +91,9 @@ class TDEventLogType:
         EV_EFI_ACTION: "EV_EFI_ACTION",
         EV_EFI_PLATFORM_FIRMWARE_BLOB: "EV_EFI_PLATFORM_FIRMWARE_BLOB",
         EV_EFI_HANDOFF_TABLES: "EV_EFI_HANDOFF_TABLES",
+        EV_EFI_PLATFORM_FIRMWARE_BLOB2: "EV_EFI_PLATFORM_FIRMWARE_BLOB2",
+        EV_EFI_HANDOFF_TABLES2: "EV_EFI_HANDOFF_TABLES2",
+        EV_EFI_VARIABLE_BOOT2: "EV_EFI_VARIABLE_BOOT2",
         EV_EFI_VARIABLE_AUTHORITY: "EV_EFI_VARIABLE_AUTHORITY"
     }
 
@@ -117,6 +128,12 @@ class TCGAlgorithmRegistry:
         TPM_ALG_SHA512: "TPM_ALG_SHA512"
     }
 
+    TPM_ALG_HASH = {
+        TPM_ALG_SHA256: hashlib.sha256,
+        TPM_ALG_SHA384: hashlib.sha384,
+        TPM_ALG_SHA512: hashlib.sha512
+    }
+
     @staticmethod
     def get_algorithm_string(algoid):
         """
@@ -126,6 +143,14 @@ class TCGAlgorithmRegistry:
             return TCGAlgorithmRegistry.TPM_ALG_TABLE[algoid]
         return "UNKNOWN"
 
+    @staticmethod
+    def get_hash_function(algoid):
+        """
+        Return the hashlib constructor of a digest algorithm ID, None if it
+        is not a supported hash algorithm
+        """
+        return TCGAlgorithmRegistry.TPM_ALG_HASH.get(algoid)
+
 
 class TDEventLogBase:
     """
@@ -140,6 +165,13 @@ class TDEventLogBase:
         self._etype = 0
         self._digest_count = 0
 
+    @property
+    def address(self):
+        """
+        Address of the entry in the event log area
+        """
+        return self._address
+
     @property
     def length(self):
         """
@@ -147,6 +179,20 @@ class TDEventLogBase:
         """
         return self._length
 
+    @property
+    def data(self):
+        """
+        Raw data of the entry
+        """
+        return self._data
+
+    @property
+    def etype(self):
+        """
+        Event type, see TDEventLogType
+        """
+        return self._etype
+
     @property
     def rtmr(self):
         """
@@ -154,19 +200,20 @@ class TDEventLogBase:
         """
         return self._rtmr
 
-    def parse(self, data):
+    def parse(self, data, offset=0):
         """
-        Parse abstract function
+        Parse abstract function. The entry starts at the given offset of
+        data, so a caller walking a whole log does not need to slice it.
         """
         raise NotImplementedError
 
-    def parse_header(self, data):
+    def parse_header(self, data, offset=0):
         """
         Parse the header of EventLog
         """
-        blob = BinaryBlob(data, self._address)
+        blob = BinaryBlob(data, self._address - offset, zero_copy=True)
 
-        index = 0
+        index = offset
         td_register_index, index = blob.get_uint32(index)
         self._etype, index = blob.get_uint32(index)
         self._digest_count, index = blob.get_uint32(index)
@@ -201,8 +248,8 @@ class TDEventLogSpecIdHeader(TDEventLogBase):
         """
         return self._digest_sizes
 
-    def parse(self, data):
-        blob, index = self.parse_header(data)
+    def parse(self, data, offset=0):
+        blob, index = self.parse_header(data, offset)
 
         index += 20  # 20 zero for digest
         index += 24  # algorithms number
@@ -214,9 +261,9 @@ class TDEventLogSpecIdHeader(TDEventLogBase):
             self._digest_sizes[algoid] = digestsize
         vendorsize, index = blob.get_uint8(index)
         index += vendorsize
-        self._length = index
-        self._data = data[0:index]
-        return index
+        self._length = index - offset
+        self._data, _ = blob.get_view(offset, self._length)
+        return self._length
 
     def dump(self):
         LOG.info("RTMR              : %d", self._rtmr)
@@ -241,6 +288,8 @@ class TDEventLogEntry(TDEventLogBase):
         self._event_size = 0
         self._event = None
         self._algorithms_id = 0
+        self._algorithm_ids = []
+        self._decoded = _NOT_DECODED
 
     @property
     def digests(self) -> List:
@@ -250,21 +299,60 @@ class TDEventLogEntry(TDEventLogBase):
         """
         return self._digests
 
-    def parse(self, data):
-        blob, index = self.parse_header(data)
+    @property
+    def event(self):
+        """
+        Event data of the entry, None if it is empty
+        """
+        return self._event
+
+    @property
+    def decoded(self):
+        """
+        Typed view of the event data, see eventdecoder, None if its event
+        type has no decoder. It is created on first access and its fields
+        are decoded when they are read.
+        """
+        if self._decoded is _NOT_DECODED:
+            # pylint: disable=import-outside-toplevel, cyclic-import
+            from .eventdecoder import decode_event
+            self._decoded = decode_event(self._etype, self._event)
+        return self._decoded
+
+    @property
+    def algorithm_ids(self) -> List[int]:
+        """
+        Algorithm ID of each digest, in the order of `digests`
+        """
+        return self._algorithm_ids
+
+    def get_digest(self, algoid: int) -> bytes:
+        """
+        Digest of the given algorithm ID, None if the entry has none
+        """
+        for digest_algoid, digest in zip(self._algorithm_ids, self._digests):
+            if digest_algoid == algoid:
+                return digest
+        return None
+
+    def parse(self, data, offset=0):
+        blob, index = self.parse_header(data, offset)
 
         for _ in range(self._digest_count):
             algoid, index = blob.get_uint16(index)
             assert algoid in self._specid_header.digest_sizes.keys()
             self._algorithms_id = algoid
+            self._algorithm_ids.append(algoid)
             digest_size = self._specid_header.digest_sizes[algoid]
             digest_data, index = blob.get_bytes(index, digest_size)
-            self._digests.append(digest_data)
+            # Digests are small and used as keys, keep an owned copy of them
+            self._digests.append(bytes(digest_data))
         self._event_size, index = blob.get_uint32(index)
-        self._event, index = blob.get_bytes(index, self._event_size)
-        self._length = index
-        self._data = data[0:index]
-        return index
+        if self._event_size > 0:
+            self._event, index = blob.get_bytes(index, self._event_size)
+        self._length = index - offset
+        self._data, _ = blob.get_view(offset, self._length)
+        return self._length
 
     def dump(self):
         LOG.info("RTMR              : %d", self._rtmr)
@@ -273,11 +361,90 @@ class TDEventLogEntry(TDEventLogBase):
         LOG.info("Length            : %d", self._length)
         LOG.info("Algorithms ID     : %d (%s)", self._algorithms_id,
                  TCGAlgorithmRegistry.get_algorithm_string(self._algorithms_id))
-        count = 0
-        for digest in self._digests:
-            LOG.info("Digest[%d] :", count)
+        for count, (algoid, digest) in enumerate(zip(self._algorithm_ids, self._digests)):
+            LOG.info("Digest[%d] : %s", count, TCGAlgorithmRegistry.get_algorithm_string(algoid))
             digest_blob = BinaryBlob(digest)
             digest_blob.dump()
-            count += 1
         super().dump()
         LOG.info("")
+
+
+class TDEventLogIndex:
+    """
+    Index over the entries of one event log, built once so lookups do not
+    scan the whole log: the offset of each entry by its number, the entries
+    grouped by RTMR, by event type and by both, and the entries by digest.
+    """
+
+    def __init__(self, entries: List[TDEventLogEntry], log_base: int = 0):
+        self._entries = entries
+        self._offsets = []
+        self._by_rtmr = {}
+        self._by_type = {}
+        self._by_rtmr_type = {}
+        self._by_digest = {}
+
+        for entry in entries:
+            self._offsets.append(entry.address - log_base)
+            self._by_rtmr.setdefault(entry.rtmr, []).append(entry)
+            self._by_type.setdefault(entry.etype, []).append(entry)
+            self._by_rtmr_type.setdefault((entry.rtmr, entry.etype), []).append(entry)
+            for digest in entry.digests:
+                self._by_digest.setdefault(digest, []).append(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def offsets(self) -> List[int]:
+        """
+        Offset of each entry in the event log data, by entry number
+        """
+        return self._offsets
+
+    @property
+    def by_rtmr(self) -> Dict[int, List[TDEventLogEntry]]:
+        """
+        Entries grouped by RTMR index, in log order
+        """
+        return self._by_rtmr
+
+    def get_entry(self, number: int) -> TDEventLogEntry:
+        """
+        Entry by its number in the event log, the spec ID header excluded
+        """
+        return self._entries[number]
+
+    def get_offset(self, number: int) -> int:
+        """
+        Offset of an entry in the event log data by its number
+        """
+        return self._offsets[number]
+
+    def get_by_rtmr(self, rtmr: int) -> List[TDEventLogEntry]:
+        """
+        Entries extended into the given RTMR index
+        """
+        return self._by_rtmr.get(rtmr, [])
+
+    def get_by_type(self, etype: int, rtmr: int = None) -> List[TDEventLogEntry]:
+        """
+        Entries of the given TDEventLogType, in one RTMR index if given
+        """
+        if rtmr is None:
+            return self._by_type.get(etype, [])
+        return self._by_rtmr_type.get((rtmr, etype), [])
+
+    def get_by_digest(self, digest: Union[bytes, str]) -> List[TDEventLogEntry]:
+        """
+        Entries with the given digest, as bytes or hex string
+        """
+        if isinstance(digest, str):
+            digest = bytes.fromhex(digest)
+        return self._by_digest.get(bytes(digest), [])
+
+    def has_digest(self, digest: Union[bytes, str]) -> bool:
+        """
+        Whether any entry has the given digest
+        """
+        return len(self.get_by_digest(digest)) > 0
@@ -2,34 +2,442 @@
 Parse td quote struct, see:
 https://software.intel.com/content/dam/develop/external/us/en/documents/tdx-module-1eas-v0.85.039.pdf  # pylint: disable=line-too-long
 https://software.intel.com/content/dam/develop/external/us/en/documents-tps/intel-tdx-cpu-architectural-specification.pdf  # pylint: disable=line-too-long
+https://download.01.org/intel-sgx/latest/dcap-latest/linux/docs/Intel_TDX_DCAP_Quoting_Library_API.pdf  # pylint: disable=line-too-long
+
+Like the TD report, the structures of a quote are views over the raw quote
+with a declarative layout, and each field is a memoryview slice taken when it
+is read. Only the offsets of the variable length parts are computed when the
+quote is parsed, so a verifier pulling out mrtd, rtmr or report_data does not
+allocate the rest of the tree.
 """
+import asyncio
 import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from .utility import DeviceNode
+from .utility import DeviceNode, TDX_REPORTDATA_LEN, TDX_VERSION_1_0, TDX_VERSION_1_5
+from .tdreport import TdReport, TD_MEASUREMENT_FIELDS
+from .rtmr import RTMR
+from .cache import TieredCache
 
-from .binaryblob import BinaryBlob
+from .binaryblob import BinaryBlob, StructView
 
 __author__ = "cpio"
 
 LOG = logging.getLogger(__name__)
 
+QUOTE_VERSION_4 = 4
+QUOTE_VERSION_5 = 5
+
+ATTESTATION_KEY_TYPE_ECDSA_P256 = 2
+TEE_TYPE_TDX = 0x81
+
+# Body types of a v5 quote
+QUOTE_BODY_TYPE_TD10 = 2
+QUOTE_BODY_TYPE_TD15 = 3
+QUOTE_BODY_VERSIONS = {
+    QUOTE_BODY_TYPE_TD10: TDX_VERSION_1_0,
+    QUOTE_BODY_TYPE_TD15: TDX_VERSION_1_5
+}
+
+# Certification data types
+CERT_DATA_TYPE_PCK_CERT_CHAIN = 5
+CERT_DATA_TYPE_QE_REPORT = 6
+
+ECDSA_SIGNATURE_LENGTH = 64
+ECDSA_PUBLIC_KEY_LENGTH = 64
+
+
+class QuoteHeader(StructView):
+    """
+    Struct Quote Header, the same in quote v4 and v5
+
+    Struct Quote Header's layout:
+    offset, len
+    0x0,    0x2     version
+    0x2,    0x2     attestation_key_type
+    0x4,    0x4     tee_type
+    0x8,    0x2     reserved1
+    0xa,    0x2     reserved2
+    0xc,    0x10    qe_vendor_id
+    0x1c,   0x14    user_data
+    """
+
+    __slots__ = ()
+
+    LENGTH = 0x30
+
+    LAYOUTS = {
+        None: StructView.build_layout(
+            ("version", 0x2),
+            ("attestation_key_type", 0x2),
+            ("tee_type", 0x4),
+            ("reserved1", 0x2),
+            ("reserved2", 0x2),
+            ("qe_vendor_id", 0x10),
+            ("user_data", 0x14))
+    }
+
+
+class TdQuoteBody(StructView):
+    """
+    Struct TD Quote Body, TD10 for TDX 1.0 and TD15 for TDX 1.5
+
+    Struct TD Quote Body's layout:
+    offset, len
+    0x0,    0x10    tee_tcb_svn
+    0x10,   0x30    mrseam
+    0x40,   0x30    mrsignerseam
+    0x70,   0x8     seam_attributes
+    0x78,   0x8     td_attributes
+    0x80,   0x8     xfam
+    0x88,   0x30    mrtd
+    0xb8,   0x30    mrconfigid
+    0xe8,   0x30    mrowner
+    0x118,  0x30    mrownerconfig
+    0x148,  0x30    rtmr_0
+    0x178,  0x30    rtmr_1
+    0x1a8,  0x30    rtmr_2
+    0x1d8,  0x30    rtmr_3
+    0x208,  0x40    report_data
+
+    # fields in TD15
+    0x248,  0x10    tee_tcb_svn2
+    0x258,  0x30    mrservicetd
+    """
+
+    __slots__ = ()
+
+    _COMMON = (
+        ("tee_tcb_svn", 0x10),
+        ("mrseam", 0x30),
+        ("mrsignerseam", 0x30),
+        ("seam_attributes", 0x8),
+        ("td_attributes", 0x8),
+        ("xfam", 0x8),
+        *TD_MEASUREMENT_FIELDS,
+        ("report_data", 0x40))
+
+    LAYOUTS = {
+        None: StructView.build_layout(*_COMMON),
+        TDX_VERSION_1_0: StructView.build_layout(*_COMMON),
+        TDX_VERSION_1_5: StructView.build_layout(
+            *_COMMON,
+            ("tee_tcb_svn2", 0x10),
+            ("mrservicetd", 0x30))
+    }
+
+    LENGTHS = {
+        TDX_VERSION_1_0: 0x248,
+        TDX_VERSION_1_5: 0x288
+    }
+
+    def get_rtmr(self, index):
+        """
+        RTMR value by its index
+        """
+        assert 0 <= index < RTMR.RTMR_COUNT
+        offset, length = self._layout[f"rtmr_{index}"]
+        return self._view[offset:offset + length]
+
+
+class QeReport(StructView):
+    """
+    Struct SGX Report Body of the Quoting Enclave
+
+    Struct SGX Report Body's layout:
+    offset, len
+    0x0,    0x10    cpusvn
+    0x10,   0x4     miscselect
+    0x14,   0x1c    reserved1
+    0x30,   0x10    attributes
+    0x40,   0x20    mrenclave
+    0x60,   0x20    reserved2
+    0x80,   0x20    mrsigner
+    0xa0,   0x60    reserved3
+    0x100,  0x2     isvprodid
+    0x102,  0x2     isvsvn
+    0x104,  0x3c    reserved4
+    0x140,  0x40    report_data
+    """
+
+    __slots__ = ()
+
+    LENGTH = 0x180
+
+    LAYOUTS = {
+        None: StructView.build_layout(
+            ("cpusvn", 0x10),
+            ("miscselect", 0x4),
+            ("reserved1", 0x1c),
+            ("attributes", 0x10),
+            ("mrenclave", 0x20),
+            ("reserved2", 0x20),
+            ("mrsigner", 0x20),
+            ("reserved3", 0x60),
+            ("isvprodid", 0x2),
+            ("isvsvn", 0x2),
+            ("reserved4", 0x3c),
+            ("report_data", 0x40))
+    }
+
+
+class QuoteSignatureData(BinaryBlob):
+    """
+    Struct ECDSA 256-bit Quote Signature Data
+
+    Struct ECDSA 256-bit Quote Signature Data's layout:
+    offset, len
+    0x0,    0x40    signature, over the quote header and body
+    0x40,   0x40    attestation_key, raw P-256 public key
+    0x80,   0x2     cert_data_type, CERT_DATA_TYPE_QE_REPORT
+    0x82,   0x4     cert_data_size
+    0x86,   *       QE report certification data:
+                    0x180   qe_report
+                    0x40    qe_report_signature, by the PCK key
+                    0x2     qe_auth_data_size
+                    *       qe_auth_data
+                    0x2     cert_data_type, CERT_DATA_TYPE_PCK_CERT_CHAIN
+                    0x4     cert_data_size
+                    *       pck_cert_chain, PEM encoded
+    """
+
+    __slots__ = ("cert_data_type", "pck_cert_data_type", "_qe_report_offset",
+                 "_qe_auth_data", "_pck_cert_chain", "_qe_report")
+
+    def __init__(self, data):
+        super().__init__(data, zero_copy=True)
+        self._qe_report = None
+        self._parse()
+
+    def _parse(self):
+        index = ECDSA_SIGNATURE_LENGTH + ECDSA_PUBLIC_KEY_LENGTH
+        self._check_length(index + 6, "signature data")
+        self.cert_data_type, index = self.get_uint16(index)
+        cert_data_size, index = self.get_uint32(index)
+        self._check_length(index + cert_data_size, "certification data")
+        if self.cert_data_type != CERT_DATA_TYPE_QE_REPORT:
+            raise ValueError(f"Unsupported certification data type {self.cert_data_type}")
+
+        self._qe_report_offset = index
+        index += QeReport.LENGTH + ECDSA_SIGNATURE_LENGTH
+        self._check_length(index + 2, "QE report")
+        qe_auth_data_size, index = self.get_uint16(index)
+        self._check_length(index + qe_auth_data_size + 6, "QE authentication data")
+        self._qe_auth_data, index = self.get_view(index, qe_auth_data_size)
+
+        self.pck_cert_data_type, index = self.get_uint16(index)
+        pck_cert_data_size, index = self.get_uint32(index)
+        self._check_length(index + pck_cert_data_size, "PCK certificate chain")
+        self._pck_cert_chain, index = self.get_view(index, pck_cert_data_size)
+
+    def _check_length(self, end, what):
+        if end > self.length:
+            raise ValueError(f"Truncated quote {what}")
+
+    @property
+    def signature(self):
+        """
+        ECDSA signature of the quote header and body, r || s
+        """
+        return self._data[0:ECDSA_SIGNATURE_LENGTH]
+
+    @property
+    def attestation_key(self):
+        """
+        Attestation public key, x || y
+        """
+        return self._data[ECDSA_SIGNATURE_LENGTH:
+                          ECDSA_SIGNATURE_LENGTH + ECDSA_PUBLIC_KEY_LENGTH]
+
+    @property
+    def qe_report(self) -> QeReport:
+        """
+        Report of the Quoting Enclave
+        """
+        if self._qe_report is None:
+            data, _ = self.get_bytes(self._qe_report_offset, QeReport.LENGTH)
+            self._qe_report = QeReport(data)
+        return self._qe_report
+
+    @property
+    def qe_report_signature(self):
+        """
+        ECDSA signature of the QE report by the PCK key, r || s
+        """
+        offset = self._qe_report_offset + QeReport.LENGTH
+        return self._data[offset:offset + ECDSA_SIGNATURE_LENGTH]
+
+    @property
+    def qe_auth_data(self):
+        """
+        QE authentication data, bound to the attestation key in the QE report
+        """
+        return self._qe_auth_data
+
+    @property
+    def pck_cert_chain(self):
+        """
+        PEM encoded PCK certificate chain: PCK, intermediate CA and root CA
+        """
+        return self._pck_cert_chain
+
 
 class TdQuote(BinaryBlob):
     """
-    Struct TDREPORT_STRUCT
+    TD Quote in version 4 or 5, ECDSA P-256 signed
+
+    TD Quote v4's layout:
+    offset, len
+    0x0,    0x30    QuoteHeader
+    0x30,   0x248   TdQuoteBody, TD10
+    0x278,  0x4     signature_data_length
+    0x27c,  *       QuoteSignatureData
+
+    TD Quote v5's layout:
+    offset, len
+    0x0,    0x30    QuoteHeader
+    0x30,   0x2     body_type, TD10 or TD15
+    0x32,   0x4     body_size
+    0x36,   *       TdQuoteBody
+    *,      0x4     signature_data_length
+    *,      *       QuoteSignatureData
+
+    Only the offsets of the body and the signature data are read when the
+    quote is created, the structures are created when they are first
+    accessed. The device node is only probed if it is used, so quotes
+    received from other TDs are parsed anywhere.
     """
+
+    __slots__ = ("_device_node", "quote_version", "body_version", "_body_offset",
+                 "_signature_offset", "_signature_length", "_header", "_body",
+                 "_signature_data")
+
     def __init__(self, data, device_node=None):
-        super().__init__(data)
+        super().__init__(data, zero_copy=True)
         # auxiliary fileds
-        if device_node is None:
-            device_node = DeviceNode()
-        self.device_node = device_node
+        self._device_node = device_node
+        self._header = None
+        self._body = None
+        self._signature_data = None
+        self._parse()
+
+    def _parse(self):
+        if self.length < QuoteHeader.LENGTH:
+            raise ValueError("Truncated quote header")
+        self.quote_version, _ = self.get_uint16(0)
+        index = QuoteHeader.LENGTH
+        if self.quote_version == QUOTE_VERSION_4:
+            self.body_version = TDX_VERSION_1_0
+            body_size = TdQuoteBody.LENGTHS[TDX_VERSION_1_0]
+        elif self.quote_version == QUOTE_VERSION_5:
+            if index + 6 > self.length:
+                raise ValueError("Truncated quote body descriptor")
+            body_type, index = self.get_uint16(index)
+            body_size, index = self.get_uint32(index)
+            self.body_version = QUOTE_BODY_VERSIONS.get(body_type)
+            if self.body_version is None:
+                raise ValueError(f"Unsupported quote body type {body_type}")
+        else:
+            raise ValueError(f"Unsupported quote version {self.quote_version}")
+        if body_size != TdQuoteBody.LENGTHS[self.body_version]:
+            raise ValueError(f"Invalid quote body size {body_size}")
+
+        self._body_offset = index
+        index += body_size
+        if index + 4 > self.length:
+            raise ValueError("Truncated quote body")
+        self._signature_length, index = self.get_uint32(index)
+        if index + self._signature_length > self.length:
+            raise ValueError("Truncated quote signature")
+        self._signature_offset = index
+
+    @property
+    def device_node(self):
+        """
+        Device node the quote was generated on, probed when first used
+        """
+        if self._device_node is None:
+            self._device_node = DeviceNode()
+        return self._device_node
+
+    @property
+    def header(self) -> QuoteHeader:
+        """
+        Quote header at offset 0x0
+        """
+        if self._header is None:
+            data, _ = self.get_bytes(0, QuoteHeader.LENGTH)
+            self._header = QuoteHeader(data)
+        return self._header
+
+    @property
+    def body(self) -> TdQuoteBody:
+        """
+        TD quote body, with the fields of the TD report
+        """
+        if self._body is None:
+            data, _ = self.get_bytes(self._body_offset,
+                                     TdQuoteBody.LENGTHS[self.body_version])
+            self._body = TdQuoteBody(data, self.body_version)
+        return self._body
+
+    @property
+    def signed_data(self):
+        """
+        Header and body of the quote, signed by the attestation key
+        """
+        return self._data[:self._signature_offset - 4]
+
+    @property
+    def signature_data(self) -> QuoteSignatureData:
+        """
+        Signature data with the QE report and the certification data
+        """
+        if self._signature_data is None:
+            data, _ = self.get_bytes(self._signature_offset, self._signature_length)
+            self._signature_data = QuoteSignatureData(data)
+        return self._signature_data
+
+    @property
+    def mrtd(self):
+        """
+        Measurement of the initial contents of the TD
+        """
+        return self.body.mrtd
+
+    @property
+    def report_data(self):
+        """
+        Report data bound into the quote
+        """
+        return self.body.report_data
+
+    def get_rtmr(self, index):
+        """
+        RTMR value of the quote by its index
+        """
+        return self.body.get_rtmr(index)
+
+    def dump(self):
+        """
+        Dump the main fields, then the Hex value
+        """
+        LOG.info("Quote version: %d, TD body: %s, attestation key type: %d, TEE type: 0x%X",
+                 self.quote_version, self.body_version,
+                 int.from_bytes(self.header.attestation_key_type, "little"),
+                 int.from_bytes(self.header.tee_type, "little"))
+        LOG.info("MRTD: %s", self.mrtd.hex())
+        for index in range(RTMR.RTMR_COUNT):
+            LOG.info("RTMR[%d]: %s", index, self.get_rtmr(index).hex())
+        LOG.info("Report data: %s", self.report_data.hex())
+        super().dump()
 
     @staticmethod
-    def get_quote(nonce=None, user_data=None, report_data=None):
+    def calc_report_data(nonce=None, user_data=None, report_data=None):
         """
-        Perform ioctl on the device file, to get td-report
+        Get the report data to bind into the quote: report_data if given,
+        else the SHA-512 digest of nonce and user data, else None.
         """
         if report_data is not None:
             LOG.info("Using report data directly to generate quote")
@@ -44,9 +452,171 @@ class TdQuote(BinaryBlob):
                 if user_data is not None:
                     hash_algo.update(bytes(user_data))
                 report_data = hash_algo.digest()
+        return report_data
+
+    @staticmethod
+    def get_quote(nonce=None, user_data=None, report_data=None, cache=None):
+        """
+        Perform ioctl on the device file, to get td-report
+
+        With a QuoteCache, a quote generated before for the same report data
+        is returned while the RTMR values of the TD are unchanged.
+        """
+        report_data = TdQuote.calc_report_data(nonce, user_data, report_data)
         device_node = DeviceNode()
+        if cache is not None:
+            return TdQuote._get_cached_quote(device_node, report_data, cache)
+
         tdquote_bytes = device_node.get_tdquote_bytes(report_data)
         if tdquote_bytes is not None:
-            quote = TdQuote(tdquote_bytes, device_node)
-            return quote
+            return TdQuote._parse_quote(tdquote_bytes, device_node)
         return None
+
+    @staticmethod
+    def _parse_quote(tdquote_bytes, device_node):
+        try:
+            return TdQuote(tdquote_bytes, device_node)
+        except ValueError as err:
+            LOG.error("Invalid TD quote: %s", err)
+            return None
+
+    @staticmethod
+    def _get_cached_quote(device_node, report_data, cache):
+        # The TD report is needed anyway, to check the current RTMR values
+        # against the ones the cached quote was generated with
+        tdreport_bytes = device_node.get_tdreport_bytes(report_data)
+        if tdreport_bytes is None:
+            LOG.error("Get TD report failed")
+            return None
+        td_info = TdReport(tdreport_bytes, device_node).td_info
+        rtmrs = b"".join(bytes(getattr(td_info, f"rtmr_{index}"))
+                         for index in range(RTMR.RTMR_COUNT))
+
+        tdquote_bytes = cache.get(report_data, rtmrs)
+        if tdquote_bytes is not None:
+            quote = TdQuote._parse_quote(tdquote_bytes, device_node)
+            if quote is not None:
+                LOG.info("Using cached quote for the report data")
+                return quote
+            LOG.info("Drop the invalid cached quote")
+            cache.invalidate(report_data)
+
+        tdquote_bytes = device_node.get_tdquote_bytes_from_report(tdreport_bytes)
+        if tdquote_bytes is None:
+            return None
+        # only a quote which parses is cached
+        quote = TdQuote._parse_quote(tdquote_bytes, device_node)
+        if quote is not None:
+            cache.put(report_data, rtmrs, tdquote_bytes)
+        return quote
+
+
+class QuoteCache:
+    """
+    Cache of TD quotes keyed by the final 64-byte report data, with an
+    in-process LRU layer and an optional on-disk layer, both expiring entries
+    after ttl seconds. Each entry keeps the RTMR values of the TD report the
+    quote was generated from, and is dropped as soon as the RTMR values of
+    the TD differ, so a quote with stale measurements is never served.
+    """
+
+    RTMRS_LENGTH = RTMR.RTMR_COUNT * RTMR.RTMR_LENGTH_BY_BYTES
+
+    def __init__(self, maxsize=64, ttl=300, directory=None):
+        self._cache = TieredCache(maxsize, ttl, directory)
+
+    @staticmethod
+    def _key(report_data):
+        report_data = bytes(report_data) if report_data is not None else b""
+        return report_data.ljust(TDX_REPORTDATA_LEN, b"\0")
+
+    def get(self, report_data, rtmrs: bytes):
+        """
+        Get the quote for the report data, generated while the TD had the
+        given RTMR values, or None
+        """
+        entry = self._cache.get(self._key(report_data))
+        if entry is None:
+            return None
+
+        if entry[:self.RTMRS_LENGTH] != rtmrs:
+            LOG.info("RTMR values changed, drop the cached quote")
+            self.invalidate(report_data)
+            return None
+        return entry[self.RTMRS_LENGTH:]
+
+    def put(self, report_data, rtmrs: bytes, quote: bytes):
+        """
+        Store the quote for the report data and the RTMR values it was
+        generated with
+        """
+        assert len(rtmrs) == self.RTMRS_LENGTH
+        self._cache.put(self._key(report_data), bytes(rtmrs) + bytes(quote))
+
+    def invalidate(self, report_data):
+        """
+        Drop the quote for the report data
+        """
+        self._cache.pop(self._key(report_data))
+
+
+class AsyncTdQuote:
+    """
+    asyncio API to get TD quotes without blocking the event loop.
+
+    The blocking GET_REPORT and QGS round trip run in a thread pool. At most
+    max_in_flight quote requests run at the same time, and concurrent
+    requests for the same report data share the result of a single one.
+    An optional QuoteCache is used by all the requests.
+    """
+
+    def __init__(self, max_in_flight=4, executor=None, cache=None):
+        self._max_in_flight = max(1, max_in_flight)
+        self._cache = cache
+        self._own_executor = executor is None
+        self._executor = executor if executor is not None else \
+            ThreadPoolExecutor(max_workers=self._max_in_flight,
+                               thread_name_prefix="tdquote")
+        # created in the event loop on first use
+        self._semaphore = None
+        # report data -> task getting its quote
+        self._pending = {}
+
+    @property
+    def in_flight(self):
+        """
+        Number of distinct quote requests pending
+        """
+        return len(self._pending)
+
+    async def _get_quote(self, report_data):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_in_flight)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, TdQuote.get_quote, None, None, report_data, self._cache)
+
+    async def get_quote(self, nonce=None, user_data=None, report_data=None):
+        """
+        Get a TdQuote for the report data, see TdQuote.get_quote. Return None
+        if the quote cannot be generated.
+        """
+        report_data = TdQuote.calc_report_data(nonce, user_data, report_data)
+        key = bytes(report_data) if report_data is not None else b""
+
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._get_quote(report_data))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        # a cancelled caller does not cancel the request shared with others
+        return await asyncio.shield(task)
+
+    def close(self):
+        """
+        Shut down the thread pool if it was created by this instance
+        """
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
@@ -2,255 +2,268 @@
 Parse td report struct, see:
 https://software.intel.com/content/dam/develop/external/us/en/documents/tdx-module-1eas-v0.85.039.pdf  # pylint: disable=line-too-long
 https://software.intel.com/content/dam/develop/external/us/en/documents-tps/intel-tdx-cpu-architectural-specification.pdf  # pylint: disable=line-too-long
+
+Each structure is a view over the raw TD report with a declarative layout
+table per TDX version. A field is a memoryview slice taken when it is read,
+so a caller only pays for the fields it uses.
 """
 
 import logging
 
-from .utility import DeviceNode, \
+from .utility import DeviceNode, DeviceSession, \
         DEVICE_NODE_NAME_DEPRECATED as DEV_DEPRECATED, \
         DEVICE_NODE_NAME_1_0 as DEV_1_0, \
-        DEVICE_NODE_NAME_1_5 as DEV_1_5
+        DEVICE_NODE_NAME_1_5 as DEV_1_5, \
+        TDX_VERSION_1_0, TDX_VERSION_1_5, TDX_VERSION_BY_DEVICE
 from .utility import ModuleVersion
 
-from .binaryblob import BinaryBlob
+from .binaryblob import BinaryBlob, StructView
 
 __author__ = "cpio"
 
 LOG = logging.getLogger(__name__)
 
 
-class ReportMacStruct(BinaryBlob):
+def _get_version(device, version):
+    if version is not None:
+        return version
+    if device == DEV_DEPRECATED:
+        LOG.error("Deprecated device node %s, please upgrade to use %s or %s",
+                  DEV_DEPRECATED, DEV_1_0, DEV_1_5)
+    return TDX_VERSION_BY_DEVICE.get(device)
+
+
+# Measurement registers of the TD, in this order in TDINFO_STRUCT and in the
+# TD quote body
+TD_MEASUREMENT_FIELDS = (
+    ("mrtd", 0x30),
+    ("mrconfigid", 0x30),
+    ("mrowner", 0x30),
+    ("mrownerconfig", 0x30),
+    ("rtmr_0", 0x30),
+    ("rtmr_1", 0x30),
+    ("rtmr_2", 0x30),
+    ("rtmr_3", 0x30))
+
+
+class ReportMacStruct(StructView):
     """
     Struct REPORTMACSTRUCT
-    """
 
-    def __init__(self, data):
-        super().__init__(data)
-        self.report_type = None
-        self.reserverd1 = None
-        self.cpusvn = None
-        self.tee_tcb_info_hash = None
-        self.tee_info_hash = None
-        self.report_data = None
-        self.reserverd2 = None
-        self.mac = None
-        self.parse()
-
-    def parse(self):
-        """
-        parse the raw data for Struct REPORTMACSTRUCT
-
-        Struct REPORTMACSTRUCT's layout:
-        offset, len
-        0x0,    0x8     report_type
-        0x8,    0x8     reserverd1
-        0x10,   0x10    cpusvn
-        0x20,   0x30    tee_tcb_info_hash
-        0x50,   0x30    tee_info_hash
-        0x80,   0x40    report_data
-        0xc0,   0x20    reserverd2
-        0xe0,   0x20    mac
-        """
-        offset = 0
-
-        self.report_type, offset = self.get_bytes(offset, 0x8)
-        self.reserverd1, offset = self.get_bytes(offset, 0x8)
-        self.cpusvn, offset = self.get_bytes(offset, 0x10)
-        self.tee_tcb_info_hash, offset = self.get_bytes(offset, 0x30)
-        self.tee_info_hash, offset = self.get_bytes(offset, 0x30)
-        self.report_data, offset = self.get_bytes(offset, 0x40)
-        self.reserverd2, offset = self.get_bytes(offset, 0x20)
-        self.mac, offset = self.get_bytes(offset, 0x20)
-
-class TeeTcbInfo(BinaryBlob):
-    """
-    Struct TEE_TCB_INFO
+    Struct REPORTMACSTRUCT's layout:
+    offset, len
+    0x0,    0x8     report_type
+    0x8,    0x8     reserverd1
+    0x10,   0x10    cpusvn
+    0x20,   0x30    tee_tcb_info_hash
+    0x50,   0x30    tee_info_hash
+    0x80,   0x40    report_data
+    0xc0,   0x20    reserverd2
+    0xe0,   0x20    mac
     """
 
-    def __init__(self, data, device):
-        super().__init__(data)
-        # auxiliary fileds
-        self.device = device
-        self.module_version = None
-
-        # real fields
-        self.valid = None
-        self.tee_tcb_svn = None
-        self.mrseam = None
-        self.mrsignerseam = None
-        self.attributes = None
-        self.tee_tcb_svn2 = None
-        self.reserved = None
-        self.parse()
-
-    def parse(self):
-        """
-        parse the raw data for Struct TEE_TCB_INFO
+    __slots__ = ()
+
+    LAYOUTS = {
+        None: StructView.build_layout(
+            ("report_type", 0x8),
+            ("reserverd1", 0x8),
+            ("cpusvn", 0x10),
+            ("tee_tcb_info_hash", 0x30),
+            ("tee_info_hash", 0x30),
+            ("report_data", 0x40),
+            ("reserverd2", 0x20),
+            ("mac", 0x20))
+    }
+
 
-        Struct TEE_TCB_INFO's layout:
-        offset, len
-        0x0,    0x08    valid
-        0x8,    0x10    tee_tcb_svn
-        0x18,   0x30    mrseam
-        0x48,   0x30    mrsignerseam
-        0x78,   0x08    attributes
+class TeeTcbInfo(StructView):
+    """
+    Struct TEE_TCB_INFO
 
-        # fileds in tdx v1.0
-        0x80,   0x6f    reserved
+    Struct TEE_TCB_INFO's layout:
+    offset, len
+    0x0,    0x08    valid
+    0x8,    0x10    tee_tcb_svn
+    0x18,   0x30    mrseam
+    0x48,   0x30    mrsignerseam
+    0x78,   0x08    attributes
 
-        # fileds in tdx v1.5
-        0x80,   0x10    tee_tcb_svn2
-        0x90,   0x5f    reserved
+    # fileds in tdx v1.0
+    0x80,   0x6f    reserved
 
-        FIXME:  need spec reference to update info # pylint: disable=fixme
-                about new field tee_tcb_svn2
-        """
-        if self.device == DEV_DEPRECATED:
-            LOG.error("Deprecated device node %s, please upgrade to use %s or %s",
-                      DEV_DEPRECATED, DEV_1_0, DEV_1_5)
-            return
+    # fileds in tdx v1.5
+    0x80,   0x10    tee_tcb_svn2
+    0x90,   0x5f    reserved
 
-        offset = 0
+    FIXME:  need spec reference to update info # pylint: disable=fixme
+            about new field tee_tcb_svn2
+    """
 
-        self.valid, offset = self.get_bytes(offset, 0x8)
-        self.tee_tcb_svn, offset = self.get_bytes(offset, 0x10)
-        self.mrseam, offset = self.get_bytes(offset, 0x30)
-        self.mrsignerseam, offset = self.get_bytes(offset, 0x30)
-        self.attributes, offset = self.get_bytes(offset, 0x8)
+    __slots__ = ("device", "_module_version")
+
+    _COMMON = (
+        ("valid", 0x8),
+        ("tee_tcb_svn", 0x10),
+        ("mrseam", 0x30),
+        ("mrsignerseam", 0x30),
+        ("attributes", 0x8))
+
+    LAYOUTS = {
+        None: StructView.build_layout(*_COMMON),
+        TDX_VERSION_1_0: StructView.build_layout(
+            *_COMMON,
+            ("reserved", 0x6f)),
+        TDX_VERSION_1_5: StructView.build_layout(
+            *_COMMON,
+            ("tee_tcb_svn2", 0x10),
+            ("reserved", 0x5f))
+    }
+
+    def __init__(self, data, device=None, version=None):
+        super().__init__(data, _get_version(device, version))
+        # auxiliary fileds
+        self.device = device
+        self._module_version = None
 
-        if  self.device == DEV_1_0:
-            self.reserved, offset = self.get_bytes(offset, 0x6f)
-        elif self.device == DEV_1_5:
-            self.tee_tcb_svn2, offset = self.get_bytes(offset, 0x10)
-            self.reserved, offset = self.get_bytes(offset, 0x5f)
+    @property
+    def module_version(self):
+        """
+        Version of the TDX module, parsed from tee_tcb_svn
+        """
+        if self._module_version is None:
+            self._module_version, _ = ModuleVersion.from_bytes(self.tee_tcb_svn)
+        return self._module_version
 
-        # parse module svn
-        self.module_version, _ = ModuleVersion.from_bytes(self.tee_tcb_svn)
 
-class TdInfo(BinaryBlob):
-    """
+class TdInfo(StructView):
+    '''
     Struct TDINFO_STRUCT
-    """
 
-    def __init__(self, data, device):
-        super().__init__(data)
+    Struct TDINFO_STRUCT's layout:
+    offset, len
+    0x0,    0x8     attributes
+    0x8,    0x8     xfam
+    0x10,   0x30    mrtd
+    0x40,   0x30    mrconfigid
+    0x70,   0x30    mrowner
+    0xa0,   0x30    mrownerconfig
+    0xd0,   0x30    rtmr_0
+    0x100,  0x30    rtmr_1
+    0x130,  0x30    rtmr_2
+    0x160,  0x30    rtmr_3
+
+    # fields in tdx v1.0
+    0x190,  0x70    reserved
+
+    # fields in tdx v1.5
+    0x190,  0x30    servtd_hash
+    0x1c0,  0x40    reserved
+
+    ref:
+        Page 40 of Intel® TDX Module v1.5 ABI Specification
+        from https://www.intel.com/content/www/us/en/developer/articles/technical/
+        intel-trust-domain-extensions.html
+    '''
+
+    __slots__ = ("device",)
+
+    _COMMON = (
+        ("attributes", 0x8),
+        ("xfam", 0x8),
+        *TD_MEASUREMENT_FIELDS)
+
+    LAYOUTS = {
+        None: StructView.build_layout(*_COMMON),
+        TDX_VERSION_1_0: StructView.build_layout(
+            *_COMMON,
+            ("reserved", 0x70)),
+        TDX_VERSION_1_5: StructView.build_layout(
+            *_COMMON,
+            ("servtd_hash", 0x30),
+            ("reserved", 0x40))
+    }
+
+    def __init__(self, data, device=None, version=None):
+        super().__init__(data, _get_version(device, version))
         # auxiliary fileds
         self.device = device
-        # read fields
-        self.attributes = None
-        self.xfam = None
-        self.mrtd = None
-        self.mrconfigid = None
-        self.mrowner = None
-        self.mrownerconfig = None
-        self.rtmr_0 = None
-        self.rtmr_1 = None
-        self.rtmr_2 = None
-        self.rtmr_3 = None
-        self.servtd_hash = None
-        self.reserved = None
-        self.parse()
-
-    def parse(self):
-        '''
-        parse the raw data for Struct TDINFO_STRUCT
-
-        Struct TDINFO_STRUCT's layout:
-        offset, len
-        0x0,    0x8     attributes
-        0x8,    0x8     xfam
-        0x10,   0x30    mrtd
-        0x40,   0x30    mrconfigid
-        0x70,   0x30    mrowner
-        0xa0,   0x30    mrownerconfig
-        0xd0,   0x30    rtmr_0
-        0x100,  0x30    rtmr_1
-        0x130,  0x30    rtmr_2
-        0x160,  0x30    rtmr_3
-
-        # fields in tdx v1.0
-        0x190,  0x70    reserved
-
-        # fields in tdx v1.5
-        0x190,  0x30    servtd_hash
-        0x1c0,  0x40    reserved
-
-        ref:
-            Page 40 of Intel® TDX Module v1.5 ABI Specification
-            from https://www.intel.com/content/www/us/en/developer/articles/technical/
-            intel-trust-domain-extensions.html
-        '''
-
-        if self.device == DEV_DEPRECATED:
-            LOG.error("Deprecated device node %s, please upgrade to use %s or %s",
-                      DEV_DEPRECATED, DEV_1_0, DEV_1_5)
-            return
-
-        offset = 0
-
-        self.attributes, offset = self.get_bytes(offset, 0x8)
-        self.xfam, offset = self.get_bytes(offset, 0x8)
-        self.mrtd, offset = self.get_bytes(offset, 0x30)
-        self.mrconfigid, offset = self.get_bytes(offset, 0x30)
-        self.mrowner, offset = self.get_bytes(offset, 0x30)
-        self.mrownerconfig, offset = self.get_bytes(offset, 0x30)
-        self.rtmr_0, offset = self.get_bytes(offset, 0x30)
-        self.rtmr_1, offset = self.get_bytes(offset, 0x30)
-        self.rtmr_2, offset = self.get_bytes(offset, 0x30)
-        self.rtmr_3, offset = self.get_bytes(offset, 0x30)
-
-        if  self.device == DEV_1_0:
-            self.reserved, offset = self.get_bytes(offset, 0x70)
-        elif self.device == DEV_1_5:
-            self.servtd_hash, offset = self.get_bytes(offset, 0x30)
-            self.reserved, offset = self.get_bytes(offset, 0x40)
+
 
 class TdReport(BinaryBlob):
     """
     Struct TDREPORT_STRUCT
+
+    Struct TDREPORT_STRUCT's layout:
+    offset, len
+    0x0,    0x100   ReportMacStruct
+    0x100,  0xef    TeeTcbInfo
+    0x1ef,  0x11    Reserved
+    0x200,  0x200   TdInfo
+
+    The sub-structures are created when they are first accessed. The TDX
+    version of the layout comes from the device node the report was read
+    from, or can be given directly to parse a report collected elsewhere.
     """
-    def __init__(self, data, device_node=None):
-        super().__init__(data)
+
+    __slots__ = ("device_node", "version", "_report_mac_struct",
+                 "_tee_tcb_info", "_td_info")
+
+    def __init__(self, data, device_node=None, version=None):
+        super().__init__(data, zero_copy=True)
         # auxiliary fileds
-        if device_node is None:
+        if device_node is None and version is None:
             device_node = DeviceNode()
         self.device_node = device_node
-        # real fields in TDREPORT_STRUCT
-        self.report_mac_struct = None
-        self.tee_tcb_info = None
-        self.reserved = None
-        self.td_info = None
-        self.parse()
-
-    def parse(self):
-        '''
-        parse the raw data for Struct TDREPORT_STRUCT
-
-        Struct TDREPORT_STRUCT's layout:
-        offset, len
-        0x0,    0x100   ReportMacStruct
-        0x100,  0xef    TeeTcbInfo
-        0x1ef,  0x11    Reserved
-        0x200,  0x200   TdInfo
-        '''
-        if self.device_node == DEV_DEPRECATED:
-            LOG.error("Deprecated device node %s, please upgrade to use %s or %s",
-                      DEV_DEPRECATED, DEV_1_0, DEV_1_5)
-            return
-
-        offset = 0
-
-        data, offset = self.get_bytes(offset, 0x100)
-        self.report_mac_struct = ReportMacStruct(data)
-
-        data, offset = self.get_bytes(offset, 0xef)
-        self.tee_tcb_info = TeeTcbInfo(data, self.device_node.device_node_name)
-
-        data, offset = self.get_bytes(offset, 0x11)
-        self.reserved = data
-
-        data, offset = self.get_bytes(offset, 0x200)
-        self.td_info = TdInfo(data, self.device_node.device_node_name)
+        self.version = _get_version(
+            device_node.device_node_name if device_node is not None else None, version)
+        self._report_mac_struct = None
+        self._tee_tcb_info = None
+        self._td_info = None
+
+    @property
+    def report_mac_struct(self) -> ReportMacStruct:
+        """
+        REPORTMACSTRUCT at offset 0x0
+        """
+        if self._report_mac_struct is None:
+            data, _ = self.get_bytes(0x0, 0x100)
+            self._report_mac_struct = ReportMacStruct(data, self.version)
+        return self._report_mac_struct
+
+    @property
+    def tee_tcb_info(self) -> TeeTcbInfo:
+        """
+        TEE_TCB_INFO at offset 0x100
+        """
+        if self._tee_tcb_info is None:
+            data, _ = self.get_bytes(0x100, 0xef)
+            self._tee_tcb_info = TeeTcbInfo(data, self._device_name, self.version)
+        return self._tee_tcb_info
+
+    @property
+    def reserved(self):
+        """
+        Reserved bytes at offset 0x1ef
+        """
+        data, _ = self.get_bytes(0x1ef, 0x11)
+        return data
+
+    @property
+    def td_info(self) -> TdInfo:
+        """
+        TDINFO_STRUCT at offset 0x200
+        """
+        if self._td_info is None:
+            data, _ = self.get_bytes(0x200, 0x200)
+            self._td_info = TdInfo(data, self._device_name, self.version)
+        return self._td_info
+
+    @property
+    def _device_name(self):
+        if self.device_node is None:
+            return None
+        return self.device_node.device_node_name
 
     @staticmethod
     def get_td_report(report_data=None):
@@ -261,3 +274,17 @@ class TdReport(BinaryBlob):
         tdreport_bytes = device_node.get_tdreport_bytes(report_data)
         report = TdReport(tdreport_bytes, device_node)
         return report
+
+    @staticmethod
+    def get_td_reports(batch_of_report_data, session=None):
+        """
+        Get one td-report per report data through a long-lived DeviceSession,
+        which is opened for the call if not given. A failed report is None.
+        """
+        if session is None:
+            with DeviceSession() as own_session:
+                return TdReport.get_td_reports(batch_of_report_data, own_session)
+
+        device_node = session.device_node
+        return [TdReport(tdreport_bytes, device_node) if tdreport_bytes is not None else None
+                for tdreport_bytes in session.get_reports(batch_of_report_data)]
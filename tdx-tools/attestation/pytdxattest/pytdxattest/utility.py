@@ -6,9 +6,12 @@ import os
 import logging
 import ctypes
 import struct
-import fcntl
+import threading
 from typing import List
 
+from .device import get_device_backend
+from .qgs import QgsClient, QGS_VSOCK_CID, QGS_VSOCK_PORT, qgs_msg_quote_req, qgs_msg_quote_resp
+
 __author__ = "cpio"
 
 LOG = logging.getLogger(__name__)
@@ -39,6 +42,14 @@ TDX_CMD_GET_QUOTE_V1_0 = int.from_bytes(struct.pack('Hcb', 0x0880, b'T', 2), 'bi
 # 0x40c4 in little-endian.
 TDX_CMD_GET_REPORT0_V1_5 = int.from_bytes(struct.pack('Hcb', 0x40c4, b'T', 1),'big')
 
+# The version of the TDREPORT_STRUCT layout returned by each device node
+TDX_VERSION_1_0 = "1.0"
+TDX_VERSION_1_5 = "1.5"
+TDX_VERSION_BY_DEVICE = {
+    DEVICE_NODE_NAME_1_0: TDX_VERSION_1_0,
+    DEVICE_NODE_NAME_1_5: TDX_VERSION_1_5
+}
+
 # The valid value of tcb_info_valid
 # Note:
 # 1.  In tdx 1.0, the valid(8 bytes), tee_tcb_svn(16 bytes), mrseam(48 bytes) are
@@ -96,6 +107,15 @@ class DeviceNode:
             })
     ]
 
+    # Result of probing the device nodes, shared by all the instances as the
+    # device node does not change while the process runs
+    _probed_device = None
+
+    # Address of QGS for the device nodes without GET_TDQUOTE, a (cid, port)
+    # vsock address or the path of a unix socket
+    QGS_ADDRESS = (QGS_VSOCK_CID, QGS_VSOCK_PORT)
+    _qgs_client = None
+
     def __init__(self):
         self.device_node_name = None
         self.operators = None
@@ -105,23 +125,39 @@ class DeviceNode:
         self.tdquote = None
 
     def _determine_device_node(self):
-        if os.path.exists(DEVICE_NODE_NAME_DEPRECATED):
+        probed = DeviceNode._probed_device
+        if probed is None:
+            probed = self._probe_device_node()
+            DeviceNode._probed_device = probed
+        self.device_node_name, self.operators = probed
+
+    @classmethod
+    def _probe_device_node(cls):
+        backend = get_device_backend()
+        if backend.exists(DEVICE_NODE_NAME_DEPRECATED):
             LOG.error("Deprecated device node %s, please upgrade to use %s or %s",
                       DEVICE_NODE_NAME_DEPRECATED, DEVICE_NODE_NAME_1_0, DEVICE_NODE_NAME_1_5)
-            return
+            return (None, None)
+
+        for dom in cls.DEVICE_OPERATOR_MAPS:
+            if  backend.exists(dom.device_node):
+                return (dom.device_node, dom.operators)
+        return (None, None)
 
-        for dom in self.DEVICE_OPERATOR_MAPS:
-            if  os.path.exists(dom.device_node):
-                self.device_node_name = dom.device_node
-                self.operators = dom.operators
-                break
+    @classmethod
+    def reset_probe(cls):
+        '''
+        Method reset_probe forgets the probed device node, so that the next
+        instance probes the device paths again.
+        '''
+        cls._probed_device = None
 
-        if self.device_node_name is None:
-            for dom in self.DEVICE_OPERATOR_MAPS:
-                if  os.path.exists(dom.device_node):
-                    self.device_node_name = dom.device_node
-                    self.operators = dom.operators
-                    break
+    def open_session(self):
+        '''
+        Method open_session opens a long-lived DeviceSession on this device
+        node.
+        '''
+        return DeviceSession(self)
 
     def get_tdreport_bytes(self, report_data=None):
         '''
@@ -141,7 +177,7 @@ class DeviceNode:
 
         # 2. Get device file descriptor
         try:
-            fd_tdx_device = os.open(self.device_node_name, os.O_RDWR)
+            fd_tdx_device = get_device_backend().open(self.device_node_name, os.O_RDWR)
         except (PermissionError, IOError, OSError):
             LOG.error("Fail to open file %s", self.device_node_name)
             return None
@@ -151,14 +187,14 @@ class DeviceNode:
 
         # 4. Retrieve tdreport
         try:
-            fcntl.ioctl(fd_tdx_device,
+            get_device_backend().ioctl(fd_tdx_device,
                 operator,
                 req)
         except OSError:
             LOG.error("Fail to execute ioctl for file %s", self.device_node_name)
-            os.close(fd_tdx_device)
+            get_device_backend().close(fd_tdx_device)
             return None
-        os.close(fd_tdx_device)
+        get_device_backend().close(fd_tdx_device)
 
         # 5. Get tdreport bytes form tdx_report_req
         tdreport_bytes = self.get_tdreport_bytes_from_req(req)
@@ -178,8 +214,8 @@ class DeviceNode:
 
         if self.device_node_name == DEVICE_NODE_NAME_1_0:
             self.reportdata = ctypes.create_string_buffer(TDX_REPORTDATA_LEN)
-            for index in range(length):
-                self.reportdata[index] = report_data[index]
+            if length > 0:
+                ctypes.memmove(self.reportdata, bytes(report_data), length)
             self.tdreport = ctypes.create_string_buffer(TDX_REPORT_LEN)
             req = struct.pack("BQLQL", 0, ctypes.addressof(self.reportdata), TDX_REPORTDATA_LEN,
                     ctypes.addressof(self.tdreport), TDX_REPORT_LEN)
@@ -187,8 +223,8 @@ class DeviceNode:
 
         if self.device_node_name == DEVICE_NODE_NAME_1_5:
             req = bytearray(TDX_REPORTDATA_LEN + TDX_REPORT_LEN)
-            for index in range(length):
-                req[index] = report_data[index]
+            if length > 0:
+                req[0:length] = bytes(report_data)
             return req
         return None
 
@@ -206,60 +242,32 @@ class DeviceNode:
             return tdreport_bytes
         return None
 
-    def qgs_msg_quote_req(self, tdreport):
-        '''
-        Method qgs_msg_quote_req generates QGS messages for tdquote
-        Refer: https://github.com/intel/SGXDataCenterAttestationPrimitives
-        qgs_msg_header_t & qgs_msg_get_quote_req_t
-        uint16_t major_version = 1;
-        uint16_t minor_version = 0;
-        uint32_t type = 0 (GET_QUOTE_REQ);
-        // size of the whole message, include this header, in byte
-        uint32_t size = header + report_size + id_list_size;
-        uint32_t error_code = 0; // used in response only
-
-        uint32_t report_size = report_size; // cannot be 0
-        uint32_t id_list_size = 0; // length of id_list, in byte, can be 0
-        uint8_t report_id_list[] = NULL;
-        '''
-        major_version = 1
-        minor_version = 0
-        msg_type = 0
-        error_code = 0
-        msg_size = 0
-        report_size = 0
-        id_list_size = 0
-
-        if tdreport is not None:
-            report_size = len(tdreport)
-        # sizeof(qgs_msg_get_quote_req_t)
-        msg_size = 16 + 8 + report_size
-
-        qgs_msg = struct.pack(f"2H5I{report_size}s", major_version, minor_version, msg_type,
-                    msg_size, error_code, report_size, id_list_size, tdreport)
-        return qgs_msg
-
-    def qgs_msg_quote_resp(self, buf):
-        '''
-        Method qgs_msg_quote_resp parse tdquote from the response of QGS
-        Refer: https://github.com/intel/SGXDataCenterAttestationPrimitives
-        qgs_msg_header_t & qgs_msg_get_quote_resp_t
-        uint16_t major_version = 1;
-        uint16_t minor_version = 0;
-        uint32_t type = 1 (GET_QUOTE_RESP);
-        uint32_t size = header + quote;
-        uint32_t error_code = 0; // used in response only
-
-        uint32_t selected_id_size;  // can be 0 in case only one id is sent in request
-        uint32_t quote_size;        // length of quote_data, in byte
-        uint8_t id_quote[];         // selected id followed by quote
-        '''
-        msg_size = len(buf) - (16 + 8)
-        major_version, minor_version, msg_type, msg_size, error_code, _, quote_size, quote = \
-            struct.unpack(f"2H5I{msg_size}s", buf)
-        if major_version != 1 and minor_version != 0 and msg_type != 1 and error_code != 0:
-            return None
-        return quote[:quote_size]
+    @staticmethod
+    def qgs_msg_quote_req(tdreport):
+        '''
+        Method qgs_msg_quote_req generates QGS messages for tdquote,
+        see qgs.qgs_msg_quote_req.
+        '''
+        return qgs_msg_quote_req(tdreport)
+
+    @staticmethod
+    def qgs_msg_quote_resp(buf):
+        '''
+        Method qgs_msg_quote_resp parse tdquote from the response of QGS,
+        see qgs.qgs_msg_quote_resp.
+        '''
+        return qgs_msg_quote_resp(buf)
+
+    @classmethod
+    def get_qgs_client(cls):
+        '''
+        Method get_qgs_client returns the QgsClient shared by the process,
+        connected to QGS_ADDRESS, for the device nodes without the
+        GET_TDQUOTE operation.
+        '''
+        if cls._qgs_client is None:
+            cls._qgs_client = QgsClient(cls.QGS_ADDRESS)
+        return cls._qgs_client
 
     def get_tdquote_bytes(self, report_data=None):
         '''
@@ -271,10 +279,21 @@ class DeviceNode:
             LOG.error("Get TD report failed")
             return None
 
+        return self.get_tdquote_bytes_from_report(tdreport_bytes)
+
+    def get_tdquote_bytes_from_report(self, tdreport_bytes):
+        '''
+        Method get_tdquote_bytes_from_report requests the tdx device to
+        retrive the tdquote of a tdreport already generated.
+        '''
+        if self.operators is not None and self.GET_TDQUOTE not in self.operators:
+            # No GetQuote ioctl on this device node, ask QGS directly
+            return self.get_qgs_client().get_quote(tdreport_bytes)
+
         tdquote_req = self.create_tdx_quote_req(tdreport_bytes)
 
         try:
-            fd_tdx_device = os.open(self.device_node_name, os.O_RDWR)
+            fd_tdx_device = get_device_backend().open(self.device_node_name, os.O_RDWR)
         except (PermissionError, IOError, OSError):
             LOG.error("Fail to open file %s", self.device_node_name)
             return None
@@ -286,14 +305,14 @@ class DeviceNode:
             return None
 
         try:
-            fcntl.ioctl(fd_tdx_device,
+            get_device_backend().ioctl(fd_tdx_device,
                 operator,
                 tdquote_req)
         except OSError:
             LOG.error("Fail to execute tdquote ioctl for file %s", self.device_node_name)
-            os.close(fd_tdx_device)
+            get_device_backend().close(fd_tdx_device)
             return None
-        os.close(fd_tdx_device)
+        get_device_backend().close(fd_tdx_device)
 
         # # # 7. Get tdreport bytes form tdx_quote_req
         tdquote_bytes = self.get_tdquote_bytes_from_req(tdquote_req)
@@ -317,7 +336,6 @@ class DeviceNode:
             __u64 data[0];
         };
         '''
-        report_size = len(tdreport)
         version = 1
         status = 0
         in_len = 0
@@ -327,7 +345,7 @@ class DeviceNode:
         in_len = len(qgs_msg) + 4
 
         if self.device_node_name == DEVICE_NODE_NAME_1_0:
-            tdquote_hdr = struct.pack(f"QQII4s{report_size}s", version, status, in_len, out_len,
+            tdquote_hdr = struct.pack(f"QQII4s{len(qgs_msg)}s", version, status, in_len, out_len,
                             len(qgs_msg).to_bytes(4, "big"), qgs_msg)
             self.tdquote = ctypes.create_string_buffer(TDX_QUOTE_LEN)
             self.tdquote[:len(tdquote_hdr)] = tdquote_hdr
@@ -380,6 +398,125 @@ class DeviceNode:
             val = TCB_INFO_VALID_VAL_1_5
         return val
 
+class DeviceSession:
+    '''
+    DeviceSession keeps the tdx device node open to generate TD reports at a
+    high rate. The request buffers are allocated once and reused, and a lock
+    serializes the ioctls, so one session can be shared across threads.
+
+    Use it as a context manager, or call close() when done.
+    '''
+
+    def __init__(self, device_node=None):
+        if device_node is None:
+            device_node = DeviceNode()
+        self.device_node = device_node
+        self._backend = get_device_backend()
+        self._fd = None
+        self._lock = threading.Lock()
+        self._operator = None
+        self._req = None
+        self._reportdata = None
+        self._tdreport = None
+        self._open()
+
+    def _open(self):
+        name = self.device_node.device_node_name
+        if name is None or self.device_node.operators is None:
+            LOG.error("Invalid device node: %s", name)
+            return
+
+        self._operator = self.device_node.operators.get(DeviceNode.GET_TDREPORT)
+        if self._operator is None:
+            LOG.error("Device %s not support operation %s", name, DeviceNode.GET_TDREPORT)
+            return
+
+        if name == DEVICE_NODE_NAME_1_0:
+            # struct tdx_report_req points to the report data and report
+            # buffers, which stay at the same addresses for the session
+            self._reportdata = ctypes.create_string_buffer(TDX_REPORTDATA_LEN)
+            self._tdreport = ctypes.create_string_buffer(TDX_REPORT_LEN)
+            self._req = struct.pack("BQLQL", 0, ctypes.addressof(self._reportdata),
+                TDX_REPORTDATA_LEN, ctypes.addressof(self._tdreport), TDX_REPORT_LEN)
+        elif name == DEVICE_NODE_NAME_1_5:
+            # struct tdx_report_req holds the report data and the report
+            self._req = bytearray(TDX_REPORTDATA_LEN + TDX_REPORT_LEN)
+        else:
+            LOG.error("Device %s is not supported", name)
+            return
+
+        try:
+            self._fd = self._backend.open(name, os.O_RDWR)
+        except (PermissionError, IOError, OSError):
+            LOG.error("Fail to open file %s", name)
+
+    @property
+    def is_open(self):
+        '''
+        Whether the device node is open
+        '''
+        return self._fd is not None
+
+    def _get_report_locked(self, report_data):
+        report_data = bytes(report_data) if report_data is not None else b""
+        if len(report_data) > TDX_REPORTDATA_LEN:
+            LOG.error("Input report_data is longer than TDX_REPORTDATA_LEN")
+            return None
+        report_data = report_data.ljust(TDX_REPORTDATA_LEN, b"\0")
+
+        if self._tdreport is not None:
+            ctypes.memmove(self._reportdata, report_data, TDX_REPORTDATA_LEN)
+        else:
+            self._req[0:TDX_REPORTDATA_LEN] = report_data
+
+        try:
+            self._backend.ioctl(self._fd, self._operator, self._req)
+        except OSError:
+            LOG.error("Fail to execute ioctl for file %s",
+                      self.device_node.device_node_name)
+            return None
+
+        if self._tdreport is not None:
+            return self._tdreport.raw
+        return bytes(memoryview(self._req)[TDX_REPORTDATA_LEN:])
+
+    def get_report(self, report_data=None):
+        '''
+        Method get_report retrieves one tdreport in bytes format, bound to
+        report_data of at most TDX_REPORTDATA_LEN bytes.
+        '''
+        return self.get_reports([report_data])[0]
+
+    def get_reports(self, batch_of_report_data):
+        '''
+        Method get_reports retrieves one tdreport per report data of the
+        batch, holding the device for the whole batch. A failed report is
+        None in the returned list.
+        '''
+        batch_of_report_data = list(batch_of_report_data)
+        with self._lock:
+            if self._fd is None:
+                LOG.error("Device node %s is not open", self.device_node.device_node_name)
+                return [None] * len(batch_of_report_data)
+            return [self._get_report_locked(report_data)
+                    for report_data in batch_of_report_data]
+
+    def close(self):
+        '''
+        Method close closes the device node.
+        '''
+        with self._lock:
+            if self._fd is not None:
+                self._backend.close(self._fd)
+                self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class ModuleVersion:
     '''
     class ModuleVersion contains version infomation of tdx module
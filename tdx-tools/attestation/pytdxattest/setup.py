@@ -27,13 +27,22 @@ setup(
     version='0.0.11',
     packages=['pytdxattest'],
     package_data={
-        '': ['tdx_eventlogs', 'tdx_tdreport', 'tdx_verify_rtmr', 'tdx_extend_rtmr', 'tdx_quote']
+        '': ['tdx_eventlogs', 'tdx_tdreport', 'tdx_verify_rtmr', 'tdx_extend_rtmr', 'tdx_quote',
+             'tdx_batch_verify', 'tdx_verify_quote', 'tdx_eventlog_diff',
+             'tdx_appraise', 'tdx_evidence', 'tdxattest']
     },
     include_package_data=True,
     python_requires='>=3.6.8',
     license='Apache License 2.0',
-    scripts=['tdx_eventlogs', 'tdx_tdreport', 'tdx_verify_rtmr', 'tdx_extend_rtmr', 'tdx_quote'],
+    scripts=['tdx_eventlogs', 'tdx_tdreport', 'tdx_verify_rtmr', 'tdx_extend_rtmr', 'tdx_quote',
+             'tdx_batch_verify', 'tdx_verify_quote', 'tdx_eventlog_diff',
+             'tdx_appraise', 'tdx_evidence', 'tdxattest'],
     long_description=load_readme(),
     long_description_content_type='text/markdown',
-    install_requires=load_requirements()
+    install_requires=load_requirements(),
+    extras_require={
+        'columnar': ['numpy'],
+        'verify': ['cryptography>=40'],
+        'compress': ['zstandard', 'lz4']
+    }
 )
@@ -0,0 +1,143 @@
+"""
+Fixtures of the pytdxattest unit tests, which run without a TD guest: the
+TDX guest device emulator and synthetic PCK certificate chains and quotes.
+"""
+
+import os
+import sys
+import struct
+import hashlib
+import datetime
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+__author__ = "cpio"
+
+# Disable redefined-outer-name since it is false positive for pytest's fixture
+# pylint: disable=redefined-outer-name,import-outside-toplevel
+
+NOT_BEFORE = datetime.datetime(2024, 1, 1)
+
+
+@pytest.fixture(autouse=True)
+def emulator(monkeypatch):
+    """
+    Run every test against the TDX guest device emulator
+    """
+    monkeypatch.setenv("PYTDXATTEST_DEVICE", "emulator")
+
+
+class Pki:
+    """
+    Builder of ECDSA P-256 certificates and of TD quotes signed through a
+    PCK certificate chain, in the layout of the quote generation library
+    """
+
+    def __init__(self):
+        self.x509 = pytest.importorskip("cryptography.x509")
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        self._hashes = hashes
+        self._serialization = serialization
+        self._ec = ec
+
+    def key(self):
+        """
+        New P-256 private key
+        """
+        return self._ec.generate_private_key(self._ec.SECP256R1())
+
+    def certificate(self, subject, public_key, issuer=None, signer=None, *, ca=False,
+                    path_length=None, key_cert_sign=None, days=3650 * 3):
+        """
+        Certificate of the subject signed by the issuer key, self-signed
+        without issuer
+        """
+        x509 = self.x509
+        name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, subject)])
+        issuer_name = name if issuer is None else issuer.subject
+        key_cert_sign = ca if key_cert_sign is None else key_cert_sign
+        builder = (x509.CertificateBuilder()
+                   .subject_name(name).issuer_name(issuer_name)
+                   .public_key(public_key).serial_number(x509.random_serial_number())
+                   .not_valid_before(NOT_BEFORE)
+                   .not_valid_after(NOT_BEFORE + datetime.timedelta(days=days))
+                   .add_extension(x509.BasicConstraints(ca=ca, path_length=path_length),
+                                  critical=True)
+                   .add_extension(x509.KeyUsage(
+                       digital_signature=not ca, content_commitment=False,
+                       key_encipherment=False, data_encipherment=False, key_agreement=False,
+                       key_cert_sign=key_cert_sign, crl_sign=ca, encipher_only=False,
+                       decipher_only=False), critical=True))
+        return builder.sign(signer, self._hashes.SHA256())
+
+    def pem(self, *certificates):
+        """
+        PEM chain of the certificates
+        """
+        return b"".join(certificate.public_bytes(self._serialization.Encoding.PEM)
+                        for certificate in certificates)
+
+    def chain(self, root_days=3650 * 3):
+        """
+        Root CA, platform CA and PCK certificate, return the PCK key, the
+        PEM chain from the PCK certificate up and the PEM of the root
+        """
+        root_key, inter_key, pck_key = self.key(), self.key(), self.key()
+        root = self.certificate("Root CA", root_key.public_key(), signer=root_key, ca=True,
+                                path_length=1, days=root_days)
+        inter = self.certificate("Platform CA", inter_key.public_key(), root, root_key,
+                                 ca=True, path_length=0)
+        pck = self.certificate("PCK Certificate", pck_key.public_key(), inter, inter_key)
+        return pck_key, self.pem(pck, inter, root), self.pem(root)
+
+    def raw_signature(self, key, data):
+        """
+        ECDSA P-256 SHA-256 signature as r || s
+        """
+        from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+        r, s = decode_dss_signature(key.sign(bytes(data), self._ec.ECDSA(self._hashes.SHA256())))
+        return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+    def raw_public_key(self, key):
+        """
+        Public key as x || y
+        """
+        return key.public_key().public_bytes(
+            self._serialization.Encoding.X962,
+            self._serialization.PublicFormat.UncompressedPoint)[1:]
+
+    def quote(self, pck_key, pem, report_data=b"", qe_auth_data=b"\x11" * 32,
+              bound_auth_data=None):
+        """
+        TD quote v4 signed by a new attestation key, whose QE report is
+        signed by the PCK key. The QE report data binds bound_auth_data,
+        the QE authentication data by default.
+        """
+        attestation_key = self.key()
+        header = struct.pack("<HHLHH", 4, 2, 0x81, 0, 0) + b"\x93\x9a\x72\x33" + bytes(32)
+        body = bytearray(hashlib.sha384(b"body").digest() * 13)[:584]
+        body[0x208:0x248] = report_data.ljust(64, b"\0")
+        signed = header + bytes(body)
+
+        raw_key = self.raw_public_key(attestation_key)
+        bound = qe_auth_data if bound_auth_data is None else bound_auth_data
+        qe_report = bytearray(384)
+        qe_report[0x140:0x160] = hashlib.sha256(raw_key + bound).digest()
+        qe_report = bytes(qe_report)
+        qe_data = (qe_report + self.raw_signature(pck_key, qe_report) +
+                   struct.pack("<H", len(qe_auth_data)) + qe_auth_data +
+                   struct.pack("<HL", 5, len(pem)) + pem)
+        signature = (self.raw_signature(attestation_key, signed) + raw_key +
+                     struct.pack("<HL", 6, len(qe_data)) + qe_data)
+        return signed + struct.pack("<L", len(signature)) + signature
+
+
+@pytest.fixture
+def pki():
+    """
+    Builder of certificates and signed quotes, the test is skipped without
+    the cryptography package
+    """
+    return Pki()
@@ -0,0 +1,110 @@
+"""
+Tests of the incremental replay of the event log
+"""
+
+import pytest
+
+from pytdxattest.actor import TDEventLogActor
+from pytdxattest.emulator import build_event_log
+from pytdxattest.source import DataSource
+from pytdxattest.tdeventlog import TCGAlgorithmRegistry
+
+__author__ = "cpio"
+
+SHA384 = TCGAlgorithmRegistry.TPM_ALG_SHA384
+ALGORITHMS = (TCGAlgorithmRegistry.TPM_ALG_SHA256, SHA384, TCGAlgorithmRegistry.TPM_ALG_SHA512)
+
+
+class LogSource(DataSource):
+    """
+    Event log which the test grows or rewrites between two reads
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        """
+        Current data of the log
+        """
+        return self.data
+
+
+def full_replay(data):
+    """
+    Banks of a replay of the data from the start
+    """
+    actor = TDEventLogActor(0, None, data=data)
+    actor.replay()
+    return actor.get_rtmr_banks()
+
+
+def test_growing_log():
+    """
+    The events appended since the last replay extend its RTMR values
+    """
+    source = LogSource(build_event_log(0)[0])
+    actor = TDEventLogActor(0, None, source=source)
+    actor.replay()
+    checkpoint = actor.checkpoint
+    for count in (1, 5, 6, 30):
+        previous = actor.checkpoint.offset
+        source.data, rtmrs = build_event_log(count)
+        replayed = actor.replay_incremental()
+        # extended, not replayed from the start
+        assert actor.checkpoint is checkpoint
+        assert actor.checkpoint.offset > previous
+        assert actor.checkpoint.event_count == count
+        assert [replayed[index].data for index in range(len(rtmrs))] == list(rtmrs)
+        assert actor.get_rtmr_banks() == full_replay(source.data)
+
+
+@pytest.mark.parametrize("rewrite", ["digest", "truncate"])
+def test_rewritten_prefix(rewrite):
+    """
+    A log rewritten or truncated before the checkpoint is replayed from the
+    start
+    """
+    log, _ = build_event_log(12)
+    source = LogSource(log)
+    actor = TDEventLogActor(0, None, source=source)
+    actor.replay()
+
+    rewritten, _ = build_event_log(16)
+    rewritten = bytearray(rewritten)
+    if rewrite == "digest":
+        # first event, same length, other digest
+        digest = actor.get_index().get_entry(0).get_digest(SHA384)
+        rewritten[rewritten.find(bytes(digest))] ^= 1
+    else:
+        rewritten = build_event_log(4)[0]
+    source.data = bytes(rewritten)
+    checkpoint = actor.checkpoint
+    actor.replay_incremental()
+    assert actor.checkpoint is not checkpoint
+    assert actor.checkpoint.event_count == (16 if rewrite == "digest" else 4)
+    assert actor.get_rtmr_banks() == full_replay(source.data)
+    assert actor.checkpoint.is_valid_for(source.data)
+    # the 4 events are a prefix of the original log
+    assert actor.checkpoint.is_valid_for(log) is (rewrite == "truncate")
+
+
+def test_multi_bank():
+    """
+    Every digest algorithm of the spec ID header is replayed incrementally
+    in its own bank
+    """
+    source = LogSource(build_event_log(7, algorithms=ALGORITHMS)[0])
+    actor = TDEventLogActor(0, None, source=source)
+    actor.replay()
+    checkpoint = actor.checkpoint
+    source.data, rtmrs = build_event_log(20, algorithms=ALGORITHMS)
+    actor.replay_incremental()
+    assert actor.checkpoint is checkpoint
+    banks = actor.get_rtmr_banks()
+    assert sorted(banks) == sorted(ALGORITHMS)
+    assert banks == full_replay(source.data)
+    assert [banks[SHA384][index] for index in range(len(rtmrs))] == list(rtmrs)
+    for algoid in ALGORITHMS:
+        size = TCGAlgorithmRegistry.get_hash_function(algoid)().digest_size
+        assert {len(value) for value in banks[algoid].values()} == {size}
@@ -0,0 +1,73 @@
+"""
+Tests of the columnar export of event logs
+"""
+
+import pytest
+
+from pytdxattest.actor import TDEventLogActor
+from pytdxattest.columnar import TDEventLogColumns, SPECID_SIGNATURE
+from pytdxattest.emulator import build_event_log
+from pytdxattest.tdeventlog import TCGAlgorithmRegistry
+
+__author__ = "cpio"
+
+pytest.importorskip("numpy")
+
+SHA256 = TCGAlgorithmRegistry.TPM_ALG_SHA256
+
+
+def event_log(count, algorithms=(TCGAlgorithmRegistry.TPM_ALG_SHA384,)):
+    """
+    Event log data without its padding, and the length of its spec ID
+    header
+    """
+    log, _ = build_event_log(count, algorithms=algorithms)
+    actor = TDEventLogActor(0, None, data=log)
+    actor.replay()
+    return log[:actor.checkpoint.offset], actor.checkpoint.specid_header.length
+
+
+def test_columns():
+    """
+    The columns hold one row per entry
+    """
+    log, _ = event_log(10)
+    columns = TDEventLogColumns.from_data(log)
+    assert len(columns) == 10
+    assert columns.digest.shape == (10, 48)
+
+
+def test_truncated_specid_header():
+    """
+    A spec ID header cut at any point raises ValueError
+    """
+    log, header_length = event_log(1)
+    for length in range(8, header_length):
+        with pytest.raises(ValueError, match="spec ID header"):
+            TDEventLogColumns.from_data(log[:length])
+        with pytest.raises(ValueError, match="spec ID header"):
+            TDEventLogColumns.from_data(log, log_length=length)
+
+
+def test_unknown_specid_header():
+    """
+    An EV_NO_ACTION entry which is not a spec ID header raises ValueError
+    """
+    log, _ = event_log(1)
+    start = log.index(SPECID_SIGNATURE)
+    log = log[:start] + b"Unknown Event00\0" + log[start + len(SPECID_SIGNATURE):]
+    with pytest.raises(ValueError, match="Unknown spec ID header"):
+        TDEventLogColumns.from_data(log)
+
+
+def test_mixed_digest_widths():
+    """
+    Digests of different widths in one column raise ValueError
+    """
+    # SHA256 digests, then entries of a log without SHA256 which get the
+    # SHA384 wide missing digest
+    sha256_log, _ = event_log(3, algorithms=(SHA256,))
+    sha384_log, _ = event_log(3)
+    assert TDEventLogColumns.from_data(sha256_log, algorithm=SHA256).digest.shape == (3, 32)
+    with pytest.raises(ValueError, match="Digest of 48 bytes"):
+        TDEventLogColumns.from_data(sha256_log + sha384_log, algorithm=SHA256)
@@ -0,0 +1,141 @@
+"""
+Tests of the evidence bundle container
+"""
+
+import io
+import pytest
+
+from pytdxattest.cli import _open_append_atomic
+from pytdxattest.evidence import EvidenceBundle, EvidenceReader, EvidenceWriter, \
+    encode_bundle, decode_bundle, RECORD_HEADER, SECTION_ENTRY, SECTION_EVENTLOG, \
+    SECTION_METADATA, SECTION_TDREPORT, COMPRESSION_NONE, COMPRESSION_ZLIB, \
+    COMPRESSION_ZSTD, COMPRESSION_LZ4
+
+__author__ = "cpio"
+
+# pylint: disable=redefined-outer-name
+
+
+class NonSeekable(io.RawIOBase):
+    """
+    Read-only stream that cannot seek, as a pipe
+    """
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def make_bundle(bundle_id="td-1"):
+    """
+    Bundle with an event log, a TD report and metadata
+    """
+    return EvidenceBundle(bundle_id, {
+        SECTION_EVENTLOG: bytes(range(256)) * 16,
+        SECTION_TDREPORT: b"\x5a" * 1024,
+        SECTION_METADATA: b'{"tdx_version": "1.0"}',
+    })
+
+
+@pytest.fixture(params=[COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_ZSTD, COMPRESSION_LZ4])
+def compression(request):
+    """
+    Each compression, the optional ones only if installed
+    """
+    if request.param == COMPRESSION_ZSTD:
+        pytest.importorskip("zstandard")
+    if request.param == COMPRESSION_LZ4:
+        pytest.importorskip("lz4.frame")
+    return request.param
+
+
+def test_round_trip(compression):
+    """
+    A decoded record has the id, sections and digests of the bundle
+    """
+    bundle = make_bundle()
+    decoded = decode_bundle(encode_bundle(bundle, compression))
+    assert decoded.id == bundle.id
+    assert decoded.sections == bundle.sections
+    for stype in bundle.sections:
+        assert decoded.digest(stype) == bundle.digest(stype)
+    assert decoded.metadata == {"tdx_version": "1.0"}
+
+
+def test_wrong_section_digest():
+    """
+    A section not matching the digest of the section table is rejected
+    """
+    record = bytearray(encode_bundle(make_bundle(), COMPRESSION_NONE))
+    # last byte of the digest of the first section
+    record[RECORD_HEADER.size + len(b"td-1") + SECTION_ENTRY.size - 1] ^= 1
+    with pytest.raises(ValueError, match="Wrong digest"):
+        decode_bundle(bytes(record))
+    assert decode_bundle(bytes(record), verify=False).id == "td-1"
+
+
+def test_truncated_record():
+    """
+    A truncated record is rejected by decode_bundle and by the reader
+    """
+    record = encode_bundle(make_bundle(), COMPRESSION_ZLIB)
+    for length in (RECORD_HEADER.size - 1, len(record) - 1):
+        with pytest.raises(ValueError, match="Truncated"):
+            decode_bundle(record[:length])
+    stream = io.BytesIO(record + record[:-1])
+    records = EvidenceReader(stream).iter_records()
+    assert next(records) == record
+    with pytest.raises(ValueError, match="Truncated evidence record at offset"):
+        next(records)
+
+
+@pytest.mark.parametrize("seekable", [True, False])
+def test_scan(seekable):
+    """
+    scan() yields the offset, length and section table of each record
+    """
+    records = [encode_bundle(make_bundle(f"td-{index}"), COMPRESSION_ZLIB)
+               for index in range(3)]
+    data = b"".join(records)
+    stream = io.BytesIO(data) if seekable else io.BufferedReader(NonSeekable(data))
+    assert stream.seekable() is seekable
+    scanned = list(EvidenceReader(stream).scan())
+    assert [record["id"] for record in scanned] == ["td-0", "td-1", "td-2"]
+    offset = 0
+    for record, raw in zip(scanned, records):
+        assert record["offset"] == offset
+        assert record["length"] == len(raw)
+        assert record["sections"][SECTION_EVENTLOG] == \
+            (4096, make_bundle().digest(SECTION_EVENTLOG))
+        offset += len(raw)
+
+
+def test_append_to_existing_file(tmp_path):
+    """
+    Records are appended after the ones of an existing file, which is left
+    as it was if an error is raised
+    """
+    path = tmp_path / "evidence.bin"
+    with _open_append_atomic(path) as output_file, EvidenceWriter(output_file) as writer:
+        writer.write(make_bundle("td-0"))
+    with _open_append_atomic(path) as output_file, EvidenceWriter(output_file) as writer:
+        writer.write(make_bundle("td-1").to_dict())
+    content = path.read_bytes()
+
+    with pytest.raises(RuntimeError):
+        with _open_append_atomic(path) as output_file, EvidenceWriter(output_file) as writer:
+            writer.write(make_bundle("td-2"))
+            raise RuntimeError("interrupted")
+    assert path.read_bytes() == content
+
+    with open(path, "rb") as evidence_file:
+        bundles = list(EvidenceReader(evidence_file))
+    assert [bundle.id for bundle in bundles] == ["td-0", "td-1"]
+    assert bundles[1].sections == make_bundle().sections
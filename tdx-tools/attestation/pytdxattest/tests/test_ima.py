@@ -0,0 +1,88 @@
+"""
+Tests of the IMA measurement list follower
+"""
+
+import struct
+import hashlib
+
+from pytdxattest.ima import ImaFollower, iter_ima_entries
+from pytdxattest.rtmr import RTMRExtender
+
+__author__ = "cpio"
+
+
+def ima_entry(name, algorithm=b"sha384", template=b"ima-ng", template_data=None):
+    """
+    Binary measurement list entry of a file, with the SHA-384 digest of its
+    name
+    """
+    if template_data is None:
+        field = algorithm + b":\0" + hashlib.sha384(name).digest()
+        template_data = struct.pack("=I", len(field)) + field + \
+            struct.pack("=I", len(name) + 1) + name + b"\0"
+    return struct.pack("=I", 10) + bytes(20) + struct.pack("=I", len(template)) + template + \
+        struct.pack("=I", len(template_data)) + template_data
+
+
+class FakeExtender:
+    """
+    Extender recording the digests
+    """
+
+    def __init__(self):
+        self.digests = []
+
+    def extend_all(self, digests, _):
+        """
+        Record the digests
+        """
+        self.digests += digests
+        return len(digests)
+
+    def close(self):
+        """
+        Nothing to close
+        """
+
+
+def test_malformed_entry():
+    """
+    The entries stop before an entry with malformed template data, and the
+    checkpoint does not move past it
+    """
+    malformed = ima_entry(b"/bad", template_data=b"\x00\x00")
+    data = ima_entry(b"/a") + ima_entry(b"/b") + malformed + ima_entry(b"/c")
+    entries = list(iter_ima_entries(data))
+    assert [entry.filename for entry, _ in entries] == ["/a", "/b"]
+    assert entries[-1][1] == data.index(malformed)
+
+
+def test_poll_stops_at_malformed_entry(tmp_path):
+    """
+    A poll extends the entries before a malformed one and resumes there
+    """
+    measurements = tmp_path / "measurements"
+    malformed = ima_entry(b"/bad", template_data=b"\x00\x00")
+    measurements.write_bytes(ima_entry(b"/a") + malformed)
+    extender = FakeExtender()
+    follower = ImaFollower(3, str(tmp_path / "checkpoint"), str(measurements), extender)
+    assert follower.poll() == 1
+    assert follower.poll() == 0
+    assert follower.checkpoint.offset == len(ima_entry(b"/a"))
+    assert extender.digests == [hashlib.sha384(b"/a").digest()]
+
+
+def test_poll_reopens_device(tmp_path, monkeypatch):
+    """
+    A device file which could not be opened at start is opened by a poll
+    """
+    measurements = tmp_path / "measurements"
+    measurements.write_bytes(ima_entry(b"/a") + ima_entry(b"/b"))
+    with monkeypatch.context() as patch:
+        patch.setattr(RTMRExtender, "_open", lambda self: None)
+        follower = ImaFollower(3, str(tmp_path / "checkpoint"), str(measurements))
+        assert follower.poll() == -1
+        assert follower.checkpoint.offset == 0
+    with follower:
+        assert follower.poll() == 2
+        assert follower.checkpoint.count == 2
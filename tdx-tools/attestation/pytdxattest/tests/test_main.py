@@ -0,0 +1,39 @@
+"""
+Tests of the tdxattest entry point
+"""
+
+import sys
+import subprocess
+
+from pytdxattest import main
+from pytdxattest.output import OUTPUT_FORMATS, FORMAT_TEXT
+from pytdxattest.tdeventlog import TCGAlgorithmRegistry
+
+__author__ = "cpio"
+
+
+def test_main_imports_no_subcommand_module():
+    """
+    Importing the entry point imports no other module of the package
+    """
+    code = "import sys, pytdxattest.main; " \
+        "print(sorted(name for name in sys.modules if name.startswith('pytdxattest.')))"
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True,
+                            text=True, cwd=main.__file__.rsplit("/", 2)[0]).stdout
+    assert output.strip() == "['pytdxattest.main']"
+
+
+def test_inlined_choices():
+    """
+    The choices inlined in the arguments match the modules they come from
+    """
+    args = main.build_parser().parse_args(["tdreport"])
+    assert args.output_format == FORMAT_TEXT
+    subparsers = main.build_parser()._subparsers._group_actions[0] # pylint: disable=protected-access
+    choices = {action.dest: action.choices
+               for name in ("tdreport", "eventlog-diff")
+               for action in subparsers.choices[name]._actions} # pylint: disable=protected-access
+    assert tuple(choices["output_format"]) == OUTPUT_FORMATS
+    for name in choices["algorithm"]:
+        assert TCGAlgorithmRegistry.get_hash_function(
+            getattr(TCGAlgorithmRegistry, "TPM_ALG_" + name.upper())) is not None
@@ -0,0 +1,142 @@
+"""
+Tests of the offline verification of TD quote signatures
+"""
+
+import datetime
+import pytest
+
+from pytdxattest.quoteverify import QuoteVerifier, CHECK_PCK_CERT_CHAIN, \
+    CHECK_QE_REPORT_SIGNATURE, CHECK_QE_REPORT_DATA, CHECK_QUOTE_SIGNATURE
+
+__author__ = "cpio"
+
+# pylint: disable=redefined-outer-name
+
+
+@pytest.fixture
+def platform(pki):
+    """
+    PCK key, PEM chain and verifier trusting the root of a platform
+    """
+    pck_key, pem, root_pem = pki.chain()
+    return pck_key, pem, QuoteVerifier([root_pem])
+
+
+def test_valid_quote(pki, platform):
+    """
+    A quote signed through a trusted chain passes every check
+    """
+    pck_key, pem, verifier = platform
+    result = verifier.verify(pki.quote(pck_key, pem, b"nonce"))
+    assert result["status"] == "pass"
+    assert result["checks"] == {CHECK_PCK_CERT_CHAIN: True, CHECK_QE_REPORT_SIGNATURE: True,
+                                CHECK_QE_REPORT_DATA: True, CHECK_QUOTE_SIGNATURE: True}
+    assert result["report_data"].startswith(b"nonce".hex())
+
+
+def test_wrong_root(pki, platform):
+    """
+    A chain up to another root is not trusted
+    """
+    _, _, verifier = platform
+    other_key, other_pem, _ = pki.chain()
+    result = verifier.verify(pki.quote(other_key, other_pem))
+    assert result["status"] == "fail"
+    assert result["checks"] == {CHECK_PCK_CERT_CHAIN: False}
+
+
+def test_expired_certificate(pki, platform):
+    """
+    A quote verified after the validity period of the chain fails
+    """
+    pck_key, pem, verifier = platform
+    quote = pki.quote(pck_key, pem)
+    assert verifier.verify(quote)["status"] == "pass"
+    later = datetime.datetime(2060, 1, 1, tzinfo=datetime.timezone.utc)
+    result = verifier.verify(quote, later)
+    assert result["checks"] == {CHECK_PCK_CERT_CHAIN: False}
+
+
+def test_tampered_qe_report(pki, platform):
+    """
+    A QE report changed after its signature by the PCK key fails
+    """
+    pck_key, pem, verifier = platform
+    quote = bytearray(pki.quote(pck_key, pem))
+    # first byte of the QE report, after the signed data, its signature
+    # data length, the quote signature, the attestation key and the
+    # certification data header
+    quote[632 + 4 + 64 + 64 + 6] ^= 1
+    result = verifier.verify(bytes(quote))
+    assert result["status"] == "fail"
+    assert result["checks"][CHECK_QE_REPORT_SIGNATURE] is False
+
+
+def test_broken_qe_report_data_binding(pki, platform):
+    """
+    A QE report data not binding the attestation key and the QE
+    authentication data fails
+    """
+    pck_key, pem, verifier = platform
+    result = verifier.verify(pki.quote(pck_key, pem, bound_auth_data=b"other"))
+    assert result["status"] == "fail"
+    assert result["checks"][CHECK_QE_REPORT_SIGNATURE] is True
+    assert result["checks"][CHECK_QE_REPORT_DATA] is False
+
+
+def test_tampered_body(pki, platform):
+    """
+    A quote body changed after its signature fails
+    """
+    pck_key, pem, verifier = platform
+    quote = bytearray(pki.quote(pck_key, pem))
+    quote[0x100] ^= 1
+    result = verifier.verify(bytes(quote))
+    assert result["status"] == "fail"
+    assert result["checks"][CHECK_QE_REPORT_DATA] is True
+    assert result["checks"][CHECK_QUOTE_SIGNATURE] is False
+
+
+def test_issuer_not_a_ca(pki):
+    """
+    A PCK certificate issued by an end-entity certificate under the
+    trusted root is rejected
+    """
+    root_key, leaf_key, pck_key = pki.key(), pki.key(), pki.key()
+    root = pki.certificate("Root CA", root_key.public_key(), signer=root_key, ca=True)
+    leaf = pki.certificate("End Entity", leaf_key.public_key(), root, root_key)
+    pck = pki.certificate("PCK Certificate", pck_key.public_key(), leaf, leaf_key)
+    verifier = QuoteVerifier([pki.pem(root)])
+    for pem in (pki.pem(pck, leaf, root), pki.pem(pck, leaf)):
+        result = verifier.verify(pki.quote(pck_key, pem))
+        assert result["checks"] == {CHECK_PCK_CERT_CHAIN: False}
+
+
+def test_issuer_without_key_cert_sign(pki):
+    """
+    A CA certificate without the keyCertSign key usage cannot issue the PCK
+    certificate
+    """
+    root_key, inter_key, pck_key = pki.key(), pki.key(), pki.key()
+    root = pki.certificate("Root CA", root_key.public_key(), signer=root_key, ca=True)
+    inter = pki.certificate("Platform CA", inter_key.public_key(), root, root_key, ca=True,
+                            key_cert_sign=False)
+    pck = pki.certificate("PCK Certificate", pck_key.public_key(), inter, inter_key)
+    verifier = QuoteVerifier([pki.pem(root)])
+    result = verifier.verify(pki.quote(pck_key, pki.pem(pck, inter, root)))
+    assert result["checks"] == {CHECK_PCK_CERT_CHAIN: False}
+
+
+def test_path_length_exceeded(pki):
+    """
+    A CA with a path length of 0 cannot issue another CA
+    """
+    root_key, inter_key, sub_key, pck_key = pki.key(), pki.key(), pki.key(), pki.key()
+    root = pki.certificate("Root CA", root_key.public_key(), signer=root_key, ca=True)
+    inter = pki.certificate("Platform CA", inter_key.public_key(), root, root_key, ca=True,
+                            path_length=0)
+    sub = pki.certificate("Sub CA", sub_key.public_key(), inter, inter_key, ca=True)
+    pck = pki.certificate("PCK Certificate", pck_key.public_key(), sub, sub_key)
+    verifier = QuoteVerifier([pki.pem(root)])
+    result = verifier.verify(pki.quote(pck_key, pki.pem(pck, sub, inter, root)))
+    assert result["checks"] == {CHECK_PCK_CERT_CHAIN: False}
@@ -0,0 +1,105 @@
+"""
+Tests of the store of reference measurements
+"""
+
+import hashlib
+import pytest
+
+from pytdxattest.actor import TDEventLogActor
+from pytdxattest.emulator import build_event_log
+from pytdxattest.refstore import ReferenceStore, LOOKUP_BATCH
+from pytdxattest.tdeventlog import TCGAlgorithmRegistry
+
+__author__ = "cpio"
+
+# pylint: disable=redefined-outer-name
+
+
+def log_manifest(log):
+    """
+    Manifest of the digests of the entries of an event log
+    """
+    index = TDEventLogActor(0, None, data=log).get_index()
+    return {"name": "fleet", "version": "1", "measurements": [
+        {"digest": index.get_entry(number).get_digest(TCGAlgorithmRegistry.TPM_ALG_SHA384).hex(),
+         "rtmr": index.get_entry(number).rtmr, "component": f"entry {number}"}
+        for number in range(len(index))]}
+
+
+@pytest.fixture
+def store(tmp_path):
+    """
+    Store in a file, which worker processes can open
+    """
+    with ReferenceStore(str(tmp_path / "refstore.db")) as refstore:
+        yield refstore
+
+
+def test_load_manifest_replaces_by_name(store):
+    """
+    Loading a manifest again replaces its measurements
+    """
+    first = hashlib.sha384(b"first").digest()
+    second = hashlib.sha384(b"second").digest()
+    store.load_manifest({"name": "ovmf", "version": "1",
+                         "measurements": [{"digest": first.hex(), "rtmr": 0}]})
+    assert store.lookup(first) == ((0, "ovmf", None),)
+    store.load_manifest({"name": "ovmf", "version": "2",
+                         "measurements": [{"digest": second.hex(), "component": "OVMF"},
+                                          {"digest": first.hex(), "rtmr": 1}]})
+    assert store.lookup(first) == ((1, "ovmf", None),)
+    assert store.lookup(second.hex()) == ((None, "ovmf", "OVMF"),)
+    assert [(manifest["name"], manifest["version"], manifest["measurements"])
+            for manifest in store.manifests()] == [("ovmf", "2", 2)]
+
+
+def test_lookup_many_batches(store):
+    """
+    Digests beyond one query batch are all looked up
+    """
+    digests = [hashlib.sha384(b"%d" % number).digest() for number in range(LOOKUP_BATCH * 2 + 1)]
+    store.load_manifest({"name": "big", "measurements": [
+        {"digest": digest.hex()} for digest in digests[::2]]})
+    found = store.lookup_many(digests + [digests[0]])
+    assert len(found) == len(digests)
+    for number, digest in enumerate(digests):
+        assert found[digest] == (((None, "big", None),) if number % 2 == 0 else ())
+    # memoized
+    assert store.lookup_many(digests) == found
+
+
+def test_appraise_empty_log(store):
+    """
+    A log with no entry after its spec ID header is an error
+    """
+    log, _ = build_event_log(0)
+    with pytest.raises(ValueError, match="No entry"):
+        store.appraise(TDEventLogActor(0, None, data=log))
+    result = store.appraise_log({"id": "empty", "eventlog": log})
+    assert result["status"] == "error"
+    assert result["id"] == "empty"
+    assert store.appraise_log({"id": "none"})["status"] == "error"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_appraise_batch(store, workers):
+    """
+    The results are in the order of the logs, with and without workers
+    """
+    known, _ = build_event_log(8)
+    partial, _ = build_event_log(12)
+    store.load_manifest(log_manifest(known))
+    logs = [known, {"id": "partial", "eventlog": partial}, {"id": "missing"}] * 5
+    results = list(store.appraise_batch(logs, workers=workers, chunksize=2))
+    assert [result["id"] for result in results] == \
+        [number if number % 3 == 0 else ("partial", "missing")[number % 3 - 1]
+         for number in range(len(logs))]
+    for result in results[::3]:
+        assert result["status"] == "pass"
+        assert result["matched"] == 8
+        assert result["manifests"] == {"fleet": 8}
+    for result in results[1::3]:
+        assert result["status"] == "fail"
+        assert [unknown[0] for unknown in result["unknown"]] == [8, 9, 10, 11]
+    for result in results[2::3]:
+        assert result["status"] == "error"
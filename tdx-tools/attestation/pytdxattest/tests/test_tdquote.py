@@ -0,0 +1,68 @@
+"""
+Tests of the TD quote parsing
+"""
+
+import pytest
+
+from pytdxattest.tdquote import TdQuote, QuoteCache
+from pytdxattest.utility import DeviceNode
+
+__author__ = "cpio"
+
+
+def test_truncated_quote(pki):
+    """
+    Every truncation of a quote raises ValueError
+    """
+    pck_key, pem, _ = pki.chain()
+    data = pki.quote(pck_key, pem)
+    assert TdQuote(data).signature_data.pck_cert_chain.tobytes() == pem
+    for length in range(len(data)):
+        with pytest.raises(ValueError):
+            quote = TdQuote(data[:length])
+            # the signature data is parsed when it is first accessed
+            _ = quote.signature_data
+
+
+@pytest.mark.parametrize("data", [b"", b"\x04\x00", b"\x05\x00" + bytes(64),
+                                  b"\x03\x00" + bytes(1024)])
+def test_invalid_quote(data):
+    """
+    A malformed quote raises ValueError
+    """
+    with pytest.raises(ValueError):
+        TdQuote(data)
+
+
+def test_get_invalid_quote(monkeypatch):
+    """
+    get_quote returns None for a malformed quote from the device
+    """
+    assert TdQuote.get_quote(b"nonce") is not None
+    monkeypatch.setattr(DeviceNode, "get_tdquote_bytes", lambda self, report_data: b"\x04\x00")
+    assert TdQuote.get_quote(b"nonce") is None
+
+
+def test_cached_quote_parsed_first(monkeypatch):
+    """
+    A malformed quote is not cached, and a malformed cached quote is
+    dropped and generated again
+    """
+    cache = QuoteCache(ttl=None)
+    get_quote = DeviceNode.get_tdquote_bytes_from_report
+    monkeypatch.setattr(DeviceNode, "get_tdquote_bytes_from_report",
+                        lambda self, tdreport_bytes: b"\x04\x00")
+    report_data = TdQuote.calc_report_data(b"nonce")
+    key = QuoteCache._key(report_data) # pylint: disable=protected-access
+    assert TdQuote.get_quote(b"nonce", cache=cache) is None
+    assert cache._cache.get(key) is None # pylint: disable=protected-access
+
+    monkeypatch.setattr(DeviceNode, "get_tdquote_bytes_from_report", get_quote)
+    quote = TdQuote.get_quote(b"nonce", cache=cache)
+    entry = cache._cache.get(key) # pylint: disable=protected-access
+    assert entry[QuoteCache.RTMRS_LENGTH:] == quote.data
+
+    # corrupt the cached quote, keeping its RTMR values
+    cache.put(report_data, entry[:QuoteCache.RTMRS_LENGTH], b"\x04\x00")
+    assert TdQuote.get_quote(b"nonce", cache=cache).data == quote.data
+    assert cache.get(report_data, entry[:QuoteCache.RTMRS_LENGTH]) == quote.data